@@ -0,0 +1,209 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""End-to-end upgrade throughput harness.
+
+Replays 'pre_upgrade' followed by the whole upgrade plan scheduled by the
+driver on a synthetic inventory. Ansible is replaced by stand-ins that
+simulate playbook execution (see :mod:`benchmarks.fake`): a fake
+'openstack-ansible' wrapper for the alternative driver, and a stub
+PlaybookExecutor for the reference one. Celery tasks are executed
+eagerly, so the harness needs neither a broker nor workers.
+
+The report contains wall-clock time of the whole upgrade, simulated
+playbook time, and the overhead added by the driver on top of it.
+
+Usage::
+
+    $ python -m benchmarks.bench_e2e --drivers alt,ref --scales 100,1000
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+import mock
+
+from kostyor.rpc import app
+
+from kostyor_openstack_ansible import discover, inventory
+from kostyor_openstack_ansible.upgrades import alt, base, ref
+
+from tests.common import get_inventory_instance
+
+from . import fake
+from .common import get_all_nodes
+from .generator import generate_inventory
+
+
+_DRIVERS = {
+    'alt': alt.Driver,
+    'ref': ref.Driver,
+}
+
+
+def _write_script(path, content):
+    with open(path, 'w') as fp:
+        fp.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def _prepare_root(workdir):
+    # Drivers run bootstrap script and playbooks from OpenStack Ansible
+    # checkout, so it must look like a real one.
+    root = os.path.join(workdir, 'openstack-ansible')
+    os.makedirs(os.path.join(root, 'playbooks'))
+    os.makedirs(os.path.join(root, 'scripts', 'upgrade-utilities',
+                             'playbooks'))
+    _write_script(
+        os.path.join(root, 'scripts', 'bootstrap-ansible.sh'),
+        '#!/bin/sh\nexit 0\n')
+
+    wrapper = os.path.join(workdir, 'openstack-ansible.sh')
+    _write_script(wrapper, '#!/bin/sh\nexec "%s" "%s" "$@"\n' % (
+        sys.executable, os.path.splitext(fake.__file__)[0] + '.py'))
+
+    return root, wrapper
+
+
+def _get_plan(instance, scale):
+    hosts = dict((host['hostname'], host) for host in get_all_nodes(scale))
+    plan = collections.OrderedDict()
+
+    with mock.patch.object(discover, 'Inventory', return_value=instance):
+        services = discover._get_hosts()
+
+    for hostname in sorted(services):
+        for service in services[hostname]:
+            plan.setdefault(service['name'], []).append(hosts[hostname])
+
+    return [({'name': name}, nodes) for name, nodes in plan.items()]
+
+
+def run(driver, scale, latency, failure_rate, forks):
+    """Replay the whole upgrade on a given number of nodes.
+
+    :returns: a dict with measurements
+    """
+    data = generate_inventory(scale)
+    instance = get_inventory_instance(data)
+    plan = _get_plan(instance, scale)
+
+    def get_inventory(*args, **kwargs):
+        # The same inventory instance is reused by all executions, so the
+        # limit set by previous execution must be reset.
+        instance.subset(None)
+        return instance
+
+    workdir = tempfile.mkdtemp(prefix='kostyor-e2e-')
+    root, wrapper = _prepare_root(workdir)
+    log = os.path.join(workdir, 'simulated.log')
+
+    patches = [
+        mock.patch.object(app.app.conf, 'CELERY_ALWAYS_EAGER', True),
+        mock.patch.object(base, '_STATE_DIR', os.path.join(workdir, 'state')),
+        mock.patch.object(alt, '_OPENSTACK_ANSIBLE', wrapper),
+        mock.patch.object(
+            alt.inventory, 'load',
+            return_value=inventory.InventoryIndex(data)),
+        mock.patch.object(ref, 'Inventory', side_effect=get_inventory),
+        mock.patch.object(ref, 'PlaybookExecutor', fake.PlaybookExecutor),
+        alt._setenv(**fake.get_env(latency, failure_rate, forks, log)),
+    ]
+
+    for patch in patches:
+        patch.__enter__()
+
+    try:
+        upgrade = _DRIVERS[driver]()
+        upgrade._root = root
+
+        error = None
+        started = time.time()
+        try:
+            upgrade.pre_upgrade()()
+            upgrade.schedule(plan)()
+        except Exception as exc:
+            error = str(exc)
+        wall = time.time() - started
+
+        simulated = fake.read_log(log)
+    finally:
+        for patch in reversed(patches):
+            patch.__exit__(None, None, None)
+        shutil.rmtree(workdir)
+
+    return {
+        'driver': driver,
+        'nodes': scale,
+        'services': len(plan),
+        'wall': wall,
+        'simulated': simulated,
+        'overhead': wall - simulated,
+        'overhead_per_node': (wall - simulated) / scale,
+        'error': error,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--drivers', type=lambda value: value.split(','), default=['alt'],
+        help='comma separated drivers to replay upgrade with')
+    parser.add_argument(
+        '--scales', type=lambda value: [int(v) for v in value.split(',')],
+        default=[100, 1000, 5000], help='comma separated numbers of nodes')
+    parser.add_argument(
+        '--latency', type=float, default=0.001,
+        help='simulated playbook time per host, in seconds')
+    parser.add_argument(
+        '--failure-rate', type=float, default=0.0,
+        help='probability of playbook failure per host')
+    parser.add_argument(
+        '--forks', type=int, default=5,
+        help='a number of hosts simulated playbook processes in parallel')
+    parser.add_argument(
+        '--output', help='a file to write results to instead of stdout')
+    args = parser.parse_args(argv)
+
+    results = []
+    for scale in args.scales:
+        for driver in args.drivers:
+            results.append(run(
+                driver, scale, args.latency, args.failure_rate, args.forks))
+            print('%-4s %8d nodes: %10.2fs wall, %10.2fs simulated, '
+                  '%10.2fs overhead' % (
+                      driver, scale, results[-1]['wall'],
+                      results[-1]['simulated'], results[-1]['overhead']),
+                  file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of limit resolution by upgrade drivers.
+
+Compares resolving the limit via 'inventory.subset()' with a list of
+hostnames (the way it used to be done) against a transient inventory
+group used by the reference driver, and against the inventory index used
+by the alternative driver.
+
+Usage::
+
+    $ python -m benchmarks.bench_limit
+"""
+
+from __future__ import print_function
+
+from kostyor_openstack_ansible import inventory
+from kostyor_openstack_ansible.upgrades import base, ref
+
+from tests.common import get_inventory_instance
+
+from .common import get_all_nodes, measure
+from .generator import generate_inventory
+
+
+_SCALES = [10, 100, 1000, 5000]
+_SERVICE = {'name': 'nova-compute'}
+
+
+def _subset_by_names(data, nodes):
+    instance = get_inventory_instance(data)
+    hosts = base.get_component_hosts_on_nodes(instance, _SERVICE, nodes)
+
+    def fn():
+        instance.subset([host.get_name() for host in hosts])
+        instance.clear_pattern_cache()
+        return instance.get_hosts()
+    return fn
+
+
+def _subset_by_group(data, nodes):
+    instance = get_inventory_instance(data)
+    hosts = base.get_component_hosts_on_nodes(instance, _SERVICE, nodes)
+
+    def fn():
+        ref._limit_inventory(instance, hosts)
+        return instance.get_hosts()
+    return fn
+
+
+def _resolve_by_index(data, nodes):
+    index = inventory.InventoryIndex(data)
+
+    def fn():
+        return base.get_component_hostnames_on_nodes(index, _SERVICE, nodes)
+    return fn
+
+
+def main():
+    print('%8s %14s %14s %14s' % ('nodes', 'subset(list)', 'subset(group)',
+                                  'index'))
+
+    for scale in _SCALES:
+        data = generate_inventory(scale)
+        nodes = get_all_nodes(scale)
+
+        print('%8d %13.4fs %13.4fs %13.4fs' % (
+            scale,
+            measure(_subset_by_names(data, nodes)),
+            measure(_subset_by_group(data, nodes)),
+            measure(_resolve_by_index(data, nodes)),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-task overhead of Ansible strategies.
+
+Unlike the end-to-end harness, Ansible is real here: a playbook of many
+trivial tasks is executed on fake hosts, i.e. inventory hosts that use
+local connection. Tasks do nothing, so the time they take is overhead
+of the strategy, such as module transfer and interpreter startup. The
+playbook is executed the same way the alternative driver does, with the
+strategy passed via environment.
+
+The overhead is measured as the difference between the playbook with
+tasks and the same playbook without them, so Ansible startup time is
+not accounted for.
+
+Usage::
+
+    $ python -m benchmarks.bench_strategy --hosts 10 --tasks 50 \\
+        --strategies linear,mitogen_linear \\
+        --strategy-plugins /opt/mitogen/ansible_mitogen/plugins/strategy
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from kostyor_openstack_ansible.upgrades import alt, base
+
+
+#: Strategies shipped with Ansible, they need no plugins directory.
+_BUILTIN = ('linear', 'free', 'debug')
+
+
+def _write_inventory(path, hosts):
+    with open(path, 'w') as fp:
+        for i in range(hosts):
+            fp.write('host-%d ansible_connection=local '
+                     'ansible_python_interpreter=%s\n' % (i, sys.executable))
+
+
+def _write_playbook(path, tasks):
+    # JSON is valid YAML, so there's no need to depend on YAML emitter.
+    with open(path, 'w') as fp:
+        json.dump([{
+            'hosts': 'all',
+            'gather_facts': False,
+            'tasks': [
+                {'name': 'task-%d' % i, 'command': 'true'}
+                for i in range(tasks)
+            ],
+        }], fp, indent=2)
+
+
+def _run(ansible_playbook, playbook, inventory, forks, env):
+    with alt._setenv(**env), open(os.devnull, 'w') as devnull:
+        started = time.time()
+        subprocess.check_call(
+            [ansible_playbook, playbook, '-i', inventory, '-f', str(forks)],
+            stdout=devnull)
+    return time.time() - started
+
+
+def run(ansible_playbook, strategy, hosts, tasks, forks):
+    """Measure per-task overhead of a given strategy.
+
+    :returns: a dict with measurements, or with 'fallback' set if the
+              strategy plugin is not available
+    """
+    if base.get_strategy(strategy) is None:
+        return {'strategy': strategy['name'], 'fallback': True}
+    env = alt._get_strategy_env(strategy)
+
+    workdir = tempfile.mkdtemp(prefix='kostyor-strategy-')
+    try:
+        inventory = os.path.join(workdir, 'hosts')
+        empty = os.path.join(workdir, 'empty.yml')
+        playbook = os.path.join(workdir, 'playbook.yml')
+
+        _write_inventory(inventory, hosts)
+        _write_playbook(empty, 0)
+        _write_playbook(playbook, tasks)
+
+        startup = _run(ansible_playbook, empty, inventory, forks, env)
+        wall = _run(ansible_playbook, playbook, inventory, forks, env)
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        'strategy': strategy['name'],
+        'fallback': False,
+        'hosts': hosts,
+        'tasks': tasks,
+        'wall': wall,
+        'startup': startup,
+        'per_task': (wall - startup) / tasks,
+        'per_task_host': (wall - startup) / (tasks * hosts),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--strategies', type=lambda value: value.split(','),
+        default=['linear'], help='comma separated strategies to compare')
+    parser.add_argument(
+        '--strategy-plugins',
+        help='a directory with third-party strategy plugins')
+    parser.add_argument(
+        '--hosts', type=int, default=10, help='a number of fake hosts')
+    parser.add_argument(
+        '--tasks', type=int, default=50,
+        help='a number of tasks in the playbook')
+    parser.add_argument(
+        '--forks', type=int, default=5,
+        help='a number of hosts Ansible processes in parallel')
+    parser.add_argument(
+        '--ansible-playbook', default='ansible-playbook',
+        help='a path to ansible-playbook')
+    parser.add_argument(
+        '--output', help='a file to write results to instead of stdout')
+    args = parser.parse_args(argv)
+
+    if not args.strategy_plugins and set(args.strategies) - set(_BUILTIN):
+        parser.error('--strategy-plugins is required for third-party '
+                     'strategies')
+
+    results = []
+    for name in args.strategies:
+        strategy = {'name': name}
+        if name not in _BUILTIN:
+            strategy['plugins'] = args.strategy_plugins
+
+        results.append(run(
+            args.ansible_playbook, strategy, args.hosts, args.tasks,
+            args.forks))
+
+        if results[-1]['fallback']:
+            print('%-20s not available' % name, file=sys.stderr)
+        else:
+            print('%-20s %10.4fs per task, %10.4fs per task per host' % (
+                name, results[-1]['per_task'], results[-1]['per_task_host']),
+                file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import timeit
+
+from tests.common import get_hosts  # noqa
+
+from .generator import get_nodes_layout
+
+
+def measure(fn, repeat=3):
+    """Return the best wall-clock time of a given function in seconds."""
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def get_all_nodes(nodes):
+    """Return Kostyor hosts for all physical nodes of generated inventory.
+
+    :param nodes: a number of physical nodes passed to the generator
+    :type nodes: int
+    """
+    return get_hosts(*[
+        hostname
+        for hostnames in get_nodes_layout(nodes).values()
+        for hostname in hostnames
+    ])
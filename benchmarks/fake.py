@@ -0,0 +1,168 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Stand-ins for Ansible that simulate playbook execution.
+
+Playbook execution is simulated by sleeping for a per-host latency, with
+hosts processed in parallel by a given number of forks, and by failing
+random hosts with a given rate. Simulated time is appended to a log file,
+so the harness can tell it apart from time spent by drivers.
+
+The module can be executed as a script, in that case it behaves like
+'openstack-ansible' wrapper. Simulation settings are passed via
+environment, since the wrapper is executed by the driver.
+"""
+
+from __future__ import print_function
+
+import fcntl
+import json
+import math
+import os
+import random
+import sys
+import time
+
+
+#: Environment variables the simulation settings are passed through.
+_LATENCY = 'KOSTYOR_FAKE_LATENCY'
+_FAILURE_RATE = 'KOSTYOR_FAKE_FAILURE_RATE'
+_FORKS = 'KOSTYOR_FAKE_FORKS'
+_LOG = 'KOSTYOR_FAKE_LOG'
+
+
+def get_env(latency=0.0, failure_rate=0.0, forks=5, log=None):
+    """Return environment variables to pass simulation settings."""
+    env = {
+        _LATENCY: str(latency),
+        _FAILURE_RATE: str(failure_rate),
+        _FORKS: str(forks),
+    }
+    if log:
+        env[_LOG] = log
+    return env
+
+
+def simulate(hosts, environ=os.environ):
+    """Simulate playbook execution on given hosts.
+
+    :param hosts: inventory hostnames
+    :type hosts: [str]
+
+    :returns: a set of failed hostnames
+    """
+    latency = float(environ.get(_LATENCY, 0.0))
+    failure_rate = float(environ.get(_FAILURE_RATE, 0.0))
+    forks = int(environ.get(_FORKS, 5))
+
+    # Playbooks without limit are executed on localhost or a handful of
+    # hosts, and take time of a single host.
+    duration = latency * math.ceil(float(len(hosts) or 1) / forks)
+    time.sleep(duration)
+
+    if environ.get(_LOG):
+        with open(environ[_LOG], 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.write('%r\n' % duration)
+
+    return set(host for host in hosts if random.random() < failure_rate)
+
+
+def read_log(path):
+    """Return total simulated time from a given log file."""
+    if not os.path.exists(path):
+        return 0.0
+
+    with open(path) as fp:
+        return sum(float(line) for line in fp if line.strip())
+
+
+class _Stats(object):
+
+    def __init__(self, failed, hosts=()):
+        self.failures = dict((host, 1) for host in failed)
+        self.dark = {}
+        self.processed = dict((host, 1) for host in hosts)
+
+
+class _TaskQueueManager(object):
+
+    def __init__(self):
+        self._callback_plugins = []
+        self._stats = _Stats([])
+
+
+class PlaybookExecutor(object):
+    """Stub of Ansible's PlaybookExecutor for the reference driver."""
+
+    def __init__(self, playbooks, inventory, **kwargs):
+        self._inventory = inventory
+        self._tqm = _TaskQueueManager()
+
+    def run(self):
+        hosts = [host.get_name() for host in self._inventory.get_hosts()]
+        failed = simulate(hosts)
+        self._tqm._stats = _Stats(failed, hosts)
+        return 2 if failed else 0
+
+
+def main(argv):
+    """Simulate 'openstack-ansible <playbook> [-l @limit] [options]'."""
+    playbook, hosts = argv[0], []
+
+    if '-l' in argv:
+        with open(argv[argv.index('-l') + 1][1:]) as fp:
+            hosts = [line.strip() for line in fp if line.strip()]
+
+    started = time.time()
+    failed = simulate(hosts)
+
+    # Behave like Ansible with the driver's callback plugin enabled, so
+    # parsing of playbook events is accounted for.
+    if os.environ.get('KOSTYOR_EVENTS_FILE'):
+        with open(os.environ['KOSTYOR_EVENTS_FILE'], 'a') as fp:
+            fp.write(json.dumps({
+                'event': 'task', 'task': playbook, 'time': started}) + '\n')
+            for host in hosts:
+                fp.write(json.dumps({
+                    'event': 'result',
+                    'host': host,
+                    'status': 'failed' if host in failed else 'changed',
+                    'time': time.time(),
+                }) + '\n')
+            fp.write(json.dumps({'event': 'stats', 'time': time.time()}) +
+                     '\n')
+
+    if not failed:
+        return 0
+
+    # Behave like Ansible configured by the alternative driver, so retry
+    # of the failed task is simulated as well.
+    if os.environ.get('ANSIBLE_RETRY_FILES_ENABLED') == 'True':
+        retry_file = os.path.join(
+            os.environ['ANSIBLE_RETRY_FILES_SAVE_PATH'],
+            os.path.splitext(os.path.basename(playbook))[0] + '.retry')
+
+        if not os.path.isdir(os.path.dirname(retry_file)):
+            os.makedirs(os.path.dirname(retry_file))
+        with open(retry_file, 'w') as fp:
+            fp.write(''.join(host + '\n' for host in sorted(failed)))
+
+    print('Failed hosts: %s' % ', '.join(sorted(failed)), file=sys.stderr)
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,173 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic OpenStack Ansible inventory generator.
+
+Produces inventories of the same shape as OpenStack Ansible dynamic
+inventory does: control plane services in LXC containers on infra nodes,
+metal services on compute and storage nodes, '{node}-host_containers'
+groups referenced by 'container_types' and '{component}_all' groups.
+"""
+
+import collections
+import uuid
+
+
+#: Containers deployed on each infra node, and inventory groups their
+#: hosts belong to.
+_INFRA_CONTAINERS = [
+    ('keystone_container', ['keystone']),
+    ('glance_container', ['glance_api', 'glance_registry']),
+    ('nova_api_metadata_container', ['nova_api_metadata']),
+    ('nova_api_os_compute_container', ['nova_api_os_compute']),
+    ('nova_cert_container', ['nova_cert']),
+    ('nova_conductor_container', ['nova_conductor']),
+    ('nova_console_container', ['nova_console']),
+    ('nova_scheduler_container', ['nova_scheduler']),
+    ('neutron_server_container', ['neutron_server']),
+    ('neutron_agents_container', [
+        'neutron_dhcp_agent',
+        'neutron_l3_agent',
+        'neutron_linuxbridge_agent',
+        'neutron_metadata_agent',
+        'neutron_metering_agent',
+    ]),
+    ('cinder_api_container', ['cinder_api']),
+    ('cinder_scheduler_container', ['cinder_scheduler']),
+    ('heat_apis_container', [
+        'heat_api',
+        'heat_api_cfn',
+        'heat_api_cloudwatch',
+    ]),
+    ('heat_engine_container', ['heat_engine']),
+    ('horizon_container', ['horizon']),
+]
+
+#: Groups of services running on metal per node type.
+_METAL_GROUPS = {
+    'compute': ['nova_compute', 'neutron_linuxbridge_agent'],
+    'storage': ['cinder_volume'],
+}
+
+#: Children of '{component}_all' groups.
+_ALL_GROUPS = {
+    'keystone_all': ['keystone'],
+    'glance_all': ['glance_api', 'glance_registry'],
+    'nova_all': [
+        'nova_api_metadata',
+        'nova_api_os_compute',
+        'nova_cert',
+        'nova_compute',
+        'nova_conductor',
+        'nova_console',
+        'nova_scheduler',
+    ],
+    'neutron_all': [
+        'neutron_dhcp_agent',
+        'neutron_l3_agent',
+        'neutron_linuxbridge_agent',
+        'neutron_metadata_agent',
+        'neutron_metering_agent',
+        'neutron_server',
+    ],
+    'cinder_all': ['cinder_api', 'cinder_scheduler', 'cinder_volume'],
+    'heat_all': [
+        'heat_api',
+        'heat_api_cfn',
+        'heat_api_cloudwatch',
+        'heat_engine',
+    ],
+    'horizon_all': ['horizon'],
+}
+
+
+def _address(n):
+    return '172.29.%d.%d' % (236 + n // 250, 1 + n % 250)
+
+
+def get_nodes_layout(nodes):
+    """Split a number of physical nodes into infra, storage and compute.
+
+    :returns: a dict of node type to list of hostnames
+    """
+    infra = 3 if nodes >= 10 else 1
+    storage = max(nodes // 20, 1 if nodes > infra + 1 else 0)
+    compute = max(nodes - infra - storage, 0)
+
+    return collections.OrderedDict([
+        ('infra', ['infra%d' % i for i in range(1, infra + 1)]),
+        ('storage', ['storage%d' % i for i in range(1, storage + 1)]),
+        ('compute', ['compute%d' % i for i in range(1, compute + 1)]),
+    ])
+
+
+def generate_inventory(nodes):
+    """Generate OpenStack Ansible inventory with a given number of nodes.
+
+    :param nodes: a number of physical nodes in the inventory
+    :type nodes: int
+
+    :returns: inventory as produced by dynamic inventory script
+    """
+    groups = collections.defaultdict(lambda: {'hosts': [], 'children': []})
+    hostvars = {}
+
+    def add_host(name, physical_host, component, is_metal):
+        hostvars[name] = {
+            'ansible_host': _address(len(hostvars)),
+            'component': component,
+            'container_name': name,
+            'physical_host': physical_host,
+            'is_metal': is_metal,
+        }
+        if is_metal:
+            hostvars[name]['container_types'] = \
+                '%s-host_containers' % physical_host
+        return hostvars[name]
+
+    layout = get_nodes_layout(nodes)
+
+    for node in layout['infra']:
+        add_host(node, node, 'haproxy', True)
+        groups['haproxy_hosts']['hosts'].append(node)
+
+        for container, container_groups in _INFRA_CONTAINERS:
+            name = '%s_%s-%s' % (node, container, uuid.uuid4().hex[:8])
+            add_host(name, node, container_groups[0], False)
+
+            groups['%s-host_containers' % node]['hosts'].append(name)
+            for group in container_groups:
+                groups[group]['hosts'].append(name)
+
+    for node_type in ('storage', 'compute'):
+        for node in layout[node_type]:
+            add_host(node, node, _METAL_GROUPS[node_type][0], True)
+
+            groups['%s_hosts' % node_type]['hosts'].append(node)
+            for group in _METAL_GROUPS[node_type]:
+                groups[group]['hosts'].append(node)
+
+    for group, children in _ALL_GROUPS.items():
+        groups[group]['children'].extend(children)
+
+    groups['all_containers']['children'].extend(
+        '%s-host_containers' % node for node in layout['infra'])
+    groups['hosts']['children'].extend(
+        '%s_hosts' % node_type
+        for node_type in ('haproxy', 'storage', 'compute'))
+
+    rv = dict(groups)
+    rv['_meta'] = {'hostvars': hostvars}
+    return rv
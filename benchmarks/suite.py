@@ -0,0 +1,218 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks of driver hot paths on synthetic inventories.
+
+Each benchmark is measured on inventories of different scale, and results
+are printed as JSON, so they can be saved and used as a baseline for the
+next run. If a baseline is passed, benchmarks that became slower than
+the baseline by more than a given tolerance are reported as regressions
+and the exit code is non-zero.
+
+Usage::
+
+    $ python -m benchmarks.suite --output baseline.json
+    $ python -m benchmarks.suite --baseline baseline.json --tolerance 0.2
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import mock
+import yaml
+
+from ansible.parsing.dataloader import DataLoader
+
+from kostyor_openstack_ansible import discover
+from kostyor_openstack_ansible.upgrades import alt, base, ref
+
+from tests.common import get_inventory_instance
+
+from .common import get_all_nodes, measure
+from .generator import generate_inventory, get_nodes_layout
+
+
+_SCALES = [10, 100, 1000, 5000, 20000]
+
+
+def _bench_discover(scale, workdir):
+    instance = get_inventory_instance(generate_inventory(scale))
+
+    def fn():
+        with mock.patch.object(discover, 'Inventory', return_value=instance):
+            return discover._get_hosts()
+    return fn
+
+
+def _bench_component_hosts(scale, workdir):
+    instance = get_inventory_instance(generate_inventory(scale))
+    nodes = get_all_nodes(scale)
+
+    def fn():
+        return base.get_component_hosts_on_nodes(
+            instance, {'name': 'nova-compute'}, nodes)
+    return fn
+
+
+def _bench_start(scale, workdir):
+    nodes = get_all_nodes(scale)
+
+    # Planning is what happens in Driver.start before any task is
+    # executed, so every supported service is planned on every node.
+    def fn():
+        driver = alt.Driver()
+        return [
+            driver.start({'name': service}, list(nodes))
+            for service in sorted(driver._playbooks)
+        ]
+    return fn
+
+
+def _bench_user_settings(scale, workdir, loader_cls):
+    # OpenStack Ansible user settings do not depend on inventory size as
+    # such, but large deployments tend to have per-host overrides.
+    layout = get_nodes_layout(scale)
+    filenames = []
+
+    for name, data in [
+        ('user_secrets.yml', dict(
+            ('%s_password' % i, 'secret-%d' % i) for i in range(100))),
+        ('user_variables.yml', {
+            'nova_nova_conf_overrides': dict(
+                (hostname, {'DEFAULT': {'cpu_allocation_ratio': 4.0}})
+                for hostname in layout['compute']
+            ),
+        }),
+    ]:
+        filenames.append(os.path.join(workdir, name))
+        with open(filenames[-1], 'w') as fp:
+            yaml.safe_dump(data, fp)
+
+    def fn():
+        with mock.patch.object(ref.glob, 'glob', return_value=filenames):
+            return ref._get_user_settings(loader_cls())
+    return fn
+
+
+_BENCHMARKS = [
+    ('discover._get_hosts', _bench_discover),
+    ('base.get_component_hosts_on_nodes', _bench_component_hosts),
+    ('Driver.start', _bench_start),
+    ('ref._get_user_settings',
+     lambda scale, workdir: _bench_user_settings(
+         scale, workdir, DataLoader)),
+    ('ref._get_user_settings[cached]',
+     lambda scale, workdir: _bench_user_settings(
+         scale, workdir, ref._CachingDataLoader)),
+]
+
+
+def run(scales, repeat):
+    """Run all benchmarks on given scales.
+
+    :returns: a list of dicts with 'benchmark', 'nodes' and 'seconds' keys
+    """
+    results = []
+    workdir = tempfile.mkdtemp(prefix='kostyor-bench-')
+
+    try:
+        for scale in scales:
+            for name, bench in _BENCHMARKS:
+                seconds = measure(bench(scale, workdir), repeat)
+                results.append({
+                    'benchmark': name,
+                    'nodes': scale,
+                    'seconds': seconds,
+                })
+                print('%-40s %8d %10.4fs' % (name, scale, seconds),
+                      file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+
+def get_regressions(results, baseline, tolerance):
+    """Compare results against baseline.
+
+    :param tolerance: allowed slowdown, e.g. 0.2 for 20%
+    :type tolerance: float
+
+    :returns: a list of results slower than baseline, each extended with
+              'baseline' key
+    """
+    expected = dict(
+        ((item['benchmark'], item['nodes']), item['seconds'])
+        for item in baseline
+    )
+
+    return [
+        dict(item, baseline=expected[item['benchmark'], item['nodes']])
+        for item in results
+        if (item['benchmark'], item['nodes']) in expected
+        and item['seconds'] > (
+            expected[item['benchmark'], item['nodes']] * (1 + tolerance))
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--scales', type=lambda value: [int(v) for v in value.split(',')],
+        default=_SCALES, help='comma separated numbers of physical nodes')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='a number of runs to choose the best time from')
+    parser.add_argument(
+        '--output', help='a file to write results to instead of stdout')
+    parser.add_argument(
+        '--baseline', help='a file with results of previous run')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='allowed slowdown in comparison to baseline')
+    args = parser.parse_args(argv)
+
+    results = run(args.scales, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = get_regressions(
+                results, json.load(fp), args.tolerance)
+
+        for item in regressions:
+            print('REGRESSION %s on %d nodes: %.4fs, baseline %.4fs' % (
+                item['benchmark'], item['nodes'], item['seconds'],
+                item['baseline']), file=sys.stderr)
+
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
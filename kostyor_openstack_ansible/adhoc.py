@@ -0,0 +1,135 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+from . import tracing
+
+
+#: A path to Ansible ad-hoc command line tool. OpenStack Ansible installs
+#: it along with 'openstack-ansible' wrapper when bootstrapping Ansible.
+_ANSIBLE = os.path.join('/usr', 'local', 'bin', 'ansible')
+
+#: A result of module execution on one host.
+#:
+#: :param result: module result as returned by Ansible
+#: :param elapsed: seconds passed since the start of Ansible till host's
+#:                 result, so Ansible startup and waiting for a free fork
+#:                 are included
+AdHocResult = collections.namedtuple('AdHocResult', ['result', 'elapsed'])
+
+
+def _read_tree(tree, started):
+    rv = {}
+
+    # Ansible writes each host's result to a separate file as soon as it
+    # receives one, so file modification time tells when the host has
+    # responded.
+    for hostname in os.listdir(tree):
+        path = os.path.join(tree, hostname)
+
+        with open(path) as fp:
+            try:
+                result = json.load(fp)
+            except ValueError:
+                continue
+
+        rv[hostname] = AdHocResult(
+            result, max(os.path.getmtime(path) - started, 0.0))
+    return rv
+
+
+def _kill(process):
+    # Ansible forks workers, so the whole process group is killed, or
+    # workers would keep connecting to hosts after the deadline.
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+@tracing.span('adhoc')
+def run(hosts, module, args=None, forks=None, timeout=None):
+    """Run Ansible module on given hosts out of process.
+
+    Unlike playbooks executed via 'openstack-ansible' wrapper, ad-hoc
+    commands are used to quickly probe hosts, so results are read back
+    from Ansible's '--tree' output.
+
+    :param hosts: inventory hostnames to run the module on
+    :type hosts: [str]
+
+    :param module: a module name to run, e.g. 'setup'
+    :type module: str
+
+    :param args: module arguments
+    :type args: str
+
+    :param forks: a number of parallel processes to use
+    :type forks: int
+
+    :param timeout: seconds after which Ansible is killed, and results of
+                    hosts that have responded so far are returned
+    :type timeout: float
+
+    :returns: a dict of hostname to :class:`AdHocResult`; hosts that
+              haven't responded are missed
+    """
+    tree = tempfile.mkdtemp(prefix='kostyor-tree-')
+    limit = tempfile.NamedTemporaryFile('w', prefix='kostyor-limit-')
+
+    try:
+        with limit:
+            limit.write('\n'.join(hosts))
+            limit.flush()
+
+            command = [
+                _ANSIBLE, 'all',
+                '-l', '@' + limit.name,
+                '-m', module,
+                '--tree', tree,
+            ]
+            if args:
+                command.extend(['-a', args])
+            if forks:
+                command.extend(['-f', str(forks)])
+
+            started = time.time()
+
+            # Ansible returns non-zero exit code if the module is failed on
+            # some hosts, and that's fine since we're interested in
+            # per-host results.
+            if timeout is None:
+                subprocess.Popen(command).wait()
+            else:
+                process = subprocess.Popen(command, preexec_fn=os.setsid)
+                timer = threading.Timer(timeout, _kill, [process])
+                timer.start()
+                try:
+                    process.wait()
+                finally:
+                    timer.cancel()
+
+        return _read_tree(tree, started)
+    finally:
+        shutil.rmtree(tree, ignore_errors=True)
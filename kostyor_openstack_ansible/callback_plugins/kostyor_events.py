@@ -0,0 +1,81 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Ansible callback plugin that writes playbook events as JSON lines.
+
+The plugin is loaded by Ansible itself, out of the driver's process, so
+it must not import anything from the driver. Events are appended to a
+file passed via KOSTYOR_EVENTS_FILE environment variable, one JSON object
+per line, and parsed by :mod:`kostyor_openstack_ansible.events`.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'kostyor_events'
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+
+        path = os.environ.get('KOSTYOR_EVENTS_FILE')
+        self._fp = open(path, 'a') if path else None
+
+    def _emit(self, event, **fields):
+        if self._fp is None:
+            return
+
+        fields.update(event=event, time=time.time())
+        self._fp.write(json.dumps(fields) + '\n')
+        self._fp.flush()
+
+    def _emit_result(self, result, status):
+        self._emit('result', host=result._host.get_name(), status=status)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._emit('task', task=task.get_name())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._emit('task', task=task.get_name())
+
+    def v2_runner_on_ok(self, result):
+        self._emit_result(
+            result, 'changed' if result._result.get('changed') else 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        # Ansible counts ignored failures as successful results, so do we.
+        self._emit_result(result, 'ok' if ignore_errors else 'failed')
+
+    def v2_runner_on_unreachable(self, result):
+        self._emit_result(result, 'unreachable')
+
+    def v2_runner_on_skipped(self, result):
+        self._emit_result(result, 'skipped')
+
+    def v2_playbook_on_stats(self, stats):
+        self._emit('stats')
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
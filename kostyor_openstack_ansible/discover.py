@@ -14,6 +14,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import os
+import time
+
+import celery
 
 from ansible.inventory import Inventory
 from ansible.parsing.dataloader import DataLoader
@@ -22,6 +26,8 @@ from ansible.vars import VariableManager
 from kostyor.inventory.discover import ServiceDiscovery
 from kostyor.rpc.app import app
 
+from . import adhoc, inventory, metrics
+
 # Ansible Inventory consists of groups each contains number of hosts.
 # This is a map of Ansible groups to OpenStack services. In other words,
 # all hosts of the following groups have the following services assigned
@@ -132,8 +138,170 @@ _SERVICES_BY_INVENTORY_GROUPS = {
 }
 
 
+#: Names of processes that tell a service is running, for services that
+#: don't run as a process of the same name. Any of them is enough.
+_PROCESSES_BY_SERVICES = {
+    # Depending on OpenStack Ansible release, Keystone runs either under
+    # uWSGI with WSGI script of the same name, or under Apache.
+    'keystone-wsgi-admin': ['keystone-wsgi-admin', 'apache2', 'httpd'],
+    'keystone-wsgi-public': ['keystone-wsgi-public', 'apache2', 'httpd'],
+    'horizon-wsgi': ['apache2', 'httpd'],
+}
+
+#: Ansible module and its arguments to list command lines of running
+#: processes. Unlike systemd units, processes can be listed the same way
+#: on every host and in every container.
+_PROCESS_PROBE = 'command', 'ps -eo args --no-headers'
+
+#: Seconds the probe is given if its settings have no 'timeout'. A hung
+#: host must never stall discovery, so the probe is always bounded.
+_PROBE_TIMEOUT = 60.0
+
+#: Seconds probe results are reused for. Discovery may be requested over
+#: and over again, while probing hundreds of hosts is not free.
+_PROBE_TTL = 300.0
+
+#: Results of the last probe in the following format:
+#:
+#:   hostnames -> (time, {hostname: process-names})
+_PROBE_CACHE = {}
+
+
+def _get_process_names(output):
+    # OpenStack services are Python scripts in virtual environments, e.g.
+    # '/openstack/venvs/nova-14.0.0/bin/python .../bin/nova-compute', so
+    # processes are matched by basename of any command line argument.
+    return set(
+        os.path.basename(arg)
+        for line in output.splitlines()
+        for arg in line.split()
+    )
+
+
+@metrics.timed('discovery_probe')
+def _probe(hostnames, forks=None, timeout=_PROBE_TIMEOUT):
+    key = tuple(sorted(hostnames))
+    cached = _PROBE_CACHE.get(key)
+
+    if cached is not None and time.time() - cached[0] < _PROBE_TTL:
+        metrics.inc('discovery_probe_cache_hits_total')
+        return cached[1]
+
+    results = adhoc.run(
+        list(key), *_PROCESS_PROBE, forks=forks, timeout=timeout)
+
+    # Hosts that haven't responded within time budget, as well as ones
+    # the probe failed on, are missed, so their services can't be
+    # verified.
+    rv = dict(
+        (hostname, _get_process_names(result.result.get('stdout', '')))
+        for hostname, result in results.items()
+        if result.result.get('rc') == 0
+    )
+
+    # Each chunk of discovery probes its own hosts, so results are cached
+    # per set of hosts and evicted once expired.
+    for expired in [k for k, (probed, _) in _PROBE_CACHE.items()
+                    if time.time() - probed >= _PROBE_TTL]:
+        del _PROBE_CACHE[expired]
+    _PROBE_CACHE[key] = (time.time(), rv)
+    return rv
+
+
+def _is_running(service, processes):
+    return any(
+        name in processes
+        for name in _PROCESSES_BY_SERVICES.get(service, [service]))
+
+
+def _add_services(rv, hostname, services):
+    # In case of All-in-One setup, some services might allocated few
+    # times on the same host. For instance, Neutron L2 agent should
+    # run on baremetal host with nova-compute as well as inside
+    # Nuetron control plane containers. From Kostyor POV, we are not
+    # interested in such details so we need to deduplicate service
+    # entries.
+    added = set(service['name'] for service in rv[hostname])
+    rv[hostname].extend(
+        {'name': service} for service in services if service not in added)
+
+
+def _get_members(groups, cached=False):
+    # Mapped inventory index is shared by worker processes, and looking
+    # into it is way cheaper than building Ansible inventory, so it's
+    # preferred when enabled. Chunks of large inventory are discovered by
+    # separate tasks, so they use the index cached by worker process too,
+    # rather than generate the whole inventory for each chunk.
+    if inventory.has_mapped_index() or cached:
+        index = inventory.load(inventory.get_path())
+        members = dict(
+            (group, index.get_group_hosts(group)) for group in groups)
+
+        return dict(
+            (group, None if hosts is None else [
+                (host, index.get_host_vars(host)['physical_host'])
+                for host in sorted(hosts)
+            ])
+            for group, hosts in members.items()
+        )
+
+    ansible_inventory = Inventory(DataLoader(), VariableManager())
+    members = dict(
+        (group, ansible_inventory.get_group(group)) for group in groups)
+
+    return dict(
+        (group, None if hosts is None else sorted(
+            (host.get_name(), host.get_vars()['physical_host'])
+            for host in hosts.get_hosts()
+        ))
+        for group, hosts in members.items()
+    )
+
+
 @app.task
-def _get_hosts():
+def _get_group_sizes():
+    members = _get_members(_SERVICES_BY_INVENTORY_GROUPS, cached=True)
+    return dict(
+        (group, len(hosts or [])) for group, hosts in members.items())
+
+
+def _get_slices(sizes, size):
+    """Split inventory groups into chunks of a given number of hosts.
+
+    Groups like 'nova_compute' may contain almost all hosts, so large
+    groups are split between chunks too.
+
+    :param sizes: a dict of group to a number of its hosts
+    :type sizes: {str: int}
+
+    :param size: a maximum number of hosts in a chunk
+    :type size: int
+
+    :returns: a list of chunks, each is a list of group, offset of the
+              first host and a number of hosts
+    """
+    chunks, chunk, free = [], [], size
+
+    for group in sorted(sizes):
+        offset = 0
+        while offset < sizes[group]:
+            count = min(free, sizes[group] - offset)
+            chunk.append([group, offset, count])
+            offset += count
+            free -= count
+
+            if not free:
+                chunks.append(chunk)
+                chunk, free = [], size
+
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+@app.task
+@metrics.timed('discovery')
+def _get_hosts(probe=None, slices=None):
     """Inspect OpenStack Ansible setup for hosts and services. Returned
     dictionary has a hostname as a key, and set of services as a value.
     Here's an example::
@@ -151,30 +319,52 @@ def _get_hosts():
     Please note, in some case we may return extra services due to bugs
     in OpenStack Ansible dynamic inventory which may produce extra items.
     Though they won't affect upgrade procedure, they might be a little
-    misleading.
+    misleading. If 'probe' is passed, services are verified to be running
+    by listing processes on all hosts and containers at once, and services
+    that aren't running are not returned. Services of hosts that haven't
+    responded within probe timeout are returned as is.
+
+    :param probe: probe settings with 'forks' and 'timeout' keys
+    :type probe: dict
+
+    :param slices: slices of inventory groups to inspect, all groups by
+                   default; large inventories are discovered in chunks,
+                   see :func:`_get_slices`
+    :type slices: [[str, int, int]]
     """
     rv = collections.defaultdict(list)
-    inventory = Inventory(DataLoader(), VariableManager())
 
-    for group, services in _SERVICES_BY_INVENTORY_GROUPS.items():
-        group = inventory.get_group(group)
+    if slices is None:
+        members = _get_members(_SERVICES_BY_INVENTORY_GROUPS)
+    else:
+        members = _get_members(
+            set(group for group, _, _ in slices), cached=True)
+        members = dict(
+            (group, (members[group] or [])[offset:offset + count])
+            for group, offset, count in slices)
+
+    processes = {}
+    if probe:
+        processes = _probe(
+            set(host
+                for hosts in members.values() if hosts is not None
+                for host, _ in hosts),
+            forks=probe.get('forks'),
+            timeout=probe.get('timeout') or _PROBE_TIMEOUT)
 
-        if group is None:
+    for group, hosts in members.items():
+        if hosts is None:
             continue
 
-        for host in group.get_hosts():
-            # In case of All-in-One setup, some services might allocated few
-            # times on the same host. For instance, Neutron L2 agent should
-            # run on baremetal host with nova-compute as well as inside
-            # Nuetron control plane containers. From Kostyor POV, we are not
-            # interested in such details so we need to deduplicate service
-            # entries.
-            to_add = filter(
-                lambda candidate: not bool(list(filter(
-                    lambda service: service['name'] == candidate,
-                    rv[host.get_vars()['physical_host']]
-                ))),
-                services)
+        services = _SERVICES_BY_INVENTORY_GROUPS[group]
+
+        for host, physical_host in hosts:
+            live = services
+            if host in processes:
+                live = [
+                    service for service in services
+                    if _is_running(service, processes[host])
+                ]
 
             # TODO: Process services to be added as not of them may be
             #       applied to the current setup. E.g., Neutron may be
@@ -182,16 +372,61 @@ def _get_hosts():
             #       while we always add both of them. It doesn't affect
             #       upgrade procedure, though, since services are used
             #       to build an upgrade order and no more.
-            rv[host.get_vars()['physical_host']].extend((
-                {'name': service} for service in to_add
-            ))
+            _add_services(rv, physical_host, live)
 
+    metrics.inc('discovery_hosts_total', len(rv))
     return rv
 
 
 class Driver(ServiceDiscovery):
 
+    #: Settings of optional liveness probe that verifies services inferred
+    #: from inventory are actually running. The probe lists processes on
+    #: all hosts and containers with a single ad-hoc command, so a high
+    #: number of forks makes it fast, while timeout is a strict budget
+    #: for the whole probe, :data:`_PROBE_TIMEOUT` by default. The probe
+    #: is disabled if None. The dict has the following format:
+    #:
+    #:   {'forks': 100, 'timeout': seconds}
+    _probe = None
+
+    #: A number of inventory hosts and containers discovered by one task.
+    #: Discovery of a large inventory produces a result that may exceed
+    #: size limits of Celery broker and result backend, so it can be split
+    #: into tasks of a bounded number of hosts each, even if most of them
+    #: are in one group. Their results are merged one by one as they are
+    #: received, so only one chunk is held in memory in addition to the
+    #: merged result. Discovery is done by a single task if None.
+    _chunk_size = None
+
     def discover(self):
+        if not self._chunk_size:
+            return {
+                'hosts': _get_hosts.delay(probe=self._probe).get(),
+            }
+
+        # Inventory is available on deployment host only, so group sizes
+        # are asked from a worker.
+        sizes = _get_group_sizes.delay().get()
+        chunks = _get_slices(sizes, self._chunk_size)
+        if not chunks:
+            return {'hosts': {}}
+
+        # Only the list of chunk results is kept, not the group result, so
+        # each chunk is dropped along with its cached result once merged.
+        chunks = celery.group(*[
+            _get_hosts.si(probe=self._probe, slices=slices)
+            for slices in chunks
+        ]).delay().results
+
+        hosts = collections.defaultdict(list)
+        while chunks:
+            chunk = chunks.pop(0)
+            for hostname, services in chunk.get().items():
+                _add_services(
+                    hosts, hostname, [service['name'] for service in services])
+            chunk.forget()
+
         return {
-            'hosts': _get_hosts.delay().get(),
+            'hosts': dict(hosts),
         }
@@ -0,0 +1,131 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import json
+import os
+
+
+#: A directory with Ansible callback plugins shipped with the driver.
+_CALLBACK_PLUGINS = os.path.join(os.path.dirname(__file__), 'callback_plugins')
+
+#: A name of callback plugin that writes playbook events as JSON lines.
+_CALLBACK = 'kostyor_events'
+
+#: An environment variable the callback plugin reads events file path from.
+_EVENTS_FILE = 'KOSTYOR_EVENTS_FILE'
+
+#: A number of slowest tasks to keep in a summary.
+_SLOWEST_TASKS = 10
+
+#: Per-host counters, the same Ansible shows in play recap.
+_COUNTERS = ('ok', 'changed', 'failed', 'unreachable', 'skipped')
+
+
+def get_env(path):
+    """Return environment variables to make Ansible write events to a file.
+
+    Callback plugin directory and whitelist are extended rather than
+    replaced, so plugins enabled by OpenStack Ansible keep working.
+
+    :param path: a path to events file
+    :type path: str
+
+    :returns: a dict of environment variables
+    """
+    def extend(name, value, separator):
+        if os.environ.get(name):
+            return value + separator + os.environ[name]
+        return value
+
+    return {
+        'ANSIBLE_CALLBACK_PLUGINS': extend(
+            'ANSIBLE_CALLBACK_PLUGINS', _CALLBACK_PLUGINS, os.pathsep),
+        'ANSIBLE_CALLBACK_WHITELIST': extend(
+            'ANSIBLE_CALLBACK_WHITELIST', _CALLBACK, ','),
+        _EVENTS_FILE: path,
+    }
+
+
+def parse(lines):
+    """Summarize playbook events written by the callback plugin.
+
+    Events are consumed one by one and only aggregates are kept, so
+    memory usage depends on a number of hosts and tasks but not on the
+    amount of output. Malformed lines, e.g. the last one of interrupted
+    execution, are skipped.
+
+    :param lines: JSON lines, e.g. an events file object
+    :type lines: iterable
+
+    :returns: a dict with 'hosts' key of hostname to per-host counters,
+              and 'tasks' key of slowest tasks, each a dict with 'task'
+              and 'duration' keys
+    """
+    hosts = {}
+    durations = {}
+    task, started, finished = None, None, None
+
+    def close_task():
+        if task is not None:
+            durations[task] = durations.get(task, 0.0) + finished - started
+
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+
+        # A task lasts till the next one is started, or till the end of
+        # playbook execution that is marked by 'stats' event.
+        finished = event['time']
+
+        if event.get('event') in ('task', 'stats'):
+            close_task()
+            task, started = event.get('task'), event['time']
+
+        elif event.get('event') == 'result':
+            counters = hosts.setdefault(
+                event['host'], dict((name, 0) for name in _COUNTERS))
+            counters[event['status']] += 1
+
+            # Changed results are successful ones too, just like in recap.
+            if event['status'] == 'changed':
+                counters['ok'] += 1
+
+    close_task()
+
+    return {
+        'hosts': hosts,
+        'tasks': [
+            {'task': name, 'duration': duration}
+            for name, duration in heapq.nlargest(
+                _SLOWEST_TASKS, durations.items(), key=lambda item: item[1])
+        ],
+    }
+
+
+def get_failed_hosts(summary):
+    """Return hosts that failed or were unreachable according to summary.
+
+    :param summary: a summary returned by :func:`parse`
+    :type summary: dict
+
+    :returns: a sorted list of hostnames
+    """
+    return sorted(
+        host for host, counters in summary['hosts'].items()
+        if counters['failed'] or counters['unreachable']
+    )
@@ -0,0 +1,443 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import subprocess
+import tempfile
+
+from . import metrics, tracing
+
+
+#: OpenStack Ansible dynamic inventory keeps the last generated inventory
+#: in this file, and it's exactly what the inventory script prints when
+#: Ansible asks for the list of hosts.
+_INVENTORY = os.path.join(
+    '/etc', 'openstack_deploy', 'openstack_inventory.json')
+
+#: Loaded indexes are kept in memory between tasks executed by the same
+#: worker process. Each deployment has its own inventory file, so they
+#: never share an index. The dict has the following format:
+#:
+#:   path -> (mtime, index)
+_CACHE = {}
+
+#: Inventory indexes are built into files of this directory and memory
+#: mapped, so all worker processes share one copy of each index instead
+#: of holding their own. Mapped indexes are used only if the directory
+#: exists.
+_INDEX_DIR = os.path.join(
+    '/var', 'lib', 'kostyor-openstack-ansible', 'inventory')
+
+#: Host variables kept in mapped index. These are all the driver needs to
+#: resolve hosts of a service on physical nodes.
+_INDEX_VARS = ('physical_host', 'container_types')
+
+#: Mapped index file layout:
+#:
+#:   header: magic, version, inventory mtime and size, a size of strings
+#:           blob and numbers of hosts, groups and group members
+#:   hosts: (name, physical_host, container_types) sorted by name
+#:   groups: (name, first member, members count) sorted by name
+#:   members: host numbers of each group, including children's hosts
+#:   strings: length-prefixed UTF-8 strings referenced by offset
+_HEADER = struct.Struct('<4sIdQIIII')
+_HOST = struct.Struct('<III')
+_GROUP = struct.Struct('<III')
+_MEMBER = struct.Struct('<I')
+_LENGTH = struct.Struct('<H')
+_MAGIC = b'KOAI'
+_VERSION = 1
+
+#: A string offset of missing host variables.
+_NONE = 0xffffffff
+
+
+class InventoryIndex(object):
+    """Read-only index over OpenStack Ansible inventory.
+
+    Building Ansible's own inventory instance is expensive: it runs the
+    dynamic inventory script, creates host and group objects, and resolves
+    variables. When all we need is to know what hosts are in what groups,
+    it's much cheaper to look directly at inventory JSON.
+
+    :param data: inventory as produced by dynamic inventory script
+    :type data: dict
+    """
+
+    def __init__(self, data):
+        self._hostvars = data.get('_meta', {}).get('hostvars', {})
+        self._groups = {}
+
+        for name, group in data.items():
+            if name == '_meta':
+                continue
+
+            # Dynamic inventory may produce groups in two formats: either
+            # as a plain list of hosts or as a dict with hosts, children
+            # and variables.
+            if isinstance(group, list):
+                group = {'hosts': group}
+            self._groups[name] = group
+
+        self._hosts_by_group = {}
+
+        # Just like in Ansible, hosts listed in groups exist even if they
+        # have no variables.
+        self._hosts = set(self._hostvars).union(*[
+            group.get('hosts', []) for group in self._groups.values()])
+
+    def get_host_vars(self, hostname):
+        """Return variables of a given host, or empty dict if none."""
+        return self._hostvars.get(hostname, {})
+
+    def get_hosts(self):
+        """Return a sorted list of all hosts in the inventory."""
+        return sorted(self._hosts)
+
+    def has_host(self, hostname):
+        """Return ``True`` if a given host exists in the inventory."""
+        return hostname in self._hosts
+
+    def get_group_hosts(self, name):
+        """Return a set of hosts of a given group including its children.
+
+        :param name: a group name
+        :type name: str
+
+        :returns: a set of hostnames, or ``None`` if there's no such group
+        """
+        if name not in self._groups:
+            return None
+
+        if name not in self._hosts_by_group:
+            hosts, visited, pending = set(), set(), [name]
+
+            while pending:
+                group = pending.pop()
+                if group in visited or group not in self._groups:
+                    continue
+                visited.add(group)
+
+                hosts.update(self._groups[group].get('hosts', []))
+                pending.extend(self._groups[group].get('children', []))
+
+            self._hosts_by_group[name] = frozenset(hosts)
+
+        return self._hosts_by_group[name]
+
+
+class MappedInventoryIndex(object):
+    """Read-only inventory index backed by memory mapped file.
+
+    It provides the same interface as :class:`InventoryIndex`, but only
+    variables listed in :data:`_INDEX_VARS` are available. Lookups are
+    binary searches over the file, so nothing but the mapping itself is
+    kept in memory, and the mapping is shared with other processes.
+
+    :param path: a path to index file built by :func:`build_index`
+    :type path: str
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.mtime, self.size, _, self._nhosts,
+         self._ngroups, nmembers) = _HEADER.unpack_from(self._mm, 0)
+
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('%s is not an inventory index' % path)
+
+        self._hosts = _HEADER.size
+        self._groups = self._hosts + self._nhosts * _HOST.size
+        self._members = self._groups + self._ngroups * _GROUP.size
+        self._strings = self._members + nmembers * _MEMBER.size
+
+    def close(self):
+        """Unmap the index file, so the index can't be used anymore."""
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_string(self, offset):
+        if offset == _NONE:
+            return None
+
+        offset += self._strings
+        length, = _LENGTH.unpack_from(self._mm, offset)
+        offset += _LENGTH.size
+        return self._mm[offset:offset + length].decode('utf-8')
+
+    def _get_host_name(self, number):
+        return self._get_string(_HOST.unpack_from(
+            self._mm, self._hosts + number * _HOST.size)[0])
+
+    def _find(self, table, record, count, name):
+        # Records are sorted by UTF-8 encoded name, and the name is the
+        # first field of each record.
+        name = name.encode('utf-8')
+        lo, hi = 0, count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            fields = record.unpack_from(self._mm, table + mid * record.size)
+            candidate = self._get_string(fields[0]).encode('utf-8')
+
+            if candidate == name:
+                return fields
+            elif candidate < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def get_host_vars(self, hostname):
+        """Return variables of a given host, or empty dict if none."""
+        host = self._find(self._hosts, _HOST, self._nhosts, hostname)
+        if host is None:
+            return {}
+
+        return dict(
+            (name, self._get_string(offset))
+            for name, offset in zip(_INDEX_VARS, host[1:])
+            if offset != _NONE
+        )
+
+    def get_hosts(self):
+        """Return a sorted list of all hosts in the inventory."""
+        return [self._get_host_name(i) for i in range(self._nhosts)]
+
+    def has_host(self, hostname):
+        """Return ``True`` if a given host exists in the inventory."""
+        return self._find(
+            self._hosts, _HOST, self._nhosts, hostname) is not None
+
+    def get_group_hosts(self, name):
+        """Return a set of hosts of a given group including its children.
+
+        :param name: a group name
+        :type name: str
+
+        :returns: a set of hostnames, or ``None`` if there's no such group
+        """
+        group = self._find(self._groups, _GROUP, self._ngroups, name)
+        if group is None:
+            return None
+
+        _, start, count = group
+        return frozenset(
+            self._get_host_name(_MEMBER.unpack_from(
+                self._mm, self._members + i * _MEMBER.size)[0])
+            for i in range(start, start + count)
+        )
+
+
+def _write_index(fp, data, mtime, size):
+    index = InventoryIndex(data)
+    strings, blob = {}, bytearray()
+
+    def add_string(value):
+        if value is None:
+            return _NONE
+        if value not in strings:
+            encoded = value.encode('utf-8')
+            strings[value] = len(blob)
+            blob.extend(_LENGTH.pack(len(encoded)) + encoded)
+        return strings[value]
+
+    def key(value):
+        return value.encode('utf-8')
+
+    groups = sorted(index._groups, key=key)
+    members = dict((name, index.get_group_hosts(name)) for name in groups)
+    hosts = sorted(index.get_hosts(), key=key)
+    numbers = dict((host, i) for i, host in enumerate(hosts))
+
+    records, offset = [], 0
+    for host in hosts:
+        variables = index.get_host_vars(host)
+        records.append(_HOST.pack(add_string(host), *[
+            add_string(variables.get(name)) for name in _INDEX_VARS
+        ]))
+
+    for name in groups:
+        records.append(_GROUP.pack(
+            add_string(name), offset, len(members[name])))
+        offset += len(members[name])
+
+    for name in groups:
+        records.extend(
+            _MEMBER.pack(number)
+            for number in sorted(numbers[host] for host in members[name]))
+
+    fp.write(_HEADER.pack(_MAGIC, _VERSION, mtime, size, len(blob),
+                          len(hosts), len(groups), offset))
+    fp.write(b''.join(records))
+    fp.write(bytes(blob))
+
+
+def build_index(path, index_path):
+    """Build mapped index file from a given inventory JSON file.
+
+    :param path: a path to inventory JSON
+    :type path: str
+
+    :param index_path: a path to index file to be written
+    :type index_path: str
+    """
+    stat = os.stat(path)
+    with open(path) as fp:
+        data = json.load(fp)
+
+    # Write to temporary file first and then rename it, so processes that
+    # have the previous index mapped keep using it, and new ones never
+    # see partially written index.
+    fd, temp = tempfile.mkstemp(
+        dir=os.path.dirname(index_path),
+        prefix='.' + os.path.basename(index_path))
+    with os.fdopen(fd, 'wb') as fp:
+        _write_index(fp, data, stat.st_mtime, stat.st_size)
+    os.rename(temp, index_path)
+
+
+def has_mapped_index():
+    """Return ``True`` if inventory indexes are memory mapped."""
+    return os.path.isdir(_INDEX_DIR)
+
+
+def _load_mapped(path):
+    stat = os.stat(path)
+    cached = _CACHE.get(path)
+
+    if cached is not None and cached[0] == (stat.st_mtime, stat.st_size):
+        metrics.inc('inventory_cache_hits_total')
+        return cached[1]
+
+    index_path = os.path.join(
+        _INDEX_DIR,
+        hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest())
+
+    with metrics.timed('inventory_load'), tracing.span('inventory_load'):
+        # Only one process rebuilds the index when inventory is changed,
+        # others wait for it and then map the new one.
+        with open(index_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                index = MappedInventoryIndex(index_path)
+            except (IOError, OSError) as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                index = None
+            except (ValueError, struct.error):
+                index = None
+
+            if index is None or (index.mtime, index.size) != (
+                    stat.st_mtime, stat.st_size):
+                if index is not None:
+                    index.close()
+                build_index(path, index_path)
+                index = MappedInventoryIndex(index_path)
+
+    # Workers live long and inventory is regenerated over and over again,
+    # so a stale mapping is released right away rather than whenever it's
+    # garbage collected.
+    if cached is not None:
+        cached[1].close()
+
+    _CACHE[path] = (stat.st_mtime, stat.st_size), index
+    return index
+
+
+def get_path(deploy=None):
+    """Return a path to inventory JSON of a given deployment.
+
+    :param deploy: a path to OpenStack Ansible deployment configuration,
+                   e.g. '/etc/openstack_deploy'; the default one is used
+                   if None
+    :type deploy: str
+    """
+    if deploy is None:
+        return _INVENTORY
+    return os.path.join(deploy, os.path.basename(_INVENTORY))
+
+
+def load(path=_INVENTORY):
+    """Load inventory index from a given inventory JSON file.
+
+    The index is cached in memory and reused until the file is modified,
+    so it's cheap to call this function on every task execution. If
+    :data:`_INDEX_DIR` exists, the index is built into a file there and
+    memory mapped instead, so it's shared between worker processes.
+
+    :param path: a path to inventory JSON
+    :type path: str
+
+    :rtype: :class:`InventoryIndex` or :class:`MappedInventoryIndex`
+    """
+    if has_mapped_index():
+        return _load_mapped(path)
+
+    mtime = os.path.getmtime(path)
+    cached = _CACHE.get(path)
+
+    if cached is None or cached[0] != mtime:
+        with metrics.timed('inventory_load'), tracing.span('inventory_load'):
+            with open(path) as fp:
+                cached = mtime, InventoryIndex(json.load(fp))
+        _CACHE[path] = cached
+    else:
+        metrics.inc('inventory_cache_hits_total')
+
+    return cached[1]
+
+
+def load_source(source, deploy=None):
+    """Load inventory index from a given Ansible inventory source.
+
+    Executable sources, like OpenStack Ansible dynamic inventory script,
+    are asked for the list of hosts the same way Ansible does, and their
+    output is never cached since it's produced anew on every call. Other
+    sources must be inventory JSON and are loaded by :func:`load`.
+
+    :param source: a path to inventory script or inventory JSON
+    :type source: str
+
+    :param deploy: a path to OpenStack Ansible deployment configuration
+                   the inventory script is executed against
+    :type deploy: str
+
+    :rtype: :class:`InventoryIndex` or :class:`MappedInventoryIndex`
+    """
+    if os.path.isdir(source) or not os.access(source, os.X_OK):
+        return load(source)
+
+    env = dict(os.environ)
+    if deploy is not None:
+        env['OSA_CONFIG_DIR'] = deploy
+
+    with metrics.timed('inventory_load'), tracing.span('inventory_load'):
+        output = subprocess.check_output([source, '--list'], env=env)
+    return InventoryIndex(json.loads(output.decode('utf-8')))
@@ -0,0 +1,232 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import functools
+import json
+import os
+import tempfile
+import time
+
+
+#: Node exporter's textfile collector reads metrics from '*.prom' files of
+#: this directory. Metrics are collected only if the directory exists, so
+#: they cost nothing unless node exporter is set up to read them.
+_TEXTFILE_DIR = os.path.join(
+    '/var', 'lib', 'node_exporter', 'textfile_collector')
+
+#: A name of metrics file within textfile collector directory.
+_TEXTFILE = 'kostyor_openstack_ansible.prom'
+
+#: Tasks are executed by multiple worker processes, and each of them
+#: updates the same metrics. So metrics are accumulated in this file and
+#: the textfile is rendered from it on each update.
+_STATE = os.path.join('/var', 'lib', 'kostyor-openstack-ansible', 'metrics')
+
+_PREFIX = 'kostyor_openstack_ansible_'
+
+#: Upper bounds of histogram buckets, in seconds. Driver operations take
+#: from milliseconds (limit resolution) to hours (playbooks).
+_BUCKETS = (0.01, 0.1, 1.0, 10.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+
+
+def _get_labels(labels):
+    return ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                                     .replace('"', r'\"')
+                                     .replace('\n', r'\n'))
+        for name, value in sorted(labels.items())
+    )
+
+
+def _get_sample(name, labels):
+    if labels:
+        return '%s%s{%s}' % (_PREFIX, name, labels)
+    return _PREFIX + name
+
+
+def _render(state):
+    lines = []
+
+    for name, samples in sorted(state['counters'].items()):
+        lines.append('# TYPE %s%s counter' % (_PREFIX, name))
+        for labels, value in sorted(samples.items()):
+            lines.append('%s %r' % (_get_sample(name, labels), value))
+
+    for name, samples in sorted(state['histograms'].items()):
+        lines.append('# TYPE %s%s histogram' % (_PREFIX, name))
+        for labels, sample in sorted(samples.items()):
+            separator = ',' if labels else ''
+
+            for bound, value in zip(_BUCKETS, sample['buckets']):
+                lines.append('%s %d' % (_get_sample(
+                    name + '_bucket',
+                    '%s%sle="%r"' % (labels, separator, bound)), value))
+            lines.append('%s %d' % (_get_sample(
+                name + '_bucket',
+                '%s%sle="+Inf"' % (labels, separator)), sample['count']))
+            lines.append('%s %r' % (
+                _get_sample(name + '_sum', labels), sample['sum']))
+            lines.append('%s %d' % (
+                _get_sample(name + '_count', labels), sample['count']))
+
+    return ''.join(line + '\n' for line in lines)
+
+
+def _write(path, content):
+    # Write to temporary file first and then rename it, so node exporter
+    # never sees partially written metrics. Temporary file doesn't have
+    # '.prom' suffix, so it's ignored by node exporter.
+    fd, temp = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(content)
+    os.rename(temp, path)
+
+
+def _update(*updates):
+    if not os.path.isdir(_TEXTFILE_DIR):
+        return
+
+    try:
+        try:
+            os.makedirs(os.path.dirname(_STATE))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        with open(_STATE + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                with open(_STATE + '.json') as fp:
+                    state = json.load(fp)
+            except (IOError, ValueError):
+                state = {'counters': {}, 'histograms': {}}
+
+            for update in updates:
+                update(state)
+
+            _write(_STATE + '.json', json.dumps(state))
+            _write(os.path.join(_TEXTFILE_DIR, _TEXTFILE), _render(state))
+
+    # Metrics are nice to have, but they must never break an upgrade.
+    except (IOError, OSError):
+        pass
+
+
+def _inc(name, value, labels):
+    def update(state):
+        samples = state['counters'].setdefault(name, {})
+        key = _get_labels(labels)
+        samples[key] = samples.get(key, 0) + value
+    return update
+
+
+def _observe(name, value, labels):
+    def update(state):
+        samples = state['histograms'].setdefault(name, {})
+        sample = samples.setdefault(_get_labels(labels), {
+            'buckets': [0] * len(_BUCKETS),
+            'sum': 0.0,
+            'count': 0,
+        })
+
+        for i, bound in enumerate(_BUCKETS):
+            if value <= bound:
+                sample['buckets'][i] += 1
+        sample['sum'] += value
+        sample['count'] += 1
+    return update
+
+
+def inc(name, value=1, **labels):
+    """Increase a counter by a given value.
+
+    :param name: a counter name without common prefix, e.g. 'hosts_total'
+    :type name: str
+
+    :param value: a value to add
+    :type value: int
+
+    :param labels: metric labels
+    :type labels: dict
+    """
+    if value:
+        _update(_inc(name, value, labels))
+
+
+def observe(name, value, **labels):
+    """Add an observation to a histogram.
+
+    :param name: a histogram name without common prefix
+    :type name: str
+
+    :param value: an observed value, in seconds
+    :type value: float
+
+    :param labels: metric labels
+    :type labels: dict
+    """
+    _update(_observe(name, value, labels))
+
+
+class timed(object):
+    """Context manager for measuring duration of an operation.
+
+    The duration is added to '<name>_duration_seconds' histogram, and
+    if the operation raises an exception, '<name>_failures_total' counter
+    is increased. It can be used as a function decorator as well.
+
+    Usage example:
+
+        with timed('playbook', playbook='os-nova-install.yml'):
+            _run_playbook(...)
+
+    :param name: an operation name
+    :type name: str
+
+    :param labels: metric labels
+    :type labels: dict
+    """
+
+    def __init__(self, name, **labels):
+        self._name = name
+        self._labels = labels
+        self._started = None
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def decorated(*args, **kwargs):
+            with timed(self._name, **self._labels):
+                return fn(*args, **kwargs)
+        return decorated
+
+    def __enter__(self):
+        self._started = time.time()
+
+    def __exit__(self, exc_type, *args):
+        updates = [
+            _observe(self._name + '_duration_seconds',
+                     time.time() - self._started,
+                     self._labels),
+        ]
+
+        if exc_type is not None:
+            updates.append(
+                _inc(self._name + '_failures_total', 1, self._labels))
+
+        _update(*updates)
@@ -0,0 +1,176 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+
+#: Spans of each trace are written to '<trace-id>.json' file of this
+#: directory. Tracing is enabled only if the directory exists.
+_TRACE_DIR = os.path.join('/var', 'lib', 'kostyor-openstack-ansible', 'traces')
+
+#: Spans opened by the current thread, from outermost to innermost.
+_local = threading.local()
+
+
+def _get_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _emit(trace_id, name, started, finished, args):
+    # Spans are written as Chrome trace events, so a trace can be opened
+    # in chrome://tracing or Perfetto as a flame chart. Both accept JSON
+    # array without closing bracket, so events of multiple processes can
+    # be simply appended to the same file.
+    event = json.dumps({
+        'name': name,
+        'cat': 'kostyor',
+        'ph': 'X',
+        'ts': int(started * 1000000),
+        'dur': int((finished - started) * 1000000),
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'args': args,
+    })
+
+    try:
+        fd = os.open(os.path.join(_TRACE_DIR, trace_id + '.json'),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            prefix = '[\n' if not os.fstat(fd).st_size else ''
+            os.write(fd, (prefix + event + ',\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    # Tracing is a debugging aid, and it must never break an upgrade.
+    except (IOError, OSError):
+        pass
+
+
+def new_context():
+    """Return a context to start a new trace from.
+
+    :returns: a context to be passed to :class:`span`, or ``None`` if
+              tracing is disabled
+    """
+    if not os.path.isdir(_TRACE_DIR):
+        return None
+    return {'trace_id': uuid.uuid4().hex}
+
+
+def get_context(default=None):
+    """Return a context of the current span to be passed to a task.
+
+    The context is a plain dict, so it can be passed to Celery task as
+    keyword argument. It also holds the time it's been created, so time
+    spent by the task in queue is traced too.
+
+    :param default: a context to return if there's no current span
+    :type default: dict
+
+    :returns: a context dict, or ``None`` if nothing is being traced
+    """
+    stack = _get_stack()
+    context = stack[-1] if stack else default
+
+    if context is None or not os.path.isdir(_TRACE_DIR):
+        return None
+    return dict(context, sent=time.time())
+
+
+class span(object):
+    """Context manager for tracing an operation.
+
+    A span is nested into the current span of the thread. If there's no
+    current span, e.g. in the beginning of Celery task, the span is
+    nested into a given context. If there's neither, nothing is traced.
+    It can be used as a function decorator as well, in that case the
+    context is taken from 'trace' keyword argument, if any.
+
+    Usage example:
+
+        with span('playbook', trace, playbook='os-nova-install.yml'):
+            _run_playbook(...)
+
+    :param name: an operation name
+    :type name: str
+
+    :param context: a context returned by :func:`get_context`
+    :type context: dict
+
+    :param args: additional details of the operation
+    :type args: dict
+    """
+
+    def __init__(self, name, context=None, **args):
+        self._name = name
+        self._context = context
+        self._args = args
+        self._span = None
+        self._started = None
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def decorated(*args, **kwargs):
+            context = kwargs.get('trace', self._context)
+            with span(self._name, context, **self._args):
+                return fn(*args, **kwargs)
+        return decorated
+
+    def __enter__(self):
+        stack = _get_stack()
+        parent = stack[-1] if stack else self._context
+
+        if parent is None or not os.path.isdir(_TRACE_DIR):
+            return
+
+        self._started = time.time()
+        self._span = {
+            'trace_id': parent['trace_id'],
+            'span_id': uuid.uuid4().hex[:16],
+        }
+
+        # Time between sending a task and starting it is otherwise
+        # invisible, so it's traced as a separate span.
+        if not stack and 'sent' in parent:
+            _emit(parent['trace_id'], 'queued', parent['sent'],
+                  self._started, {'parent_id': parent.get('span_id')})
+
+        self._args = dict(self._args, parent_id=parent.get('span_id'))
+        stack.append(self._span)
+
+    def __exit__(self, exc_type, *args):
+        if self._span is None:
+            return
+
+        # Nested spans left open, e.g. by failed playbook, are discarded
+        # so they don't become parents of unrelated spans.
+        stack = _get_stack()
+        if self._span in stack:
+            del stack[stack.index(self._span):]
+
+        if exc_type is not None:
+            self._args['error'] = exc_type.__name__
+
+        _emit(self._span['trace_id'], self._name, self._started, time.time(),
+              dict(self._args, span_id=self._span['span_id']))
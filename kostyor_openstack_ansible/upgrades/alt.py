@@ -13,49 +13,322 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from ansible.inventory import Inventory
-from ansible.parsing.dataloader import DataLoader
-from ansible.vars import VariableManager
+import os
+import tempfile
+import time
 
 from kostyor.rpc import tasks
 from kostyor.rpc.app import app
 
+from .. import adhoc, events, inventory, metrics, tracing
 from . import base
 
 
+#: A path to 'openstack-ansible' wrapper that runs playbooks with OpenStack
+#: Ansible settings. It's installed when bootstrapping Ansible.
+_OPENSTACK_ANSIBLE = os.path.join('/usr', 'local', 'bin', 'openstack-ansible')
+
+
+class _setenv(object):
+    """Context manager for temporally setting environment variables.
+
+    Some Ansible settings can't be passed via command line, so the only
+    way to pass them to 'openstack-ansible' is environment variables
+    inherited by the child process.
+
+    Usage example:
+
+        with _setenv(ANSIBLE_RETRY_FILES_ENABLED='True'):
+            _run_playbook(...)
+
+    :param variables: environment variables to be set
+    :type variables: dict
+    """
+
+    def __init__(self, **variables):
+        self._newenv = variables
+        self._oldenv = {}
+
+    def __enter__(self):
+        for name, value in self._newenv.items():
+            self._oldenv[name] = os.environ.get(name)
+            os.environ[name] = value
+
+    def __exit__(self, *args):
+        for name, value in self._oldenv.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _get_facts_env(facts):
+    # Fact gathering settings are regular Ansible configuration options,
+    # so they can be overridden via environment.
+    env = {}
+    if facts and facts.get('gather_subset'):
+        env['ANSIBLE_GATHER_SUBSET'] = facts['gather_subset']
+    if facts and facts.get('gather_timeout'):
+        env['ANSIBLE_GATHER_TIMEOUT'] = str(facts['gather_timeout'])
+    return env
+
+
+def _get_strategy_env(strategy):
+    # Ansible uses the configured strategy for plays that don't set their
+    # own, and looks up strategy plugins in additional directories too.
+    env = {}
+    strategy = base.get_strategy(strategy)
+    if strategy:
+        env['ANSIBLE_STRATEGY'] = strategy['name']
+    if strategy and strategy.get('plugins'):
+        env['ANSIBLE_STRATEGY_PLUGINS'] = os.pathsep.join(
+            path for path in [strategy['plugins'],
+                              os.environ.get('ANSIBLE_STRATEGY_PLUGINS')]
+            if path)
+    return env
+
+
+def _get_deployment_env(deployment):
+    # Both 'openstack-ansible' wrapper and OpenStack Ansible dynamic
+    # inventory look for deployment configuration in OSA_CONFIG_DIR, and
+    # the wrapper keeps ANSIBLE_INVENTORY if it's already set.
+    env = {}
+    if deployment and deployment.get('deploy'):
+        env['OSA_CONFIG_DIR'] = deployment['deploy']
+    if deployment and deployment.get('inventory'):
+        env['ANSIBLE_INVENTORY'] = deployment['inventory']
+    return env
+
+
+def _load_inventory(deployment):
+    # Limits must be resolved against the inventory Ansible is executed
+    # against, so a custom inventory source takes precedence over
+    # inventory JSON of the deployment (see '_get_deployment_env').
+    deployment = deployment or {}
+    if deployment.get('inventory'):
+        return inventory.load_source(
+            deployment['inventory'], deployment.get('deploy'))
+    return inventory.load(inventory.get_path(deployment.get('deploy')))
+
+
+def _get_summary(events_file, name):
+    summary = events.parse(events_file)
+    metrics.inc('playbook_failed_hosts_total',
+                len(events.get_failed_hosts(summary)), playbook=name)
+    return summary
+
+
+def _with_saved(summary, entry):
+    # Time saved by restricted fact gathering is reported per run.
+    if 'saved' in entry:
+        return dict(summary, saved=entry['saved'])
+    return summary
+
+
+def _quarantine(playbook, index, summary, limit):
+    # Failed hosts are known from playbook events only, so if there are
+    # none, the failure can't be attributed to particular nodes.
+    failed = events.get_failed_hosts(summary)
+    if limit is None or not failed:
+        return None
+
+    nodes = sorted(set(
+        index.get_host_vars(host).get('physical_host', host)
+        for host in failed))
+    if not base.quarantine(playbook, nodes, limit):
+        return None
+    return nodes
+
+
 @app.task(bind=True, base=tasks.execute.__class__)
-def _run_playbook(self, playbook, cwd=None, ignore_errors=False):
-    return super(_run_playbook.__class__, self).run(
-        [
-            '/usr/local/bin/openstack-ansible', playbook,
-        ],
-        cwd=cwd,
-        ignore_errors=ignore_errors,
-    )
+@tracing.span('_run_playbook')
+@base.cluster_state()
+def _run_playbook(self, playbook, cwd=None, ignore_errors=False, facts=None,
+                  strategy=None, limit=None, trace=None, deployment=None):
+    name = os.path.basename(playbook)
+    events_file = tempfile.NamedTemporaryFile('r', prefix='kostyor-events-')
+
+    env = dict(_get_deployment_env(deployment), **_get_facts_env(facts))
+    env.update(_get_strategy_env(strategy))
+    env.update(events.get_env(events_file.name))
+
+    # Just like in '_run_playbook_for', the limit is passed via file.
+    args = []
+    limit_file = tempfile.NamedTemporaryFile('w', prefix='kostyor-limit-')
+    if limit is not None:
+        limit_file.write('\n'.join(limit))
+        limit_file.flush()
+        args.extend(['-l', '@' + limit_file.name])
+
+    with _setenv(**env), limit_file, events_file:
+        started = time.time()
+        with metrics.timed('playbook', playbook=name):
+            super(_run_playbook.__class__, self).run(
+                [
+                    _OPENSTACK_ANSIBLE, playbook,
+                ] + args,
+                cwd=cwd,
+                ignore_errors=ignore_errors,
+            )
+        duration = time.time() - started
+        summary = _get_summary(events_file, name)
+
+    # These playbooks aren't limited to nodes, so they are measured on
+    # hosts they've reported results for. Only successful executions are
+    # representative.
+    if summary['hosts'] and not events.get_failed_hosts(summary):
+        index = _load_inventory(deployment)
+        entry = base.record_duration(
+            playbook,
+            len(set(index.get_host_vars(host).get('physical_host', host)
+                    for host in summary['hosts'])),
+            duration,
+            facts=facts)
+        summary = _with_saved(summary, entry)
+    return summary
 
 
 @app.task(bind=True, base=tasks.execute.__class__)
+@tracing.span('_run_playbook_for')
+@base.cluster_state()
 def _run_playbook_for(self, playbook, nodes, service, cwd=None,
-                      ignore_errors=False):
-    inventory = Inventory(DataLoader(), VariableManager())
-    hosts = [
-        host.get_vars()['inventory_hostname']
-        for host in base.get_component_hosts_on_nodes(
-            inventory, service, nodes
+                      ignore_errors=False, tags=None, skip_tags=None,
+                      release=None, batching=None, facts=None,
+                      strategy=None, quarantine=None, canary=False,
+                      trace=None, deployment=None):
+    # The whole point of this driver is to run Ansible out of process,
+    # so loading Ansible inventory here just to compute a limit is a waste
+    # of time and memory. Cached inventory JSON is enough for that.
+    index = _load_inventory(deployment)
+    deployment_env = _get_deployment_env(deployment)
+    strategy_env = _get_strategy_env(strategy)
+    name = os.path.basename(playbook)
+
+    scope = []
+    if tags:
+        scope.extend(['--tags', ','.join(tags)])
+    if skip_tags:
+        scope.extend(['--skip-tags', ','.join(skip_tags)])
+
+    def run(nodes):
+        if quarantine is not None:
+            nodes = base.exclude_quarantined(nodes, canary)
+            if not nodes:
+                return
+
+        hosts = base.get_component_hostnames_on_nodes(index, service, nodes)
+
+        # In case of retry we want to run the playbook only on hosts failed
+        # last time, and Ansible is asked to write them to a retry file that
+        # we look for. If errors are ignored, the task is never retried.
+        limit_hosts = hosts
+        retry_file = base.get_retry_file(playbook, limit_hosts, release)
+        if not ignore_errors:
+            hosts = base.pop_retry_hosts(playbook, hosts, release)
+
+        # Do not run the playbook on hosts that are already upgraded.
+        # A single ad-hoc run over all hosts is cheap in comparison to
+        # the playbook.
+        if release is not None and hosts:
+            with _setenv(**deployment_env):
+                results = adhoc.run(hosts, *base._VERSION_PROBE)
+            upgraded = base.get_upgraded_hosts(results, service, release)
+            hosts = [host for host in hosts if host not in upgraded]
+
+            if not hosts:
+                return
+
+        metrics.inc('playbook_hosts_total', len(hosts), playbook=name)
+
+        # Ansible output is meant for humans and may take megabytes, so
+        # results are summarized from events written by callback plugin.
+        events_file = tempfile.NamedTemporaryFile(
+            'r', prefix='kostyor-events-')
+
+        env = dict(deployment_env, **_get_facts_env(facts))
+        env.update(strategy_env)
+        env.update(events.get_env(events_file.name))
+        env = _setenv(
+            ANSIBLE_RETRY_FILES_ENABLED=str(not ignore_errors),
+            ANSIBLE_RETRY_FILES_SAVE_PATH=os.path.dirname(retry_file),
+            **env
         )
-    ]
 
-    return super(_run_playbook_for.__class__, self).run(
-        [
-            '/usr/local/bin/openstack-ansible', playbook,
-            '-l', ','.join(hosts)
-        ],
-        cwd=cwd,
-        ignore_errors=ignore_errors,
-    )
+        # The limit may contain hundreds of hosts, so passing it in command
+        # line may hit arguments length limit. Fortunately, Ansible supports
+        # reading the limit from file if it's prefixed with '@'.
+        limit = tempfile.NamedTemporaryFile('w', prefix='kostyor-limit-')
+
+        with limit, events_file:
+            limit.write('\n'.join(hosts))
+            limit.flush()
+
+            started = time.time()
+            try:
+                with env, metrics.timed('playbook', playbook=name):
+                    with tracing.span('playbook', playbook=name):
+                        super(_run_playbook_for.__class__, self).run(
+                            [
+                                _OPENSTACK_ANSIBLE, playbook,
+                                '-l', '@' + limit.name,
+                            ] + scope,
+                            cwd=cwd,
+                            ignore_errors=ignore_errors,
+                        )
+            except Exception:
+                summary = _get_summary(events_file, name)
+                quarantined = _quarantine(playbook, index, summary, quarantine)
+                if quarantined is None:
+                    raise
+
+                # The task is never retried, so the retry file written by
+                # Ansible must not narrow down the next execution.
+                base.discard_retry_hosts(playbook, limit_hosts, release)
+                return dict(summary, quarantined=quarantined)
+
+            summary = _get_summary(events_file, name)
+
+        # Durations of past executions help to choose batch sizes. Failed
+        # executions raise an exception, so they never get here unless
+        # errors are ignored.
+        entry = base.record_duration(
+            playbook,
+            len(set(index.get_host_vars(host).get('physical_host', host)
+                    for host in hosts)),
+            time.time() - started,
+            facts=facts)
+        return _with_saved(summary, entry)
+
+    if batching:
+        return base.run_in_batches(run, playbook, nodes, batching, facts)
+    return run(nodes)
+
+
+@app.task
+@metrics.timed('preflight')
+@tracing.span('_check_reachability')
+@base.cluster_state()
+def _check_reachability(forks=None, trace=None, deployment=None):
+    # Ad-hoc commands do not gather facts, so a ping is just a round trip
+    # to each host.
+    hosts = _load_inventory(deployment).get_hosts()
+
+    with _setenv(**_get_deployment_env(deployment)):
+        results = adhoc.run(hosts, 'ping', forks=forks)
+    base.check_reachability(results, hosts)
+
+
+@app.task(bind=True)
+@tracing.span('_pre_stage')
+def _pre_stage(self, batch=None, trace=None, deployment=None, **kwargs):
+    hosts = _load_inventory(deployment).get_hosts()
+    return self.replace(base.pre_stage(
+        _run_playbook, hosts, batch, deployment, trace=trace, **kwargs))
 
 
 class Driver(base.Driver):
 
     _run_playbook = _run_playbook
     _run_playbook_for = _run_playbook_for
+    _check_reachability = _check_reachability
+    _pre_stage = _pre_stage
@@ -15,12 +15,65 @@
 
 import os
 import copy
+import collections
+import errno
+import fcntl
+import functools
+import hashlib
+import json
+import math
+import shutil
+import tempfile
+import threading
+import time
 
 import celery
 
 from kostyor.rpc import tasks
+from kostyor.rpc.app import app
 from kostyor.upgrades.drivers import base
 
+from .. import metrics, tracing
+
+
+#: Ansible module and its arguments to gather local facts only. Nothing
+#: but local facts is needed to check installed version of a service, so
+#: there's no need to pay for full facts gathering.
+_VERSION_PROBE = 'setup', 'filter=ansible_local gather_subset=!all'
+
+#: A directory where the driver keeps its state between task executions,
+#: e.g. hosts to be retried. Tasks are executed by Celery worker on
+#: deployment host, so the directory is local to the deployment host.
+#: State of each cluster but the default one is kept in its own
+#: subdirectory, see :class:`cluster_state`.
+_STATE_DIR = os.path.join('/var', 'lib', 'kostyor-openstack-ansible')
+
+#: A cluster whose state is accessed by the current thread.
+_local = threading.local()
+
+
+#: A playbook that prefetches artifacts of the target release to hosts and
+#: containers, see :meth:`Driver.pre_stage`.
+_PRESTAGE_PLAYBOOK = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'playbooks', 'prestage.yml')
+
+#: Retry files older than this, in seconds, are ignored. A failed task is
+#: usually retried soon, while an older file is likely left by a failure
+#: nobody has retried, and it must not narrow down unrelated executions.
+_RETRY_TTL = 24 * 60 * 60
+
+#: A number of playbook durations to keep in history per playbook. Old
+#: measurements are dropped, since they may not reflect current state.
+_HISTORY_SIZE = 100
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
 
 def _get_component_from_service(service):
     # OpenStack services has the following naming format: '{component}-*',
@@ -28,7 +81,24 @@ def _get_component_from_service(service):
     return service['name'].split('-')[0]
 
 
-def get_component_hosts_on_nodes(inventory, service, nodes):
+def get_component_hosts_on_nodes(inventory, service, nodes, index=None):
+    # Looking up hosts in inventory index is way cheaper than walking
+    # through Ansible groups, so the index is preferred when given. Ansible
+    # hosts are still returned since they are what the caller needs. Both
+    # ways are instrumented, so this function is not.
+    if index is not None:
+        hosts = [
+            inventory.get_host(name)
+            for name in get_component_hostnames_on_nodes(index, service, nodes)
+        ]
+        return [host for host in hosts if host is not None]
+
+    return _get_component_hosts_on_nodes(inventory, service, nodes)
+
+
+@metrics.timed('limit_resolution')
+@tracing.span('limit_resolution')
+def _get_component_hosts_on_nodes(inventory, service, nodes):
     component = _get_component_from_service(service)
     rv = []
 
@@ -56,9 +126,812 @@ def get_component_hosts_on_nodes(inventory, service, nodes):
             set(inventory.get_group(component + '_all').get_hosts())
         ))
 
+    metrics.inc('limit_hosts_total', len(rv), component=component)
+    return rv
+
+
+@metrics.timed('limit_resolution')
+@tracing.span('limit_resolution')
+def get_component_hostnames_on_nodes(index, service, nodes):
+    """The same as :func:`get_component_hosts_on_nodes` but for inventory
+    index, so it can be used without loading Ansible.
+
+    :param index: an inventory index to look up hosts in
+    :type index: :class:`kostyor_openstack_ansible.inventory.InventoryIndex`
+
+    :returns: a list of inventory hostnames
+    """
+    component = _get_component_from_service(service)
+    component_hosts = index.get_group_hosts(component + '_all') or set()
+    rv = []
+
+    for node in nodes:
+        variables = index.get_host_vars(node['hostname'])
+        containers = index.get_group_hosts(variables['container_types'])
+
+        candidates = set(containers or [])
+        if index.has_host(node['hostname']):
+            candidates.add(node['hostname'])
+
+        rv.extend(sorted(candidates & component_hosts))
+
+    metrics.inc('limit_hosts_total', len(rv), component=component)
+    return rv
+
+
+def get_upgraded_hosts(results, service, release):
+    """Return hosts where a given service already runs a given release.
+
+    OpenStack Ansible roles save a tag of installed service's virtualenv
+    to Ansible local facts, and the tag equals to OpenStack Ansible
+    release by default. So it's enough to gather local facts to find out
+    which hosts have been already upgraded.
+
+    :param results: results of version probe, see :data:`_VERSION_PROBE`
+    :type results: {str: :class:`kostyor_openstack_ansible.adhoc.AdHocResult`}
+
+    :param service: a service to check
+    :type service: dict
+
+    :param release: OpenStack Ansible release, e.g. '14.2.0'
+    :type release: str
+
+    :returns: a set of inventory hostnames
+    """
+    component = _get_component_from_service(service)
+    rv = set()
+
+    for hostname, result in results.items():
+        facts = result.result.get('ansible_facts', {})
+        local = facts.get('ansible_local', {}).get('openstack_ansible', {})
+
+        if local.get(component, {}).get('venv_tag') == release:
+            rv.add(hostname)
+    return rv
+
+
+def _get_window_size(size, total):
+    if str(size).endswith('%'):
+        size = int(math.ceil(total * float(str(size)[:-1]) / 100))
+    return max(int(size), 1)
+
+
+def get_windows(hosts, window):
+    """Split hosts into rolling upgrade windows.
+
+    A window is a number of hosts to be upgraded at once, and it may be
+    defined in the following ways:
+
+    * ``None`` -- all hosts at once;
+    * ``10`` -- ten hosts at once;
+    * ``'10%'`` -- ten percent of hosts at once;
+    * ``(1, 'availability_zone')`` -- one host of each group at once, where
+      hosts are grouped by a value of a given host's key. The size may be
+      in percents as well, then it's relative to the group.
+
+    :param hosts: hosts to be split
+    :type hosts: [dict]
+
+    :param window: a window definition
+    :type window: None, int, str or tuple
+
+    :returns: a list of windows, each window is a list of hosts
+    """
+    if window is None:
+        return [hosts]
+
+    size, key = window if isinstance(window, tuple) else (window, None)
+
+    groups = collections.OrderedDict()
+    for host in hosts:
+        groups.setdefault(host.get(key) if key else None, []).append(host)
+
+    rv = []
+    for group in groups.values():
+        step = _get_window_size(size, len(group))
+
+        for i, offset in enumerate(range(0, len(group), step)):
+            if len(rv) <= i:
+                rv.append([])
+            rv[i].extend(group[offset:offset + step])
+
+    return rv
+
+
+def get_stages(plan, dependencies):
+    """Split upgrade plan into stages of independent steps.
+
+    Steps of the same stage do not depend on each other and hence may be
+    executed concurrently, while stages must be executed one after
+    another. Dependencies may refer to either services or components,
+    in the latter case a step depends on all steps of the component.
+
+    :param plan: a list of steps, where each step is a pair of service
+                 and hosts to upgrade the service on
+    :type plan: [(dict, [dict])]
+
+    :param dependencies: service or component to a list of services and
+                         components it depends on
+    :type dependencies: {str: [str]}
+
+    :returns: a list of stages, each stage is a list of steps
+    """
+    def depends_on(step, other):
+        name = step[0]['name']
+        component = _get_component_from_service(step[0])
+        other_name = other[0]['name']
+        other_component = _get_component_from_service(other[0])
+
+        for dependency in dependencies.get(name, []) + (
+                dependencies.get(component, []) if component != name else []):
+            if dependency == other_name:
+                return True
+            if dependency == other_component != component:
+                return True
+        return False
+
+    pending = list(range(len(plan)))
+    requires = dict(
+        (i, set(j for j in pending if i != j and depends_on(plan[i], plan[j])))
+        for i in pending
+    )
+
+    rv = []
+    while pending:
+        stage = [i for i in pending if not requires[i]]
+        if not stage:
+            raise ValueError(
+                'Services have circular dependencies: %s' % ', '.join(
+                    sorted(set(plan[i][0]['name'] for i in pending))))
+
+        for i in stage:
+            pending.remove(i)
+        for i in pending:
+            requires[i].difference_update(stage)
+
+        rv.append([plan[i] for i in stage])
     return rv
 
 
+def _get_state_dir():
+    cluster = getattr(_local, 'cluster', None)
+    if cluster is None:
+        return _STATE_DIR
+    return os.path.join(_STATE_DIR, 'clusters', str(cluster))
+
+
+class cluster_state(object):
+    """Context manager for accessing driver state of a given cluster.
+
+    Different clusters may have hosts with the same names, e.g. 'infra1',
+    so retry files, quarantine and history of one cluster must not be
+    seen by another. Within the context, all driver state is read from
+    and written to the directory of the cluster. It can be used as a
+    function decorator as well, in that case the cluster is taken from
+    'deployment' keyword argument, if any.
+
+    Usage example:
+
+        with cluster_state(deployment['cluster']):
+            hosts = pop_retry_hosts(...)
+
+    :param cluster: a cluster id, or ``None`` for the default cluster
+    :type cluster: str
+    """
+
+    def __init__(self, cluster=None):
+        self._cluster = cluster
+        self._previous = None
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def decorated(*args, **kwargs):
+            deployment = kwargs.get('deployment') or {}
+            with cluster_state(deployment.get('cluster', self._cluster)):
+                return fn(*args, **kwargs)
+        return decorated
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'cluster', None)
+        _local.cluster = self._cluster
+
+    def __exit__(self, *args):
+        _local.cluster = self._previous
+
+
+def _get_retry_dir(release=None):
+    # Retry files of each release are kept apart, so they can be purged
+    # without touching ones of upgrades to other releases.
+    return os.path.join(_get_state_dir(), 'retry', release or 'default')
+
+
+def get_retry_file(playbook, hosts, release=None):
+    """Return a path to retry file of playbook execution on given hosts.
+
+    The file has the same format Ansible uses for its own retry files, and
+    it's named the same way, so Ansible may be asked to write it directly.
+    In order to distinguish executions of the same playbook on different
+    hosts, or during upgrades to different releases, each limit and
+    release has its own directory.
+
+    :param playbook: a path to playbook
+    :type playbook: str
+
+    :param hosts: inventory hostnames the playbook is limited to
+    :type hosts: [str]
+
+    :param release: OpenStack Ansible release the playbook upgrades to
+    :type release: str
+    """
+    limit = '\n'.join(sorted(hosts))
+
+    return os.path.join(
+        _get_retry_dir(release),
+        hashlib.sha1(limit.encode('utf-8')).hexdigest(),
+        os.path.splitext(os.path.basename(playbook))[0] + '.retry',
+    )
+
+
+def pop_retry_hosts(playbook, hosts, release=None):
+    """Narrow hosts to ones failed during previous playbook execution.
+
+    When Kostyor retries a failed task, it makes no sense to run the
+    playbook on hosts where it has already succeeded. So if the previous
+    execution of the same playbook on the same hosts left a retry file,
+    the limit is narrowed to failed and unreachable hosts only. The retry
+    file is removed, so the next failure must produce a new one. Files
+    older than :data:`_RETRY_TTL` are removed without narrowing anything.
+
+    :param playbook: a path to playbook
+    :type playbook: str
+
+    :param hosts: inventory hostnames the playbook is limited to
+    :type hosts: [str]
+
+    :param release: OpenStack Ansible release the playbook upgrades to
+    :type release: str
+
+    :returns: a list of inventory hostnames to run the playbook on
+    """
+    retry_file = get_retry_file(playbook, hosts, release)
+
+    try:
+        with open(retry_file) as fp:
+            failed = set(line.strip() for line in fp if line.strip())
+        expired = time.time() - os.path.getmtime(retry_file) > _RETRY_TTL
+    except (IOError, OSError) as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return hosts
+
+    os.remove(retry_file)
+
+    if expired:
+        return hosts
+
+    # Inventory might be changed since then, so let's consider only hosts
+    # that are still in the limit.
+    return [host for host in hosts if host in failed] or hosts
+
+
+def save_retry_hosts(playbook, hosts, failed, release=None):
+    """Save failed hosts of playbook execution to its retry file.
+
+    :param playbook: a path to playbook
+    :type playbook: str
+
+    :param hosts: inventory hostnames the playbook is limited to
+    :type hosts: [str]
+
+    :param failed: inventory hostnames the playbook is failed on
+    :type failed: [str]
+
+    :param release: OpenStack Ansible release the playbook upgrades to
+    :type release: str
+    """
+    retry_file = get_retry_file(playbook, hosts, release)
+    _makedirs(os.path.dirname(retry_file))
+
+    with open(retry_file, 'w') as fp:
+        fp.write(''.join(host + '\n' for host in sorted(failed)))
+
+
+def discard_retry_hosts(playbook, hosts, release=None):
+    """Remove retry file of playbook execution on given hosts, if any.
+
+    A task that has succeeded despite failed hosts, e.g. because they are
+    quarantined, is never retried, so its retry file must not narrow down
+    the next execution of the playbook on the same hosts.
+
+    :param playbook: a path to playbook
+    :type playbook: str
+
+    :param hosts: inventory hostnames the playbook is limited to
+    :type hosts: [str]
+
+    :param release: OpenStack Ansible release the playbook upgrades to
+    :type release: str
+    """
+    try:
+        os.remove(get_retry_file(playbook, hosts, release))
+    except (IOError, OSError) as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def purge_retry_hosts(release=None):
+    """Remove retry files of a given release.
+
+    An upgrade starts from scratch, but retry files of upgrades to other
+    releases, as well as of other clusters, are kept.
+
+    :param release: OpenStack Ansible release the upgrade is to
+    :type release: str
+    """
+    shutil.rmtree(_get_retry_dir(release), ignore_errors=True)
+
+
+@app.task
+@cluster_state()
+def _purge_retry_hosts(release=None, deployment=None):
+    purge_retry_hosts(release)
+
+
+class _locked(object):
+    """Context manager for exclusive access to driver state files.
+
+    Tasks may be executed by multiple worker processes at once, so read
+    and write of shared state must be serialized.
+
+    :param name: a name of lock file within state directory
+    :type name: str
+    """
+
+    def __init__(self, name):
+        self._path = os.path.join(_get_state_dir(), name + '.lock')
+        self._fp = None
+
+    def __enter__(self):
+        _makedirs(os.path.dirname(self._path))
+        self._fp = open(self._path, 'a')
+        fcntl.flock(self._fp, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self._fp, fcntl.LOCK_UN)
+        self._fp.close()
+
+
+def _read_state(name, default):
+    try:
+        with open(os.path.join(_get_state_dir(), name + '.json')) as fp:
+            return json.load(fp)
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        pass
+    return default
+
+
+def _write_state(name, state):
+    # Write to temporary file first and then rename it, so readers never
+    # see partially written state.
+    state_dir = _get_state_dir()
+    fd, path = tempfile.mkstemp(dir=state_dir, prefix=name + '.')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(state, fp)
+    os.rename(path, os.path.join(state_dir, name + '.json'))
+
+
+def record_duration(playbook, nodes, duration, facts=None):
+    """Save duration of successful playbook execution to history.
+
+    If the playbook is executed with restricted fact gathering, time saved
+    in comparison to past executions with full fact gathering is estimated
+    and saved along.
+
+    :param playbook: a path to playbook
+    :type playbook: str
+
+    :param nodes: a number of physical nodes the playbook is executed on
+    :type nodes: int
+
+    :param duration: execution time in seconds
+    :type duration: float
+
+    :param facts: fact gathering profile the playbook is executed with
+    :type facts: dict
+
+    :returns: a saved history entry
+    """
+    name = os.path.basename(playbook)
+    entry = {'nodes': nodes, 'duration': duration}
+
+    if facts:
+        entry['facts'] = facts
+
+        full = get_node_duration(playbook)
+        if full is not None:
+            entry['saved'] = max(full * nodes - duration, 0.0)
+
+    with _locked('history'):
+        history = _read_state('history', {})
+        history[name] = (history.get(name, []) + [entry])[-_HISTORY_SIZE:]
+        _write_state('history', history)
+
+    return entry
+
+
+def get_durations(playbook):
+    """Return durations of past executions of a given playbook.
+
+    :param playbook: a path or a name of playbook
+    :type playbook: str
+
+    :returns: a list of dicts with 'nodes' and 'duration' keys, from
+              oldest to newest
+    """
+    return _read_state('history', {}).get(os.path.basename(playbook), [])
+
+
+def get_node_duration(playbook, facts=None):
+    """Return median execution time of a given playbook per node.
+
+    Only executions with the same fact gathering profile are taken into
+    account, since fact gathering is a noticeable part of execution time.
+
+    :returns: seconds per node, or ``None`` if there's no history
+    """
+    durations = sorted(
+        item['duration'] / item['nodes']
+        for item in get_durations(playbook)
+        if item['nodes'] and item.get('facts') == (facts or None)
+    )
+
+    if not durations:
+        return None
+    return durations[len(durations) // 2]
+
+
+def get_batch_size(batching, node_duration, previous=None):
+    """Return a number of nodes to upgrade in the next batch.
+
+    The size is chosen so the batch takes 'target' seconds if nodes are
+    upgraded as fast as before, but it's kept within 'min' and 'max'
+    bounds. In order to not to overshoot due to measurement noise, batch
+    size is at most doubled from batch to batch.
+
+    :param batching: batching policy with 'target', 'min' and 'max' keys
+    :type batching: dict
+
+    :param node_duration: observed upgrade time of one node in seconds
+    :type node_duration: float or None
+
+    :param previous: size of the previous batch if any
+    :type previous: int
+    """
+    if node_duration is None:
+        size = batching['min']
+    elif node_duration <= 0:
+        size = batching['max']
+    else:
+        size = int(batching['target'] // node_duration)
+
+    if previous is not None:
+        size = min(size, previous * 2)
+    return max(batching['min'], min(batching['max'], size))
+
+
+def run_in_batches(run, playbook, nodes, batching, facts=None):
+    """Run playbook on nodes in batches of adaptive size.
+
+    Each batch is executed by 'run' callable, and its duration is used to
+    choose the size of the next batch, see :func:`get_batch_size`. The
+    first batch size is based on durations of past executions of the same
+    playbook, if any.
+
+    :param run: a callable that runs the playbook on given nodes
+    :type run: callable
+
+    :param playbook: a path to playbook
+    :type playbook: str
+
+    :param nodes: nodes to run the playbook on
+    :type nodes: [dict]
+
+    :param batching: batching policy with 'target', 'min' and 'max' keys
+    :type batching: dict
+
+    :param facts: fact gathering profile the playbook is executed with
+    :type facts: dict
+
+    :returns: a dict with measurements and decisions for each batch
+    """
+    size = get_batch_size(batching, get_node_duration(playbook, facts))
+    batches = []
+
+    while len(nodes) > sum(batch['size'] for batch in batches):
+        offset = sum(batch['size'] for batch in batches)
+        batch = nodes[offset:offset + size]
+
+        started = time.time()
+        result = run(batch)
+        duration = time.time() - started
+
+        size = get_batch_size(batching, duration / len(batch), len(batch))
+        batches.append({
+            'nodes': [node['hostname'] for node in batch],
+            'size': len(batch),
+            'duration': duration,
+            'result': result,
+            'next_size': size,
+        })
+
+    return {'batches': batches}
+
+
+def pre_stage(run_playbook, hosts, batch, deployment, **kwargs):
+    """Return a group of prefetch playbook executions in batches of hosts.
+
+    Hosts are enumerated by a driver task on the deployment host, since
+    inventory is available there only, and the task is replaced by the
+    group, so it's finished only when all batches are. Batches are
+    executed in parallel, as many at once as there are free worker slots.
+
+    :param run_playbook: a driver task to run a playbook with
+    :type run_playbook: :class:`celery.Task`
+
+    :param hosts: hostnames to prefetch artifacts to
+    :type hosts: [str]
+
+    :param batch: a number of hosts to prefetch by one playbook execution
+    :type batch: int
+
+    :param deployment: a deployment the playbook is executed against
+    :type deployment: dict
+
+    :param kwargs: other arguments passed to ``run_playbook``
+    :type kwargs: dict
+    """
+    if not hosts:
+        return tasks.noop.si()
+
+    return celery.group(*[
+        run_playbook.si(
+            _PRESTAGE_PLAYBOOK,
+            cwd=os.path.join(deployment['root'], 'playbooks'),
+            ignore_errors=True,
+            limit=hosts[i:i + batch],
+            deployment=deployment,
+            **kwargs)
+        for i in range(0, len(hosts), batch)
+    ])
+
+
+def check_reachability(results, hosts):
+    """Ensure all hosts have responded to pre-flight ping.
+
+    Response time of responded hosts is saved to driver state, so slow
+    hosts can be spotted afterwards (see :func:`get_response_times`).
+
+    :param results: a dict of hostname to
+                    :class:`kostyor_openstack_ansible.adhoc.AdHocResult`
+    :type results: dict
+
+    :param hosts: hostnames that were pinged
+    :type hosts: [str]
+
+    :raises Exception: if some hosts are unreachable
+    """
+    response_times = dict(
+        (hostname, result.elapsed) for hostname, result in results.items()
+        if not result.result.get('unreachable')
+    )
+
+    with _locked('response_time'):
+        _write_state('response_time', response_times)
+
+    unreachable = sorted(
+        hostname for hostname in hosts
+        if hostname not in results
+        or results[hostname].result.get('unreachable')
+        or results[hostname].result.get('failed')
+    )
+
+    if unreachable:
+        raise Exception('Hosts are unreachable: %s' % ', '.join(unreachable))
+
+
+def get_response_times():
+    """Return response times measured by the last pre-flight check.
+
+    It's not a connection latency: Ansible reports no per-host start
+    time, so the time is counted from the start of the check till the
+    host's result. It includes Ansible startup and, if there are more
+    hosts than forks, waiting for a free fork. Hosts are still comparable
+    to each other as long as the check uses enough forks.
+
+    :returns: a dict of hostname to seconds
+    """
+    return _read_state('response_time', {})
+
+
+def quarantine(playbook, nodes, limit):
+    """Put nodes a playbook has failed on into quarantine.
+
+    In quarantine mode a few failed nodes do not stop the upgrade. They
+    are recorded in driver state instead, excluded from subsequent steps
+    (see :func:`exclude_quarantined`) and reported at the end, so the
+    operator can fix them afterwards.
+
+    :param playbook: a path to playbook
+    :type playbook: str
+
+    :param nodes: hostnames of physical nodes the playbook has failed on
+    :type nodes: [str]
+
+    :param limit: a maximum number of nodes in quarantine
+    :type limit: int
+
+    :returns: ``True`` if nodes are quarantined, or ``False`` if the limit
+              would be exceeded, in which case nothing is recorded
+    """
+    with _locked('quarantine'):
+        state = _read_state('quarantine', {})
+        quarantined = dict(state)
+
+        for node in nodes:
+            quarantined.setdefault(node, {
+                'playbook': os.path.basename(playbook),
+                'time': time.time(),
+            })
+
+        if len(quarantined) > limit:
+            return False
+        _write_state('quarantine', quarantined)
+
+    metrics.inc('quarantined_nodes_total', len(quarantined) - len(state))
+    return True
+
+
+def get_quarantined():
+    """Return nodes in quarantine.
+
+    :returns: a dict of node hostname to a dict with 'playbook' the node
+              has failed on and 'time' it has been quarantined at
+    """
+    return _read_state('quarantine', {})
+
+
+def exclude_quarantined(nodes, canary=False):
+    """Return nodes that are not in quarantine.
+
+    :param nodes: Kostyor hosts
+    :type nodes: [dict]
+
+    :param canary: whether nodes are canaries; skipping a canary would
+                   upgrade the rest of hosts with nothing verified, so
+                   it's an error for canaries to be in quarantine
+    :type canary: bool
+
+    :raises Exception: if some canaries are in quarantine
+    """
+    quarantined = get_quarantined()
+
+    if canary and any(node['hostname'] in quarantined for node in nodes):
+        raise Exception('Canary nodes are quarantined: %s' % ', '.join(
+            sorted(node['hostname'] for node in nodes
+                   if node['hostname'] in quarantined)))
+
+    return [node for node in nodes if node['hostname'] not in quarantined]
+
+
+def release_quarantined(nodes=None):
+    """Release nodes from quarantine once they are fixed.
+
+    :param nodes: node hostnames to release, or ``None`` to release all
+    :type nodes: [str]
+    """
+    with _locked('quarantine'):
+        quarantined = _read_state('quarantine', {})
+
+        for node in list(quarantined if nodes is None else nodes):
+            quarantined.pop(node, None)
+        _write_state('quarantine', quarantined)
+
+
+@app.task
+@cluster_state()
+def _release_quarantined(nodes=None, deployment=None):
+    release_quarantined(nodes)
+
+
+@app.task
+@cluster_state()
+def _report_quarantined(deployment=None):
+    return get_quarantined()
+
+
+def estimate(stages):
+    """Predict how long it takes to execute given upgrade stages.
+
+    Each playbook is assumed to take the same time per node as it did in
+    the median past execution (see :func:`record_duration`). Steps with a
+    playbook that has no history are reported as unknown and do not
+    contribute to totals.
+
+    :param stages: a list of stages, each a list of steps with 'service',
+                   'playbook', 'nodes' and 'runs' keys, where 'runs' is
+                   a list of playbook, its fact gathering profile and
+                   a number of nodes it's executed on
+    :type stages: [[dict]]
+
+    :returns: a dict with estimated ``steps`` and ``stages``, ``total``
+              time it takes to upgrade services one by one, and
+              ``critical_path`` time it takes when independent services
+              are upgraded concurrently (see :meth:`Driver.schedule`)
+    """
+    estimation = {'steps': [], 'stages': [], 'unknown': []}
+
+    for stage in stages:
+        durations = [0.0]
+
+        for step in stage:
+            duration = 0.0
+            for playbook, facts, nodes in step['runs']:
+                node_duration = get_node_duration(playbook, facts)
+                if node_duration is None:
+                    estimation['unknown'].append(step['service'])
+                    duration = None
+                    break
+                duration += node_duration * nodes
+
+            estimation['steps'].append({
+                'service': step['service'],
+                'playbook': step['playbook'],
+                'nodes': step['nodes'],
+                'duration': duration,
+            })
+            durations.append(duration or 0.0)
+
+        estimation['stages'].append(max(durations))
+
+    estimation['total'] = sum(
+        step['duration'] or 0.0 for step in estimation['steps'])
+    estimation['critical_path'] = sum(estimation['stages'])
+    return estimation
+
+
+@app.task
+@cluster_state()
+def _estimate(stages, deployment=None):
+    return estimate(stages)
+
+
+def get_strategy(strategy):
+    """Return strategy settings if the strategy plugin is available.
+
+    Accelerated strategies, e.g. Mitogen, are third-party plugins that
+    may be missing on a worker, so playbooks fall back to the strategy
+    configured for Ansible instead of failing.
+
+    :param strategy: strategy settings with 'name' and, for third-party
+                     plugins, 'plugins' keys
+    :type strategy: dict
+
+    :returns: the same settings, or ``None`` to use default strategy
+    """
+    if not strategy:
+        return None
+
+    plugins = strategy.get('plugins')
+    if plugins and not os.path.exists(
+            os.path.join(plugins, strategy['name'] + '.py')):
+        metrics.inc('strategy_fallbacks_total', strategy=strategy['name'])
+        return None
+    return strategy
+
+
 class Driver(base.UpgradeDriver):
     """Upgrade driver implementation for OpenStack Ansible.
 
@@ -128,15 +1001,198 @@ class Driver(base.UpgradeDriver):
         'horizon-wsgi':              'os-horizon-install.yml',
     }
 
-    # A path to OpenStack Ansible sources.
-    #
-    # TODO: to be configurable
+    #: Since the very same playbook is used for all service's subservices,
+    #: running it for one subservice executes role tasks of others too. Most
+    #: of them are skipped after host matching, but it still takes time.
+    #: These tables allow to scope playbook execution to a slice of role
+    #: by passing '--tags' and '--skip-tags' to Ansible. If a subservice
+    #: is not in a table, the playbook is executed as a whole.
+    #:
+    #: Please note, '--tags' executes only tagged tasks, so it must be used
+    #: with care. Unknown tags in '--skip-tags' are ignored by Ansible, so
+    #: tags that exist only in some OpenStack Ansible releases are fine.
+    _tags = {}
+
+    _skip_tags = {
+        'nova-compute':              ['nova-db-setup', 'nova-service-add'],
+
+        'neutron-openvswitch-agent': ['neutron-db-setup',
+                                      'neutron-service-add'],
+        'neutron-linuxbridge-agent': ['neutron-db-setup',
+                                      'neutron-service-add'],
+        'neutron-sriov-nic-agent':   ['neutron-db-setup',
+                                      'neutron-service-add'],
+
+        'cinder-volume':             ['cinder-db-setup', 'cinder-service-add'],
+    }
+
+    #: By default, all hosts passed to '.start()' are upgraded at once, which
+    #: is either too risky for services like L3 agents or too slow if one
+    #: has to pass hosts one by one. Rolling windows limit how many nodes of
+    #: a service are upgraded at once, see :func:`get_windows` for possible
+    #: values. Windows are executed one after another, and the next window
+    #: is not started if the previous one is failed.
+    #:
+    #: Control plane may be upgraded one node per availability zone at once
+    #: by using ``(1, 'availability_zone')`` window, as long as Kostyor's
+    #: hosts carry that key.
+    _windows = {
+        'nova-compute':              '10%',
+        'neutron-l3-agent':          1,
+    }
+
+    #: Upgrade ordering constraints between services. Keys and values
+    #: may be either services or components, e.g. 'nova-compute' or
+    #: 'nova'. Services without constraints between each other are upgraded
+    #: concurrently by :meth:`schedule`.
+    #:
+    #: The dict has the following format:
+    #:
+    #:   service-or-component -> [service-or-component, ...]
+    _dependencies = {
+        'glance':                    ['keystone'],
+        'nova':                      ['keystone'],
+        'neutron':                   ['keystone'],
+        'cinder':                    ['keystone'],
+        'heat':                      ['keystone'],
+        'horizon':                   ['keystone'],
+
+        'nova-compute':              ['nova-conductor'],
+
+        'neutron-openvswitch-agent': ['neutron-server'],
+        'neutron-linuxbridge-agent': ['neutron-server'],
+        'neutron-sriov-nic-agent':   ['neutron-server'],
+        'neutron-l3-agent':          ['neutron-server'],
+        'neutron-dhcp-agent':        ['neutron-server'],
+        'neutron-metering-agent':    ['neutron-server'],
+        'neutron-metadata-agent':    ['neutron-server'],
+
+        'cinder-volume':             ['cinder-api', 'cinder-scheduler'],
+    }
+
+    #: Services to be upgraded in batches of adaptive size. Instead of
+    #: fixed windows, hosts are upgraded batch by batch by a single task,
+    #: and the size of each batch is chosen to take about 'target' seconds
+    #: based on durations of previous batches and past executions of the
+    #: same playbook, but within 'min' and 'max' bounds. Sizes and
+    #: durations of batches are returned in the task result.
+    #:
+    #: The dict has the following format:
+    #:
+    #:   service -> {'target': seconds, 'min': nodes, 'max': nodes}
+    _batching = {}
+
+    #: Services to be upgraded in canary mode, and health check playbooks
+    #: to verify a canary. In this mode the first of hosts passed to
+    #: '.start()' is upgraded alone, then the health check playbook (if
+    #: not ``None``) is executed on it, and only then the rest of hosts
+    #: are upgraded in rolling windows (see :attr:`_windows`). Canary
+    #: failure stops the upgrade before the rest of hosts are touched.
+    #:
+    #: The dict has the following format:
+    #:
+    #:   service -> health-check-playbook
+    #:
+    #: E.g. ``{'nova-compute': 'healthcheck-nova.yml'}``, where the playbook
+    #: is looked up in OpenStack Ansible playbooks directory unless it's
+    #: an absolute path.
+    _canaries = {}
+
+    #: A path to OpenStack Ansible sources.
     _root = os.path.join('/opt', 'openstack-ansible')
 
+    #: A path to OpenStack Ansible deployment configuration, i.e. user
+    #: settings and generated inventory.
+    _deploy = os.path.join('/etc', 'openstack_deploy')
+
+    #: Ansible inventory source. If None, the one configured for Ansible
+    #: by OpenStack Ansible is used.
+    _inventory = None
+
+    #: One worker pool may upgrade several OpenStack Ansible deployments,
+    #: each with its own sources and configuration. Clusters that are not
+    #: listed here, as well as missing keys, fall back to the defaults
+    #: above. If only 'deploy' is set, inventory is generated from that
+    #: directory too. The dict has the following format:
+    #:
+    #:   cluster-id -> {'root': path, 'deploy': path, 'inventory': source}
+    #:
+    #: Please note, 'bootstrap-ansible.sh' executed by :meth:`pre_upgrade`
+    #: installs roles to /etc/ansible/roles and the 'openstack-ansible'
+    #: wrapper to /usr/local/bin, which are shared by all deployments. So
+    #: deployments on different OpenStack Ansible releases can't be
+    #: upgraded by the same workers at the same time. Driver state, e.g.
+    #: retry files, quarantine and history, is kept per listed cluster
+    #: (see :class:`cluster_state`).
+    _clusters = {}
+
+    #: OpenStack Ansible release we upgrade to, e.g. '14.2.0'. When set,
+    #: installed versions are probed right before running a playbook, and
+    #: hosts where the service already runs this release are excluded
+    #: from the limit. It comes in handy when upgrade is resumed after
+    #: a partial manual upgrade.
+    _release = None
+
+    #: Fact gathering profiles for playbooks that don't need all facts.
+    #: Gathering facts on hundreds of hosts and containers is a noticeable
+    #: fixed cost of each playbook, so playbooks from this allowlist are
+    #: executed with restricted 'gather_subset' and, optionally, shorter
+    #: 'gather_timeout'. Other playbooks gather facts as configured by
+    #: OpenStack Ansible. The dict has the following format:
+    #:
+    #:   playbook -> {'gather_subset': subset, 'gather_timeout': seconds}
+    _facts = {
+        # The playbook only removes pip configuration file and doesn't
+        # use any facts, yet it's executed on every host and container.
+        'pip-conf-removal.yml': {'gather_subset': '!all'},
+
+        # Only architecture is needed to choose artifacts to prefetch.
+        'prestage.yml': {'gather_subset': '!all'},
+    }
+
+    #: A number of parallel connections used to ping every host and
+    #: container in inventory before upgrade. Unreachable hosts are found
+    #: in seconds instead of in the middle of a long playbook. The check
+    #: is disabled if None.
+    _preflight_forks = None
+
+    #: Ansible strategy plugin to execute playbooks with. OpenStack Ansible
+    #: roles consist of hundreds of small tasks, and with default strategy
+    #: each of them pays for module transfer and interpreter startup on
+    #: every host. Accelerated strategies such as Mitogen avoid that cost.
+    #: If the plugin isn't found in 'plugins' directory, playbooks are
+    #: executed with the strategy configured for Ansible. The dict has the
+    #: following format:
+    #:
+    #:   {'name': 'mitogen_linear', 'plugins': path-to-strategy-plugins}
+    _strategy = None
+
+    #: A maximum number of nodes to quarantine during upgrade. When set,
+    #: nodes a playbook has failed on are quarantined instead of failing
+    #: the task (see :func:`quarantine`), so a few bad nodes don't stall
+    #: hundreds of healthy ones. Once the limit is exceeded, the task
+    #: fails as usual. Canaries are never quarantined. Quarantined nodes
+    #: are reported by the last task of :meth:`schedule`. Quarantine is
+    #: scoped to an upgrade, so it's reset by :meth:`pre_upgrade`, and
+    #: fixed nodes may be released earlier by :meth:`release_quarantined`.
+    #: Quarantine is disabled if None.
+    _quarantine = None
+
+    #: A number of hosts and containers artifacts are prefetched to by one
+    #: playbook execution in :meth:`pre_stage`. Batches are executed in
+    #: parallel, as many at once as there are free worker slots.
+    _prestage_batch = 100
+
     _run_playbook = None
     _run_playbook_for = None
+    _check_reachability = None
+    _pre_stage = None
 
     def __init__(self, *args, **kwargs):
+        #: A cluster to upgrade. It's also taken from hosts passed to
+        #: 'start()', but 'pre_upgrade()' knows nothing about hosts.
+        self._cluster = kwargs.pop('cluster_id', None)
+
         super(Driver, self).__init__(*args, **kwargs)
 
         #: Due to the fact that we have one playbook that upgrades the whole
@@ -145,15 +1201,52 @@ class Driver(base.UpgradeDriver):
         #: to prevent running this playbook once again (it makes no sense),
         #: we need to track playbook executions per host.
         #:
+        #: Executions scoped with tags are tracked separately, since they
+        #: upgrade only a part of the service. An unscoped execution, that
+        #: has empty tags and skip-tags, covers any scoped one.
+        #:
         #: The dict has the following format:
         #:
-        #:   (host, playbook) -> is-executed
+        #:   (host, playbook, tags, skip-tags) -> is-executed
         self._executions = {}
 
+        #: All tasks produced by the driver are traced as a single trace,
+        #: so the whole upgrade can be inspected at once.
+        self._trace = tracing.new_context()
+
+    def _get_deployment(self, hosts=()):
+        for host in hosts:
+            if host.get('cluster_id') is not None:
+                self._cluster = host['cluster_id']
+                break
+
+        # Clusters that are not listed in settings are upgraded using the
+        # default deployment, so they share its state too.
+        cluster = self._cluster if self._cluster in self._clusters else None
+        settings = self._clusters.get(cluster, {})
+        return {
+            'root': settings.get('root', self._root),
+            'deploy': settings.get('deploy', self._deploy),
+            'inventory': settings.get('inventory', self._inventory),
+            'cluster': cluster,
+        }
+
     def pre_upgrade(self):
+        deployment = self._get_deployment()
+        root = deployment['root']
+
         utilities = os.path.join(
-            self._root, 'scripts', 'upgrade-utilities', 'playbooks')
-        playbooks = os.path.join(self._root, 'playbooks')
+            root, 'scripts', 'upgrade-utilities', 'playbooks')
+        playbooks = os.path.join(root, 'playbooks')
+
+        def run_playbook(playbook, **kwargs):
+            return self._run_playbook.si(
+                playbook,
+                facts=self._get_facts(playbook),
+                strategy=self._strategy,
+                trace=tracing.get_context(self._trace),
+                deployment=deployment,
+                **kwargs)
 
         # According to the upgrade document, there are steps that must be
         # executed before trying to upgrade OpenStack to new version. This
@@ -161,78 +1254,302 @@ class Driver(base.UpgradeDriver):
         # to run them manually.
         #
         # http://docs.openstack.org/developer/openstack-ansible/upgrade-guide/manual-upgrade.html
-        return celery.chain(*[
+        steps = [
+
+            # Retry files of a previous upgrade to the same release, even if
+            # it has never been retried, must not narrow down playbooks of
+            # this one.
+            _purge_retry_hosts.si(
+                release=self._release, deployment=deployment),
+
+            # Nodes quarantined during a previous upgrade are either fixed
+            # or still broken, and this upgrade must find it out itself
+            # rather than skip them or count them towards its limit.
+            _release_quarantined.si(deployment=deployment),
 
             # Bootstrapping Ansible again ensures that all OpenStack Ansible
             # role dependencies are in place before running playbooks of new
             # release.
             tasks.execute.si(
-                os.path.join(self._root, 'scripts', 'bootstrap-ansible.sh'),
-                cwd=self._root,
+                os.path.join(root, 'scripts', 'bootstrap-ansible.sh'),
+                cwd=root,
             ),
 
             # Some configuration may changed, and old facts should be purged.
-            self._run_playbook.si(
+            run_playbook(
                 os.path.join(utilities, 'ansible_fact_cleanup.yml'),
             ),
 
             # The user configuration files in /etc/openstack_deploy/ and
             # the environment layout in /etc/openstack_deploy/env.d may
             # have new name values added in new release.
-            self._run_playbook.si(
+            run_playbook(
                 os.path.join(utilities, 'deploy-config-changes.yml'),
             ),
 
             # Populate user_secrets.yml with new secrets added in new
             # release.
-            self._run_playbook.si(
+            run_playbook(
                 os.path.join(utilities, 'user-secrets-adjustment.yml'),
             ),
 
             # The presence of pip.conf file can cause build failures when
             # upgrading. So better remove it everywhere.
-            self._run_playbook.si(
+            run_playbook(
                 os.path.join(utilities, 'pip-conf-removal.yml'),
             ),
 
             # Update the configuration of the repo servers and build a new
             # packages required by new release.
-            self._run_playbook.si(
+            run_playbook(
                 os.path.join(playbooks, 'repo-install.yml'),
                 cwd=playbooks,
             ),
-        ])
+        ]
+
+        # Fail fast if some hosts are unreachable, since otherwise it will
+        # be noticed only deep inside of some playbook.
+        if self._preflight_forks:
+            steps.insert(0, self._check_reachability.si(
+                forks=self._preflight_forks,
+                trace=tracing.get_context(self._trace),
+                deployment=deployment))
+
+        return celery.chain(*steps)
+
+    def pre_stage(self):
+        """Prefetch artifacts of the target release ahead of the upgrade.
+
+        Most of the time OpenStack Ansible playbooks spend on downloading
+        virtual environments from repo servers. This hook is meant to be
+        run after :meth:`pre_upgrade`, when new artifacts are built, but
+        before the maintenance window. It downloads them to every host and
+        container in parallel batches (see :attr:`_prestage_batch`), so
+        playbooks executed by :meth:`start` only switch over to them.
+
+        The task is finished only when all batches are, and its result
+        holds results of the batches. Prefetching is best effort: hosts
+        it has failed on download artifacts during the upgrade as usual.
+        """
+        return self._pre_stage.si(
+            batch=self._prestage_batch,
+            facts=self._get_facts(_PRESTAGE_PLAYBOOK),
+            strategy=self._strategy,
+            trace=tracing.get_context(self._trace),
+            deployment=self._get_deployment())
+
+    def _get_facts(self, playbook):
+        return self._facts.get(os.path.basename(playbook))
+
+    def _get_scope(self, service):
+        return (
+            self._playbooks[service['name']],
+            tuple(self._tags.get(service['name'], [])),
+            tuple(self._skip_tags.get(service['name'], [])),
+        )
+
+    def _skip_executed(self, hosts, playbook, tags, skip_tags, executions):
+        # Do not execute a playbook second time on the same host. This might
+        # happened pretty often as OpenStack Ansible playbooks upgrades
+        # the whole service at once rather than its separate parts.
+        for host in copy.copy(hosts):
+            key = host['id'], playbook, tags, skip_tags
+            if any([executions.get(key),
+                    executions.get((host['id'], playbook, (), ()))]):
+                hosts.remove(host)
+            executions[key] = True
 
     def start(self, service, hosts):
+        with tracing.span('start', self._trace, service=service['name']):
+            return self._start(service, hosts)
+
+    def _start(self, service, hosts):
         # Kostyor's model may contain services we do not support yet. If
         # such one is passed then do nothing. It seems reasonable to ignore
         # and let users to handle it themselves.
         if service['name'] not in self._playbooks:
             return tasks.noop.si()
 
-        # Do not execute a playbook second time on the same host. This might
-        # happened pretty often as OpenStack Ansible playbooks upgrades
-        # the whole service at once rather than its separate parts.
-        for host in copy.copy(hosts):
-            key = host['id'], self._playbooks[service['name']]
-            if self._executions.get(key):
-                hosts.remove(host)
-            self._executions[key] = True
+        playbook, tags, skip_tags = self._get_scope(service)
+        self._skip_executed(hosts, playbook, tags, skip_tags, self._executions)
 
         if not hosts:
             return tasks.noop.si()
 
-        return self._run_playbook_for.si(
-            os.path.join(
-                self._root, 'playbooks', self._playbooks[service['name']]
-            ),
+        deployment = self._get_deployment(hosts)
 
-            # By default, OpenStack Ansible deploys control plane services
-            # in LXC containers, and use those as hosts in Ansible inventory.
-            # However, from Kostyor's point of view we are interested in
-            # baremetal node-by-node upgrade and we don't want to know about
-            # containers. So we need to limit playbook execution only to
-            # a baremetal node and its containers.
-            hosts,
-            service,
-        )
+        def run_on(nodes, playbook=playbook, tags=tags, skip_tags=skip_tags,
+                   release=self._release, batching=None,
+                   quarantine=self._quarantine, canary=False):
+            return self._run_playbook_for.si(
+                os.path.join(deployment['root'], 'playbooks', playbook),
+
+                # By default, OpenStack Ansible deploys control plane
+                # services in LXC containers, and use those as hosts in
+                # Ansible inventory. However, from Kostyor's point of view
+                # we are interested in baremetal node-by-node upgrade and we
+                # don't want to know about containers. So we need to limit
+                # playbook execution only to a baremetal node and its
+                # containers.
+                nodes,
+                service,
+
+                tags=list(tags),
+                skip_tags=list(skip_tags),
+                release=release,
+                batching=batching,
+                facts=self._get_facts(playbook),
+                strategy=self._strategy,
+                quarantine=quarantine,
+                canary=canary,
+                trace=tracing.get_context(),
+                deployment=deployment,
+            )
+
+        window = self._windows.get(service['name'])
+        batching = self._batching.get(service['name'])
+
+        # In canary mode the first host is upgraded alone and, optionally,
+        # verified by health check playbook. Only if it succeeded, the rest
+        # of hosts are upgraded in rolling windows.
+        if service['name'] in self._canaries:
+            canary, rest = hosts[:1], hosts[1:]
+
+            # Canary failure must stop the upgrade, so no failures are
+            # tolerated, and a canary quarantined earlier is an error
+            # rather than a reason to skip it.
+            canary_quarantine = 0 if self._quarantine is not None else None
+            steps = [run_on(canary, quarantine=canary_quarantine,
+                            canary=True)]
+
+            healthcheck = self._canaries[service['name']]
+            if healthcheck is not None:
+                steps.append(
+                    run_on(canary, healthcheck, (), (), release=None,
+                           quarantine=canary_quarantine, canary=True))
+
+            if rest and batching:
+                steps.append(run_on(rest, batching=batching))
+            elif rest:
+                steps.extend(
+                    run_on(nodes) for nodes in get_windows(rest, window))
+
+            return celery.chain(*steps)
+
+        if batching:
+            return run_on(hosts, batching=batching)
+
+        windows = [run_on(nodes) for nodes in get_windows(hosts, window)]
+
+        if len(windows) == 1:
+            return windows[0]
+        return celery.chain(*windows)
+
+    def get_stages(self, plan):
+        """Split upgrade plan into stages of independent steps.
+
+        See :func:`get_stages` for details.
+        """
+        return get_stages(plan, self._dependencies)
+
+    def schedule(self, plan):
+        """Upgrade services of a given plan respecting their dependencies.
+
+        Steps of each stage are dispatched as a Celery group, so they are
+        executed concurrently as long as there are free worker slots.
+        Stages are chained, so the next stage is started only when the
+        previous one is succeeded. In quarantine mode, the chain ends with
+        a task that returns quarantined nodes (see :attr:`_quarantine`).
+
+        :param plan: a list of steps, where each step is a pair of service
+                     and hosts to upgrade the service on
+        :type plan: [(dict, [dict])]
+        """
+        with tracing.span('schedule', self._trace):
+            steps = [
+                celery.group(*[self.start(service, hosts)
+                               for service, hosts in stage])
+                for stage in self.get_stages(plan)
+            ]
+
+        # Quarantined nodes are reported as the result of the whole chain,
+        # so the operator knows which nodes to fix.
+        if self._quarantine is not None:
+            steps.append(_report_quarantined.si(
+                deployment=self._get_deployment()))
+        return celery.chain(*steps)
+
+    def release_quarantined(self, hosts=None):
+        """Release nodes from quarantine once they are fixed.
+
+        Quarantine is kept by workers on deployment host, so releasing
+        is a task to be executed there too. Released nodes are upgraded
+        by subsequent steps as usual.
+
+        :param hosts: Kostyor hosts to release, or ``None`` to release all
+        :type hosts: [dict]
+
+        :returns: a Celery task
+        """
+        return _release_quarantined.si(
+            nodes=None if hosts is None else [
+                host['hostname'] for host in hosts],
+            deployment=self._get_deployment(hosts or ()))
+
+    def estimate(self, plan):
+        """Predict how long it takes to upgrade services of a given plan.
+
+        Estimation is based on durations of past playbook executions (see
+        :func:`estimate`). Hosts that won't be upgraded by :meth:`start`
+        because a playbook has already been executed on them are not taken
+        into account. History is kept by workers on deployment host, so
+        the estimation is a task to be executed there too.
+
+        :param plan: a list of steps, where each step is a pair of service
+                     and hosts to upgrade the service on
+        :type plan: [(dict, [dict])]
+
+        :returns: a Celery task that returns estimation, see
+                  :func:`estimate` for its format
+        """
+        executions = dict(self._executions)
+        stages = []
+
+        for stage in self.get_stages(plan):
+            steps = []
+
+            for service, hosts in stage:
+                if service['name'] not in self._playbooks:
+                    continue
+
+                playbook, tags, skip_tags = self._get_scope(service)
+                hosts = list(hosts)
+                self._skip_executed(
+                    hosts, playbook, tags, skip_tags, executions)
+
+                runs = []
+                if hosts:
+                    runs.append(
+                        [playbook, self._get_facts(playbook), len(hosts)])
+
+                    # The health check playbook is executed on a canary host
+                    # only, but its duration is added to the whole step as
+                    # it blocks the rest of hosts.
+                    healthcheck = self._canaries.get(service['name'])
+                    if healthcheck is not None:
+                        runs.append(
+                            [healthcheck, self._get_facts(healthcheck), 1])
+
+                steps.append({
+                    'service': service['name'],
+                    'playbook': playbook,
+                    'nodes': [host['hostname'] for host in hosts],
+                    'runs': runs,
+                })
+
+            stages.append(steps)
+
+        return _estimate.si(
+            stages,
+            deployment=self._get_deployment(
+                [host for _, hosts in plan for host in hosts]))
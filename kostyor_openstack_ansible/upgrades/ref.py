@@ -30,17 +30,29 @@ import billiard
 multiprocessing.Process = billiard.Process  # noqa
 
 import os
+import copy
 import glob
+import time
+import uuid
 
+from ansible import constants as C
+from ansible.cli.adhoc import AdHocCLI
 from ansible.cli.playbook import PlaybookCLI
 from ansible.executor.playbook_executor import PlaybookExecutor
+from ansible.executor.task_queue_manager import TaskQueueManager
 from ansible.inventory import Inventory
+from ansible.inventory.group import Group
 from ansible.parsing.dataloader import DataLoader
+from ansible.parsing.splitter import parse_kv
+from ansible.playbook.play import Play
+from ansible.plugins import strategy_loader
+from ansible.plugins.callback import CallbackBase
 from ansible.vars import VariableManager
 from ansible.utils.vars import combine_vars
 
 from kostyor.rpc.app import app
 
+from .. import adhoc, inventory, metrics, tracing
 from . import base
 
 
@@ -76,7 +88,103 @@ class _setcwd(object):
             os.chdir(self._oldcwd)
 
 
-def _get_user_settings(loader):
+class _setfacts(object):
+    """Context manager for temporally setting fact gathering options.
+
+    Ansible reads its configuration once on import, and playbooks are
+    executed in process, so the only way to change fact gathering for a
+    single execution is to override loaded constants.
+
+    :param facts: fact gathering profile with 'gather_subset' and
+                  'gather_timeout' keys, both are optional
+    :type facts: dict
+    """
+
+    _constants = {
+        'gather_subset': 'DEFAULT_GATHER_SUBSET',
+        'gather_timeout': 'DEFAULT_GATHER_TIMEOUT',
+    }
+
+    def __init__(self, facts):
+        self._newconst = dict(
+            (self._constants[name], value)
+            for name, value in (facts or {}).items() if value
+        )
+        self._oldconst = {}
+
+    def __enter__(self):
+        for name, value in self._newconst.items():
+            self._oldconst[name] = getattr(C, name)
+            setattr(C, name, value)
+
+    def __exit__(self, *args):
+        for name, value in self._oldconst.items():
+            setattr(C, name, value)
+
+
+def _use_strategy(executor, strategy):
+    # Strategy is a play keyword, and plays are loaded by the executor
+    # itself, so the only way to change it for a single execution is to
+    # intercept plays on their way to task queue manager. Plays that set
+    # their own strategy keep it, the same way they do with strategy set
+    # in Ansible configuration.
+    if strategy.get('plugins'):
+        strategy_loader.add_directory(strategy['plugins'])
+
+    run = executor._tqm.run
+
+    def run_play(play):
+        if play.strategy == C.DEFAULT_STRATEGY:
+            play.strategy = strategy['name']
+        return run(play=play)
+    executor._tqm.run = run_play
+
+
+#: Parsed YAML files are kept in memory between playbook executions in the
+#: same worker process. The dict has the following format:
+#:
+#:   path -> (mtime, data)
+_YAML_CACHE = {}
+
+
+class _CachingDataLoader(DataLoader):
+    """Data loader that reuses parsed YAML files across executions.
+
+    During upgrade the same playbooks, roles and settings are loaded over
+    and over again, e.g. when a playbook is executed in batches. Parsing
+    them takes noticeable time, so parsed data is cached until the file
+    is modified.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_CachingDataLoader, self).__init__(*args, **kwargs)
+        self.hits = 0
+        self.misses = 0
+
+    def load_from_file(self, file_name, *args, **kwargs):
+        path = self.path_dwim(file_name)
+
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return super(_CachingDataLoader, self).load_from_file(
+                file_name, *args, **kwargs)
+
+        cached = _YAML_CACHE.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = mtime, super(_CachingDataLoader, self).load_from_file(
+                file_name, *args, **kwargs)
+            _YAML_CACHE[path] = cached
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        # Ansible may modify loaded data in place, so the cached one must
+        # never be shared.
+        return copy.deepcopy(cached[1])
+
+
+def _get_user_settings(loader, deploy=None):
     """Read user settings from /etc/openstack_deploy.
 
     OpenStack Ansible user settings are stored in /etc/openstack_deploy
@@ -86,13 +194,18 @@ def _get_user_settings(loader):
 
     :param loader: an instance of ansible data loader to be used
     :type loader: :class:`ansible.parsing.dataloader.DataLoader`
+
+    :param deploy: a path to deployment configuration, if it's not in
+                   /etc/openstack_deploy
+    :type deploy: str
     """
     settings = {}
 
-    # /etc/openstack_deploy is default and, by all means, hardcoded path
-    # to deployment settings. The dir contains user settings, where each
-    # file starts with 'user_' prefix and ends with '.yml' suffix.
-    pattern = os.path.join('/etc', 'openstack_deploy', 'user_*.yml')
+    # /etc/openstack_deploy is default path to deployment settings. The
+    # dir contains user settings, where each file starts with 'user_'
+    # prefix and ends with '.yml' suffix.
+    pattern = os.path.join(
+        deploy or os.path.join('/etc', 'openstack_deploy'), 'user_*.yml')
 
     for filename in glob.glob(pattern):
         # Ansible may use different strategies of combining variables, so
@@ -102,29 +215,252 @@ def _get_user_settings(loader):
     return settings
 
 
-def _run_playbook_impl(playbook, hosts_fn=None, cwd=None, ignore_errors=False):
+def _load_inventory(loader, variable_manager, deployment=None):
+    """Load inventory and user settings of a given deployment.
+
+    :param deployment: a dict with 'deploy' path and 'inventory' source,
+                       both are optional
+    :type deployment: dict
+
+    :rtype: :class:`ansible.inventory.Inventory`
+    """
+    deployment = deployment or {}
+
+    # OpenStack Ansible dynamic inventory looks for deployment
+    # configuration in OSA_CONFIG_DIR, so it must be set the same way the
+    # 'openstack-ansible' wrapper does, or the inventory of the default
+    # deployment is used along with settings of the given one.
+    config_dir = os.environ.get('OSA_CONFIG_DIR')
+    if deployment.get('deploy'):
+        os.environ['OSA_CONFIG_DIR'] = deployment['deploy']
+
+    try:
+        inventory = Inventory(
+            loader,
+            variable_manager,
+            deployment.get('inventory') or C.DEFAULT_HOST_LIST)
+    finally:
+        if config_dir is None:
+            os.environ.pop('OSA_CONFIG_DIR', None)
+        else:
+            os.environ['OSA_CONFIG_DIR'] = config_dir
+    variable_manager.set_inventory(inventory)
+    variable_manager.extra_vars = _get_user_settings(
+        loader, deployment.get('deploy'))
+
+    return inventory
+
+
+def _limit_inventory(inventory, hosts):
+    """Limit inventory to a given list of hosts.
+
+    Ansible resolves each pattern passed to 'subset()' by matching it
+    against every group and host in inventory, which is slow when the
+    limit consists of hundreds of hosts. So instead we put the hosts into
+    a transient group and limit inventory to that group, that is resolved
+    by a single lookup.
+
+    :param inventory: an inventory to limit
+    :type inventory: :class:`ansible.inventory.Inventory`
+
+    :param hosts: hosts to limit the inventory to
+    :type hosts: [:class:`ansible.inventory.host.Host`]
+    """
+    # Group name must be unique since the same inventory instance may be
+    # limited more than once.
+    group = Group('kostyor_limit_%s' % uuid.uuid4().hex)
+
+    for host in hosts:
+        group.add_host(host)
+
+    inventory.add_group(group)
+    inventory.clear_pattern_cache()
+    inventory.subset(group.name)
+
+
+class _TracingCallback(CallbackBase):
+    """Callback plugin to trace plays and tasks of playbook execution.
+
+    Each play and each task is traced as a span nested into the current
+    one, so it's clear which part of a playbook takes most of the time.
+    """
+
+    def __init__(self):
+        super(_TracingCallback, self).__init__()
+        self._spans = []
+
+    def _close(self, depth):
+        while len(self._spans) > depth:
+            self._spans.pop().__exit__(None, None, None)
+
+    def _open(self, depth, name, **args):
+        self._close(depth)
+        self._spans.append(tracing.span(name, **args))
+        self._spans[-1].__enter__()
+
+    def v2_playbook_on_play_start(self, play):
+        self._open(0, 'play', play=play.get_name())
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._open(1, 'task', task=task.get_name())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._open(1, 'handler', task=task.get_name())
+
+    def v2_playbook_on_stats(self, stats):
+        self._close(0)
+
+
+class _AdHocCallback(CallbackBase):
+    """Callback plugin to collect per-host results of ad-hoc execution.
+
+    Results are stored in the same format the alt driver gets them from
+    Ansible ad-hoc command line tool, so they can be processed the same
+    way.
+    """
+
+    def __init__(self):
+        super(_AdHocCallback, self).__init__()
+        self.results = {}
+
+        # Ansible 2.x has no per-host start event, so elapsed time is
+        # counted from the start of execution, just like in the alt driver.
+        self._started = time.time()
+
+    def _store(self, result):
+        self.results[result._host.get_name()] = adhoc.AdHocResult(
+            result._result, time.time() - self._started)
+
+    def v2_runner_on_ok(self, result):
+        self._store(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._store(result)
+
+    def v2_runner_on_unreachable(self, result):
+        self._store(result)
+
+
+def _get_adhoc_options(forks=None):
+    """Return options of ad-hoc command with proper defaults.
+
+    Just like playbook options (see '_run_playbook_impl'), they can be
+    obtained only from CLI instance. Ad-hoc commands must never reuse
+    playbook options, since playbook tags would filter out their only
+    task, which is untagged.
+
+    :param forks: a number of parallel processes, or Ansible default
+    :type forks: int
+    """
+    args = ['to-be-stripped', 'all']
+    if forks:
+        args.extend(['--forks', str(forks)])
+
+    adhoc_cli = AdHocCLI(args)
+    adhoc_cli.parse()
+    return adhoc_cli.options
+
+
+@tracing.span('adhoc')
+def _run_adhoc_impl(loader, variable_manager, inventory, options, hosts,
+                    module, args=None):
+    """Run Ansible module on given hosts in process.
+
+    :param hosts: hosts to run the module on
+    :type hosts: [:class:`ansible.inventory.host.Host`]
+
+    :param module: a module name to run, e.g. 'setup'
+    :type module: str
+
+    :param args: module arguments
+    :type args: str
+
+    :returns: a dict of hostname to
+              :class:`kostyor_openstack_ansible.adhoc.AdHocResult`
+    """
+    _limit_inventory(inventory, hosts)
+
+    play = Play().load(
+        {
+            'hosts': 'all',
+            'gather_facts': 'no',
+            'tasks': [
+                {'action': {'module': module, 'args': parse_kv(args or '')}},
+            ],
+        },
+        variable_manager=variable_manager,
+        loader=loader,
+    )
+
+    callback = _AdHocCallback()
+    tqm = TaskQueueManager(
+        inventory=inventory,
+        variable_manager=variable_manager,
+        loader=loader,
+        options=options,
+        passwords={},
+        stdout_callback=callback,
+    )
+
+    try:
+        tqm.run(play)
+    finally:
+        tqm.cleanup()
+
+    return callback.results
+
+
+def _run_playbook_impl(playbook, hosts_fn=None, cwd=None, ignore_errors=False,
+                       tags=None, skip_tags=None, service=None, release=None,
+                       facts=None, strategy=None, quarantine=None,
+                       deployment=None):
+    args = ['to-be-stripped', playbook]
+    if tags:
+        args.extend(['--tags', ','.join(tags)])
+    if skip_tags:
+        args.extend(['--skip-tags', ','.join(skip_tags)])
+
     # Unfortunately, there's no good way to get the options instance
     # with proper defaults since it's generated by argparse inside
     # PlaybookCLI. Due to the fact that the options can't be empty
     # and must contain proper values we have not choice but extract
     # them from PlaybookCLI instance.
-    playbook_cli = PlaybookCLI(['to-be-stripped', playbook])
+    playbook_cli = PlaybookCLI(args)
     playbook_cli.parse()
     options = playbook_cli.options
 
     # Get others required options.
-    loader = DataLoader()
+    loader = _CachingDataLoader()
     variable_manager = VariableManager()
-    inventory = Inventory(loader, variable_manager)
-    variable_manager.set_inventory(inventory)
-    variable_manager.extra_vars = _get_user_settings(loader)
+    inventory = _load_inventory(loader, variable_manager, deployment)
 
-    # Limit playbook execution to hosts returned by 'hosts_fn'.
+    # Limit playbook execution to hosts returned by 'hosts_fn'. In case
+    # of retry, only hosts failed last time are taken into account. If
+    # errors are ignored, the task is never retried.
+    limit, hosts = None, []
     if hosts_fn is not None:
-        inventory.subset([
-            host.get_vars()['inventory_hostname']
-            for host in hosts_fn(inventory)
-        ])
+        hosts = hosts_fn(inventory)
+        limit = [host.get_name() for host in hosts]
+        if not ignore_errors:
+            retry = set(base.pop_retry_hosts(playbook, limit, release))
+            hosts = [host for host in hosts if host.get_name() in retry]
+
+        # Do not run the playbook on hosts that are already upgraded.
+        # A single ad-hoc run over all hosts is cheap in comparison to
+        # the playbook.
+        if release is not None and hosts:
+            upgraded = base.get_upgraded_hosts(
+                _run_adhoc_impl(loader, variable_manager, inventory,
+                                _get_adhoc_options(), hosts,
+                                *base._VERSION_PROBE),
+                service,
+                release)
+            hosts = [host for host in hosts if host.get_name() not in upgraded]
+
+            if not hosts:
+                return {'exitcode': 0}
+
+        _limit_inventory(inventory, hosts)
 
     # Finally, we can create a playbook executor and run the playbook.
     executor = PlaybookExecutor(
@@ -138,8 +474,76 @@ def _run_playbook_impl(playbook, hosts_fn=None, cwd=None, ignore_errors=False):
 
     # Some playbooks may rely on current working directory, so better allow
     # to change it before execution.
-    with _setcwd(cwd):
-        exitcode = executor.run()
+    name = os.path.basename(playbook)
+    timer = metrics.timed('playbook', playbook=name)
+
+    # Plays and tasks are traced by callback plugin, and the only way to
+    # add one to executor is to append it to already loaded plugins.
+    if tracing.get_context() is not None and executor._tqm is not None:
+        executor._tqm._callback_plugins.append(_TracingCallback())
+
+    strategy = base.get_strategy(strategy)
+    if strategy is not None and executor._tqm is not None:
+        _use_strategy(executor, strategy)
+
+    started = time.time()
+    with _setcwd(cwd), _setfacts(facts), timer:
+        with tracing.span('playbook', playbook=name):
+            exitcode = executor.run()
+    duration = time.time() - started
+
+    metrics.inc('yaml_cache_hits_total', loader.hits)
+    metrics.inc('yaml_cache_misses_total', loader.misses)
+    if limit is not None:
+        metrics.inc('playbook_hosts_total', len(hosts), playbook=name)
+    if exitcode:
+        metrics.inc('playbook_failures_total', playbook=name)
+        metrics.inc('playbook_failed_hosts_total',
+                    len(set(executor._tqm._stats.failures) |
+                        set(executor._tqm._stats.dark)),
+                    playbook=name)
+
+    failed = set()
+    if limit is not None and exitcode:
+        stats = executor._tqm._stats
+        failed = set(stats.failures) | set(stats.dark)
+
+    # In quarantine mode nodes of failed hosts are set aside, and the
+    # upgrade goes on unless too many nodes have failed. The task is never
+    # retried then, so there's no retry file to leave behind.
+    if quarantine is not None and failed and base.quarantine(
+            playbook,
+            sorted(set(host.get_vars().get('physical_host', host.get_name())
+                       for host in hosts if host.get_name() in failed)),
+            quarantine):
+        return {'exitcode': exitcode}
+
+    # Remember failed and unreachable hosts, so retry of the task will run
+    # the playbook only on them.
+    if failed and not ignore_errors:
+        base.save_retry_hosts(playbook, limit, failed, release)
+
+    # Durations of past executions help to choose batch sizes, but only
+    # successful ones are representative. Unlimited playbooks are measured
+    # on hosts they've been executed on.
+    result = {'exitcode': exitcode}
+    if limit is None and executor._tqm is not None:
+        hosts = [
+            host for host in map(inventory.get_host,
+                                 executor._tqm._stats.processed)
+            if host is not None
+        ]
+    if not exitcode and hosts:
+        entry = base.record_duration(
+            playbook,
+            len(set(host.get_vars().get('physical_host', host.get_name())
+                    for host in hosts)),
+            duration,
+            facts=facts)
+
+        # Time saved by restricted fact gathering is reported per run.
+        if 'saved' in entry:
+            result['saved'] = entry['saved']
 
     # Celery treats exceptions from task as way to mark it failed. So let's
     # throw one to do so in case return code is not zero.
@@ -147,29 +551,109 @@ def _run_playbook_impl(playbook, hosts_fn=None, cwd=None, ignore_errors=False):
         raise Exception('Playbook "%s" has been finished with errors. '
                         'Exit code is "%d".' % (playbook, exitcode))
 
-    return exitcode
+    return result
 
 
 @app.task
-def _run_playbook(playbook, cwd=None, ignore_errors=False):
+@tracing.span('_run_playbook')
+@base.cluster_state()
+def _run_playbook(playbook, cwd=None, ignore_errors=False, facts=None,
+                  strategy=None, limit=None, trace=None, deployment=None):
+    def hosts_fn(inventory):
+        return [
+            host for host in map(inventory.get_host, limit)
+            if host is not None
+        ]
+
     return _run_playbook_impl(
         playbook,
+        hosts_fn if limit is not None else None,
         cwd=cwd,
-        ignore_errors=ignore_errors
+        ignore_errors=ignore_errors,
+        facts=facts,
+        strategy=strategy,
+        deployment=deployment,
     )
 
 
 @app.task
-def _run_playbook_for(playbook, hosts, service, cwd=None, ignore_errors=False):
-    return _run_playbook_impl(
-        playbook,
-        lambda inv: base.get_component_hosts_on_nodes(inv, service, hosts),
-        cwd=cwd,
-        ignore_errors=ignore_errors
-    )
+@tracing.span('_run_playbook_for')
+@base.cluster_state()
+def _run_playbook_for(playbook, hosts, service, cwd=None, ignore_errors=False,
+                      tags=None, skip_tags=None, release=None, batching=None,
+                      facts=None, strategy=None, quarantine=None,
+                      canary=False, trace=None, deployment=None):
+    # Shared memory-mapped index makes limit resolution cheap, but it's
+    # built from the default inventory only.
+    index = None
+    settings = deployment or {}
+    if inventory.has_mapped_index() and not settings.get('inventory'):
+        index = inventory.load(inventory.get_path(settings.get('deploy')))
+
+    def run(nodes):
+        if quarantine is not None:
+            nodes = base.exclude_quarantined(nodes, canary)
+            if not nodes:
+                return {'exitcode': 0}
+
+        return _run_playbook_impl(
+            playbook,
+            lambda inv: base.get_component_hosts_on_nodes(
+                inv, service, nodes, index=index),
+            cwd=cwd,
+            ignore_errors=ignore_errors,
+            tags=tags,
+            skip_tags=skip_tags,
+            service=service,
+            release=release,
+            facts=facts,
+            strategy=strategy,
+            quarantine=quarantine,
+            deployment=deployment,
+        )
+
+    if batching:
+        return base.run_in_batches(run, playbook, hosts, batching, facts)
+    return run(hosts)
+
+
+@app.task
+@metrics.timed('preflight')
+@tracing.span('_check_reachability')
+@base.cluster_state()
+def _check_reachability(forks=None, trace=None, deployment=None):
+    loader = _CachingDataLoader()
+    variable_manager = VariableManager()
+    inventory = _load_inventory(loader, variable_manager, deployment)
+
+    hosts = inventory.get_hosts('all')
+    base.check_reachability(
+        _run_adhoc_impl(loader, variable_manager, inventory,
+                        _get_adhoc_options(forks), hosts, 'ping'),
+        [host.get_name() for host in hosts])
+
+
+@app.task(bind=True)
+@tracing.span('_pre_stage')
+def _pre_stage(self, batch=None, trace=None, deployment=None, **kwargs):
+    # Hosts are enumerated the same way '_run_playbook_for' resolves
+    # limits: custom inventory sources are known to Ansible only.
+    if (deployment or {}).get('inventory'):
+        hosts = sorted(
+            host.get_name() for host in _load_inventory(
+                _CachingDataLoader(), VariableManager(), deployment
+            ).get_hosts('all'))
+    else:
+        hosts = inventory.load(
+            inventory.get_path((deployment or {}).get('deploy'))).get_hosts()
+
+    return self.replace(base.pre_stage(
+        _run_playbook, hosts, batch, deployment, trace=trace, **kwargs))
 
 
 class Driver(base.Driver):
 
     _run_playbook = _run_playbook
     _run_playbook_for = _run_playbook_for
+    _check_reachability = _check_reachability
+    _pre_stage = _pre_stage
@@ -22,7 +22,7 @@ setup(
     keywords='openstack kostyor driver ansible upgrade day2 ops',
     author='Ihor Kalnytskyi',
     author_email='igor@kalnitsky.org',
-    packages=find_packages(exclude=['docs', 'tests*']),
+    packages=find_packages(exclude=['docs', 'tests*', 'benchmarks*']),
     include_package_data=True,
     zip_safe=False,
     python_requires='>=2.7,!=3.0.*,!=3.1.*,!=3.2.*,!=3.3.*',
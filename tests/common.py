@@ -18,6 +18,7 @@ import os
 import uuid
 
 import mock
+import pytest
 
 from ansible.inventory import Inventory
 from ansible.parsing.dataloader import DataLoader
@@ -67,3 +68,23 @@ def get_hosts(*hostnames):
         }
         for hostname in hostnames
     ]
+
+
+class UsesStateDir(object):
+    """Base class for tests that need driver state.
+
+    Each test gets its own empty state directory, so tests never see
+    retry files, history or quarantine of each other.
+    """
+
+    @pytest.fixture(autouse=True)
+    def use_state_dir(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(
+            'kostyor_openstack_ansible.upgrades.base._STATE_DIR',
+            str(tmpdir))
+
+
+def read_trace(path):
+    # Chrome trace format allows to omit closing bracket, but Python's
+    # JSON parser doesn't.
+    return json.loads(path.read().rstrip().rstrip(',') + ']')
@@ -0,0 +1,84 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import signal
+import time
+
+import mock
+import pytest
+
+from kostyor_openstack_ansible import adhoc
+
+
+class TestRun(object):
+
+    @pytest.fixture(autouse=True)
+    def use_fake_popen(self, monkeypatch):
+        self.limit = None
+        self.popen = mock.Mock(side_effect=self._write_tree)
+
+        monkeypatch.setattr(adhoc.subprocess, 'Popen', self.popen)
+
+    def _write_tree(self, args, **kwargs):
+        with open(args[args.index('-l') + 1][1:]) as fp:
+            self.limit = fp.read().split('\n')
+
+        tree = args[args.index('--tree') + 1]
+        for hostname in self.limit[:-1]:
+            with open(os.path.join(tree, hostname), 'w') as fp:
+                json.dump({'ping': 'pong'}, fp)
+        return mock.DEFAULT
+
+    def test_run(self):
+        results = adhoc.run(['host-1', 'host-2'], 'ping', forks=50)
+
+        self.popen.assert_called_once_with([
+            '/usr/local/bin/ansible', 'all',
+            '-l', mock.ANY,
+            '-m', 'ping',
+            '--tree', mock.ANY,
+            '-f', '50',
+        ])
+
+        assert self.limit == ['host-1', 'host-2']
+        assert list(results) == ['host-1']
+        assert results['host-1'].result == {'ping': 'pong'}
+        assert results['host-1'].elapsed >= 0.0
+
+    def test_run_with_args(self):
+        adhoc.run(['host-1'], 'setup', 'filter=ansible_local')
+
+        assert self.popen.call_args[0][0][-2:] == [
+            '-a', 'filter=ansible_local',
+        ]
+
+    def test_tree_is_removed(self):
+        adhoc.run(['host-1', 'host-2'], 'ping')
+
+        tree = self.popen.call_args[0][0][7]
+        assert not os.path.exists(tree)
+
+    def test_run_with_timeout(self, monkeypatch):
+        killpg = mock.Mock()
+        monkeypatch.setattr(adhoc.os, 'killpg', killpg)
+        self.popen.return_value.pid = 42
+        self.popen.return_value.wait.side_effect = lambda: time.sleep(0.5)
+
+        results = adhoc.run(['host-1', 'host-2'], 'ping', timeout=0.01)
+
+        killpg.assert_called_once_with(42, signal.SIGKILL)
+        assert list(results) == ['host-1']
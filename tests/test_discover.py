@@ -13,11 +13,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
+import gc
+import json
+import weakref
+
 import mock
 import pytest
 
 from kostyor.rpc import app
-from kostyor_openstack_ansible import discover
+from kostyor_openstack_ansible import adhoc, discover, inventory
 
 from .common import get_fixture, get_inventory_instance
 
@@ -141,6 +146,143 @@ class TestDriver(object):
             }
         }
 
+    def test_discover_in_chunks(self, monkeypatch):
+        expected = discover.Driver().discover()
+        monkeypatch.setattr(discover.Driver, '_chunk_size', 3)
+        monkeypatch.setattr(discover.inventory, 'load', mock.Mock(
+            return_value=inventory.InventoryIndex(self._inventory)))
+        discover.Inventory.reset_mock()
+
+        info = discover.Driver().discover()
+
+        for result in (info, expected):
+            for hostname, services in result['hosts'].items():
+                result['hosts'][hostname] = sorted(
+                    services, key=lambda v: v['name'])
+
+        assert info == expected
+
+        # Chunks use inventory cached by worker rather than generate it.
+        assert not discover.Inventory.called
+
+    def test_discover_releases_merged_chunks(self, monkeypatch):
+        chunks = [{'infra1': [{'name': 'nova-api'}]},
+                  {'infra2': [{'name': 'nova-api'}]},
+                  {'infra1': [{'name': 'nova-conductor'}]}]
+        results = [mock.Mock(**{'get.return_value': chunk})
+                   for chunk in chunks]
+        released = [weakref.ref(result) for result in results]
+
+        def get_chunk(index):
+            # All chunks merged before are released by then.
+            gc.collect()
+            assert all(ref() is None for ref in released[:index])
+            return chunks[index]
+
+        for index, result in enumerate(results):
+            result.get.side_effect = functools.partial(get_chunk, index)
+
+        group = mock.Mock()
+        group.return_value.delay.return_value.results = results
+        monkeypatch.setattr(discover.celery, 'group', group)
+        monkeypatch.setattr(discover, '_get_group_sizes', mock.Mock(**{
+            'delay.return_value.get.return_value': {'group': 3}}))
+        monkeypatch.setattr(discover.Driver, '_chunk_size', 1)
+        del results, result
+
+        info = discover.Driver().discover()
+
+        assert info == {
+            'hosts': {
+                'infra1': [{'name': 'nova-api'}, {'name': 'nova-conductor'}],
+                'infra2': [{'name': 'nova-api'}],
+            },
+        }
+        assert all(ref() is None for ref in released)
+
+    def test_get_slices(self):
+        assert discover._get_slices({'a': 5, 'b': 0, 'c': 2}, 3) == [
+            [['a', 0, 3]],
+            [['a', 3, 2], ['c', 0, 1]],
+            [['c', 1, 1]],
+        ]
+
+    def test_discover_with_mapped_index(self, monkeypatch, tmpdir):
+        expected = discover.Driver().discover()
+
+        path = tmpdir.join('openstack_inventory.json')
+        path.write(json.dumps(self._inventory))
+        monkeypatch.setattr(discover.inventory, '_INVENTORY', str(path))
+        monkeypatch.setattr(
+            discover.inventory, '_INDEX_DIR', str(tmpdir.mkdir('index')))
+        discover.Inventory.reset_mock()
+
+        info = discover.Driver().discover()
+
+        for result in (info, expected):
+            for hostname, services in result['hosts'].items():
+                result['hosts'][hostname] = sorted(
+                    services, key=lambda v: v['name'])
+
+        assert info == expected
+        assert not discover.Inventory.called
+
+    @pytest.fixture
+    def probe(self, monkeypatch):
+        run = mock.Mock(return_value={
+            'compute1': adhoc.AdHocResult({
+                'rc': 0,
+                'stdout': (
+                    '/sbin/init\n'
+                    '/openstack/venvs/nova-14.0.0/bin/python '
+                    '/openstack/venvs/nova-14.0.0/bin/nova-compute '
+                    '--config-file /etc/nova/nova.conf\n'
+                    '/openstack/venvs/neutron-14.0.0/bin/python '
+                    '/openstack/venvs/neutron-14.0.0/bin/'
+                    'neutron-linuxbridge-agent\n'
+                ),
+            }, 0.1),
+            'lvm-storage1': adhoc.AdHocResult(
+                {'unreachable': True}, 10.0),
+        })
+
+        monkeypatch.setattr(discover.adhoc, 'run', run)
+        monkeypatch.setattr(discover, '_PROBE_CACHE', {})
+        return run
+
+    def test_discover_reports_live_services(self, probe, monkeypatch):
+        monkeypatch.setattr(
+            discover.Driver, '_probe', {'forks': 100, 'timeout': 30})
+
+        info = discover.Driver().discover()
+
+        assert probe.call_args[0][1:] == discover._PROCESS_PROBE
+        assert probe.call_args[1] == {'forks': 100, 'timeout': 30}
+        assert 'compute1' in probe.call_args[0][0]
+
+        # Services of hosts that haven't responded can't be verified, so
+        # they are reported as inferred from inventory.
+        assert sorted(info['hosts']['compute1'],
+                      key=lambda v: v['name']) == [
+            {'name': 'neutron-linuxbridge-agent'},
+            {'name': 'nova-compute'},
+        ]
+        assert info['hosts']['lvm-storage1'] == [{'name': 'cinder-volume'}]
+
+    def test_discover_probe_is_always_bounded(self, probe, monkeypatch):
+        monkeypatch.setattr(discover.Driver, '_probe', {'forks': 100})
+
+        discover.Driver().discover()
+
+        assert probe.call_args[1] == {
+            'forks': 100, 'timeout': discover._PROBE_TIMEOUT}
+
+    def test_discover_reuses_probe_results(self, probe):
+        discover._get_hosts(probe={'timeout': 30})
+        discover._get_hosts(probe={'timeout': 30})
+
+        assert probe.call_count == 1
+
 
 class TestDriverForAIO(object):
 
@@ -0,0 +1,105 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+from kostyor_openstack_ansible import events
+
+
+def _lines(*items):
+    return [json.dumps(item) + '\n' for item in items]
+
+
+class TestEvents(object):
+
+    def test_get_env(self, monkeypatch):
+        monkeypatch.delenv('ANSIBLE_CALLBACK_PLUGINS', raising=False)
+        monkeypatch.delenv('ANSIBLE_CALLBACK_WHITELIST', raising=False)
+
+        env = events.get_env('/tmp/events')
+
+        assert env == {
+            'ANSIBLE_CALLBACK_PLUGINS': events._CALLBACK_PLUGINS,
+            'ANSIBLE_CALLBACK_WHITELIST': 'kostyor_events',
+            'KOSTYOR_EVENTS_FILE': '/tmp/events',
+        }
+        assert os.path.exists(
+            os.path.join(env['ANSIBLE_CALLBACK_PLUGINS'],
+                         'kostyor_events.py'))
+
+    def test_get_env_keeps_enabled_plugins(self, monkeypatch):
+        monkeypatch.setenv('ANSIBLE_CALLBACK_PLUGINS', '/etc/ansible/cb')
+        monkeypatch.setenv('ANSIBLE_CALLBACK_WHITELIST', 'profile_tasks')
+
+        env = events.get_env('/tmp/events')
+
+        assert env['ANSIBLE_CALLBACK_PLUGINS'] == \
+            events._CALLBACK_PLUGINS + os.pathsep + '/etc/ansible/cb'
+        assert env['ANSIBLE_CALLBACK_WHITELIST'] == \
+            'kostyor_events,profile_tasks'
+
+    def test_parse(self):
+        summary = events.parse(_lines(
+            {'event': 'task', 'task': 'setup', 'time': 10.0},
+            {'event': 'result', 'host': 'a', 'status': 'ok', 'time': 11.0},
+            {'event': 'result', 'host': 'b', 'status': 'unreachable',
+             'time': 12.0},
+            {'event': 'task', 'task': 'install', 'time': 12.5},
+            {'event': 'result', 'host': 'a', 'status': 'changed',
+             'time': 13.0},
+            {'event': 'task', 'task': 'restart', 'time': 13.0},
+            {'event': 'result', 'host': 'a', 'status': 'failed',
+             'time': 18.0},
+            {'event': 'stats', 'time': 18.5},
+        ))
+
+        assert summary == {
+            'hosts': {
+                'a': {'ok': 2, 'changed': 1, 'failed': 1, 'unreachable': 0,
+                      'skipped': 0},
+                'b': {'ok': 0, 'changed': 0, 'failed': 0, 'unreachable': 1,
+                      'skipped': 0},
+            },
+            'tasks': [
+                {'task': 'restart', 'duration': 5.5},
+                {'task': 'setup', 'duration': 2.5},
+                {'task': 'install', 'duration': 0.5},
+            ],
+        }
+        assert events.get_failed_hosts(summary) == ['a', 'b']
+
+    def test_parse_keeps_slowest_tasks(self, monkeypatch):
+        monkeypatch.setattr(events, '_SLOWEST_TASKS', 2)
+
+        summary = events.parse(_lines(*[
+            {'event': 'task', 'task': 'task-%d' % i, 'time': float(i * i)}
+            for i in range(5)
+        ] + [{'event': 'stats', 'time': 25.0}]))
+
+        assert summary['tasks'] == [
+            {'task': 'task-4', 'duration': 9.0},
+            {'task': 'task-3', 'duration': 7.0},
+        ]
+
+    def test_parse_skips_malformed_lines(self):
+        summary = events.parse(
+            _lines({'event': 'task', 'task': 'setup', 'time': 1.0}) +
+            ['{"event": "result", "ho'])
+
+        assert summary == {
+            'hosts': {},
+            'tasks': [{'task': 'setup', 'duration': 0.0}],
+        }
@@ -0,0 +1,219 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import pytest
+
+from kostyor_openstack_ansible import inventory
+
+from .common import get_fixture
+
+
+class TestInventoryIndex(object):
+
+    _inventory = get_fixture('dynamic_inventory.json')
+
+    # Both index classes must behave the same, so they share test cases.
+    @pytest.fixture(params=['InventoryIndex', 'MappedInventoryIndex'])
+    def make_index(self, request, tmpdir):
+        def make(data):
+            if request.param == 'InventoryIndex':
+                return inventory.InventoryIndex(data)
+
+            path = tmpdir.join('openstack_inventory.json')
+            path.write(json.dumps(data))
+            inventory.build_index(str(path), str(tmpdir.join('index')))
+
+            index = inventory.MappedInventoryIndex(str(tmpdir.join('index')))
+            request.addfinalizer(index.close)
+            return index
+        return make
+
+    @pytest.fixture
+    def index(self, make_index):
+        return make_index(self._inventory)
+
+    def test_get_group_hosts(self, index):
+        assert index.get_group_hosts('horizon') == set([
+            'infra1_horizon_container-afb604da',
+            'infra2_horizon_container-b7a45742',
+            'infra3_horizon_container-364cb921',
+        ])
+
+    def test_get_group_hosts_includes_children(self, index):
+        assert 'compute1' in index.get_group_hosts('nova_all')
+
+    def test_get_group_hosts_unknown_group(self, index):
+        assert index.get_group_hosts('unknown_group') is None
+
+    def test_get_group_hosts_plain_list(self, make_index):
+        index = make_index({'group': ['host-1', 'host-2']})
+
+        assert index.get_group_hosts('group') == set(['host-1', 'host-2'])
+
+    def test_get_host_vars(self, index):
+        variables = index.get_host_vars('infra1')
+
+        assert variables['container_types'] == 'infra1-host_containers'
+        assert variables['physical_host'] == 'infra1'
+
+    def test_get_host_vars_unknown_host(self, index):
+        assert index.get_host_vars('infra42') == {}
+
+    def test_get_hosts(self, index):
+        hosts = index.get_hosts()
+
+        assert hosts == sorted(hosts)
+        assert 'infra1' in hosts
+        assert 'infra1_horizon_container-afb604da' in hosts
+
+    def test_has_host(self, index):
+        assert index.has_host('infra1')
+        assert not index.has_host('infra42')
+
+    def test_hosts_without_vars(self, make_index):
+        index = make_index({
+            'group': ['host-1'],
+            '_meta': {'hostvars': {'host-2': {}}},
+        })
+
+        assert index.get_hosts() == ['host-1', 'host-2']
+        assert index.has_host('host-1')
+        assert index.has_host('host-2')
+
+
+class TestLoad(object):
+
+    _inventory = get_fixture('dynamic_inventory.json')
+
+    def test_load_is_cached(self, tmpdir):
+        path = tmpdir.join('openstack_inventory.json')
+        path.write(json.dumps(self._inventory))
+
+        assert inventory.load(str(path)) is inventory.load(str(path))
+
+    def test_load_reloads_modified(self, tmpdir):
+        path = tmpdir.join('openstack_inventory.json')
+        path.write(json.dumps(self._inventory))
+        index = inventory.load(str(path))
+
+        path.write(json.dumps({'group': ['host-1']}))
+        path.setmtime(path.mtime() + 10)
+
+        assert inventory.load(str(path)) is not index
+        assert inventory.load(str(path)).get_group_hosts('group') == set([
+            'host-1',
+        ])
+
+    def test_load_source_json(self, tmpdir):
+        path = tmpdir.join('inventory.json')
+        path.write(json.dumps(self._inventory))
+
+        assert inventory.load_source(str(path)) is inventory.load(str(path))
+
+    def test_load_source_script(self, tmpdir):
+        path = tmpdir.join('inventory.sh')
+        path.write('\n'.join([
+            '#!/bin/sh',
+            'echo "{\\"$OSA_CONFIG_DIR\\": [\\"$1\\"]}"',
+        ]))
+        path.chmod(0o755)
+
+        index = inventory.load_source(str(path), '/srv/openstack_deploy')
+
+        assert index.get_group_hosts('/srv/openstack_deploy') == set([
+            '--list',
+        ])
+
+
+class TestMappedIndex(object):
+
+    _inventory = get_fixture('dynamic_inventory.json')
+
+    @pytest.fixture(autouse=True)
+    def use_index_dir(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(
+            inventory, '_INDEX_DIR', str(tmpdir.mkdir('index')))
+        monkeypatch.setattr(inventory, '_CACHE', {})
+
+    @pytest.fixture
+    def path(self, tmpdir):
+        path = tmpdir.join('openstack_inventory.json')
+        path.write(json.dumps(self._inventory))
+        return path
+
+    def test_load(self, path):
+        index = inventory.load(str(path))
+        expected = inventory.InventoryIndex(self._inventory)
+
+        assert isinstance(index, inventory.MappedInventoryIndex)
+        assert index.get_hosts() == expected.get_hosts()
+
+        for host in expected.get_hosts():
+            assert index.has_host(host)
+            assert index.get_host_vars(host) == dict(
+                (name, value)
+                for name, value in expected.get_host_vars(host).items()
+                if name in inventory._INDEX_VARS)
+
+        for group in self._inventory:
+            assert index.get_group_hosts(group) == \
+                expected.get_group_hosts(group)
+
+    def test_load_unknown(self, path):
+        index = inventory.load(str(path))
+
+        assert not index.has_host('infra42')
+        assert index.get_host_vars('infra42') == {}
+        assert index.get_group_hosts('unknown_group') is None
+
+    def test_load_is_cached(self, path):
+        assert inventory.load(str(path)) is inventory.load(str(path))
+
+    def test_load_reuses_index_file(self, path, monkeypatch):
+        inventory.load(str(path))
+        monkeypatch.setattr(inventory, '_CACHE', {})
+
+        def build_index(*args):
+            pytest.fail('index is rebuilt')
+
+        monkeypatch.setattr(inventory, 'build_index', build_index)
+
+        assert inventory.load(str(path)).has_host('infra1')
+
+    def test_load_rebuilds_modified(self, path):
+        index = inventory.load(str(path))
+
+        path.write(json.dumps({'group': ['host-1']}))
+        path.setmtime(path.mtime() + 10)
+
+        assert inventory.load(str(path)) is not index
+        assert inventory.load(str(path)).get_group_hosts('group') == \
+            frozenset(['host-1'])
+
+        # The stale mapping is released.
+        with pytest.raises(ValueError):
+            index.has_host('infra1')
+
+    def test_load_rebuilds_corrupted(self, path, monkeypatch, tmpdir):
+        inventory.load(str(path))
+        monkeypatch.setattr(inventory, '_CACHE', {})
+
+        for index_path in tmpdir.join('index').listdir():
+            if index_path.ext != '.lock':
+                index_path.write('garbage')
+
+        assert inventory.load(str(path)).has_host('infra1')
@@ -0,0 +1,103 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+
+from kostyor_openstack_ansible import metrics
+
+
+class TestMetrics(object):
+
+    @pytest.fixture(autouse=True)
+    def use_textfile_dir(self, monkeypatch, tmpdir):
+        self.textfile_dir = tmpdir.mkdir('textfile_collector')
+        self.state = tmpdir.join('state', 'metrics')
+
+        monkeypatch.setattr(metrics, '_TEXTFILE_DIR', str(self.textfile_dir))
+        monkeypatch.setattr(metrics, '_STATE', str(self.state))
+
+    def _read(self):
+        return self.textfile_dir.join(metrics._TEXTFILE).read().splitlines()
+
+    def test_disabled_without_textfile_dir(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(
+            metrics, '_TEXTFILE_DIR', str(tmpdir.join('not-exist')))
+
+        metrics.inc('hosts_total')
+
+        assert not os.path.exists(str(self.state) + '.json')
+
+    def test_inc(self):
+        metrics.inc('hosts_total', 3, playbook='os-nova-install.yml')
+        metrics.inc('hosts_total', 2, playbook='os-nova-install.yml')
+        metrics.inc('cache_hits_total')
+
+        assert self._read() == [
+            '# TYPE kostyor_openstack_ansible_cache_hits_total counter',
+            'kostyor_openstack_ansible_cache_hits_total 1',
+            '# TYPE kostyor_openstack_ansible_hosts_total counter',
+            'kostyor_openstack_ansible_hosts_total'
+            '{playbook="os-nova-install.yml"} 5',
+        ]
+
+    def test_observe(self, monkeypatch):
+        monkeypatch.setattr(metrics, '_BUCKETS', (1.0, 10.0))
+
+        metrics.observe('duration_seconds', 0.5)
+        metrics.observe('duration_seconds', 5.0)
+        metrics.observe('duration_seconds', 50.0)
+
+        assert self._read() == [
+            '# TYPE kostyor_openstack_ansible_duration_seconds histogram',
+            'kostyor_openstack_ansible_duration_seconds_bucket{le="1.0"} 1',
+            'kostyor_openstack_ansible_duration_seconds_bucket{le="10.0"} 2',
+            'kostyor_openstack_ansible_duration_seconds_bucket{le="+Inf"} 3',
+            'kostyor_openstack_ansible_duration_seconds_sum 55.5',
+            'kostyor_openstack_ansible_duration_seconds_count 3',
+        ]
+
+    def test_timed_counts_failures(self):
+        with pytest.raises(ValueError):
+            with metrics.timed('playbook', playbook='os-nova-install.yml'):
+                raise ValueError()
+
+        lines = self._read()
+
+        assert (
+            'kostyor_openstack_ansible_playbook_failures_total'
+            '{playbook="os-nova-install.yml"} 1'
+        ) in lines
+        assert (
+            'kostyor_openstack_ansible_playbook_duration_seconds_count'
+            '{playbook="os-nova-install.yml"} 1'
+        ) in lines
+
+    def test_timed_decorator(self):
+        @metrics.timed('discovery')
+        def discover():
+            return 42
+
+        assert discover() == 42
+        assert 'kostyor_openstack_ansible_discovery_duration_seconds_count 1' \
+            in self._read()
+
+    def test_escape_labels(self):
+        metrics.inc('hosts_total', playbook='a "quoted"\nname')
+
+        assert self._read()[1] == (
+            'kostyor_openstack_ansible_hosts_total'
+            '{playbook="a \\"quoted\\"\\nname"} 1')
@@ -0,0 +1,99 @@
+# This file is part of OpenStack Ansible driver for Kostyor.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from kostyor_openstack_ansible import tracing
+
+from .common import read_trace
+
+
+class TestTracing(object):
+
+    @pytest.fixture(autouse=True)
+    def use_trace_dir(self, monkeypatch, tmpdir):
+        self.trace_dir = tmpdir
+        monkeypatch.setattr(tracing, '_TRACE_DIR', str(tmpdir))
+
+    def _read(self, context):
+        return read_trace(self.trace_dir.join(context['trace_id'] + '.json'))
+
+    def test_disabled_without_trace_dir(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(
+            tracing, '_TRACE_DIR', str(tmpdir.join('not-exist')))
+
+        assert tracing.new_context() is None
+        with tracing.span('start', {'trace_id': 'abc'}):
+            assert tracing.get_context() is None
+
+    def test_nothing_traced_without_context(self):
+        with tracing.span('start'):
+            assert tracing.get_context() is None
+
+        assert self.trace_dir.listdir() == []
+
+    def test_nested_spans(self):
+        context = tracing.new_context()
+
+        with tracing.span('start', context, service='nova-api'):
+            with tracing.span('limit_resolution'):
+                pass
+
+        inner, outer = self._read(context)
+
+        assert outer['name'] == 'start'
+        assert outer['ph'] == 'X'
+        assert outer['args']['service'] == 'nova-api'
+        assert outer['args']['parent_id'] is None
+        assert inner['name'] == 'limit_resolution'
+        assert inner['args']['parent_id'] == outer['args']['span_id']
+        assert outer['ts'] <= inner['ts']
+        assert inner['dur'] <= outer['dur']
+
+    def test_context_passed_to_task(self):
+        context = tracing.new_context()
+
+        @tracing.span('task')
+        def task(trace=None):
+            return 42
+
+        with tracing.span('start', context):
+            trace = tracing.get_context()
+
+        assert task(trace=trace) == 42
+
+        start, queued, task = self._read(context)
+
+        assert queued['name'] == 'queued'
+        assert queued['args']['parent_id'] == start['args']['span_id']
+        assert task['name'] == 'task'
+        assert task['args']['parent_id'] == start['args']['span_id']
+
+    def test_span_records_error(self):
+        context = tracing.new_context()
+
+        with pytest.raises(ValueError):
+            with tracing.span('playbook', context):
+                raise ValueError()
+
+        assert self._read(context)[0]['args']['error'] == 'ValueError'
+
+    def test_unclosed_spans_are_discarded(self):
+        context = tracing.new_context()
+
+        with tracing.span('playbook', context):
+            tracing.span('task').__enter__()
+
+        assert tracing.get_context() is None
@@ -13,18 +13,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import os
 import sys
 
 import mock
 import pytest
 
 from kostyor.rpc import app, tasks
-from kostyor_openstack_ansible.upgrades import alt
+from kostyor_openstack_ansible import inventory, tracing
+from kostyor_openstack_ansible.upgrades import alt, base
 
-from ..common import get_fixture, get_inventory_instance, get_hosts
+from ..common import UsesStateDir, get_fixture, get_hosts, read_trace
 
 
-class TestDriver(object):
+class TestDriver(UsesStateDir):
 
     _inventory = get_fixture('dynamic_inventory.json')
 
@@ -35,15 +38,16 @@ class TestDriver(object):
     @pytest.fixture(autouse=True)
     def use_fake_inventory(self, monkeypatch):
         monkeypatch.setattr(
-            'kostyor_openstack_ansible.upgrades.alt.Inventory',
+            'kostyor_openstack_ansible.upgrades.alt.inventory.load',
             mock.Mock(
-                return_value=get_inventory_instance(self._inventory)
+                return_value=inventory.InventoryIndex(self._inventory)
             )
         )
 
     @pytest.fixture(autouse=True)
     def use_fake_popen(self, monkeypatch):
-        self.popen = mock.Mock()
+        self.limit = None
+        self.popen = mock.Mock(side_effect=self._read_limit)
         self.popen.return_value.returncode = 0
 
         monkeypatch.setattr(
@@ -52,6 +56,14 @@ class TestDriver(object):
             self.popen
         )
 
+    def _read_limit(self, args, **kwargs):
+        # Limit file is removed right after the execution, so we need to
+        # read it while the command is running.
+        if '-l' in args:
+            with open(args[args.index('-l') + 1][1:]) as fp:
+                self.limit = fp.read().split('\n')
+        return mock.DEFAULT
+
     def setup(self):
         self.driver = alt.Driver()
 
@@ -108,6 +120,43 @@ class TestDriver(object):
                 cwd='/opt/openstack-ansible/playbooks'),
         ]
 
+    @mock.patch('kostyor.rpc.tasks.execute.si', return_value=tasks.noop.si())
+    def test_pre_upgrade_checks_reachability(self, execute, monkeypatch):
+        run_adhoc = mock.Mock(return_value={})
+        monkeypatch.setattr(
+            'kostyor_openstack_ansible.upgrades.alt.adhoc.run', run_adhoc)
+        monkeypatch.setattr(self.driver, '_preflight_forks', 100)
+
+        with pytest.raises(Exception) as excinfo:
+            self.driver.pre_upgrade()()
+
+        run_adhoc.assert_called_once_with(mock.ANY, 'ping', forks=100)
+        assert 'infra1_horizon_container-afb604da' in run_adhoc.call_args[0][0]
+        assert str(excinfo.value).startswith('Hosts are unreachable: ')
+
+        # Nothing else is executed if some hosts are unreachable.
+        assert self.popen.call_args_list == []
+
+    def test_pre_stage(self, monkeypatch):
+        hosts = inventory.InventoryIndex(self._inventory).get_hosts()
+        limits = []
+        monkeypatch.setattr(self.driver, '_prestage_batch', 10)
+
+        def read_limit(args, **kwargs):
+            self._read_limit(args)
+            limits.extend(self.limit)
+            return mock.DEFAULT
+
+        self.popen.side_effect = read_limit
+        self.driver.pre_stage().apply().get()
+
+        assert self.popen.call_count == (len(hosts) + 9) // 10
+        assert self.popen.call_args == mock.call(
+            ['/usr/local/bin/openstack-ansible', base._PRESTAGE_PLAYBOOK,
+             '-l', mock.ANY],
+            cwd='/opt/openstack-ansible/playbooks')
+        assert sorted(limits) == hosts
+
     def test_start_runs_playbook(self):
         self.driver.start({'name': 'nova-compute'}, get_hosts('compute1'))()
 
@@ -116,11 +165,16 @@ class TestDriver(object):
                 '/usr/local/bin/openstack-ansible',
                 '/opt/openstack-ansible/playbooks/os-nova-install.yml',
                 '-l',
-                'compute1',
+                mock.ANY,
+                '--skip-tags',
+                'nova-db-setup,nova-service-add',
             ],
             cwd=None,
         )
 
+        assert self.popen.call_args[0][0][3].startswith('@')
+        assert self.limit == ['compute1']
+
     def test_start_runs_playbook_on_few_hosts(self):
         self.driver.start(
             {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
@@ -130,14 +184,16 @@ class TestDriver(object):
                 '/usr/local/bin/openstack-ansible',
                 '/opt/openstack-ansible/playbooks/os-horizon-install.yml',
                 '-l',
-                ','.join([
-                    'infra1_horizon_container-afb604da',
-                    'infra2_horizon_container-b7a45742',
-                ]),
+                mock.ANY,
             ],
             cwd=None,
         )
 
+        assert self.limit == [
+            'infra1_horizon_container-afb604da',
+            'infra2_horizon_container-b7a45742',
+        ]
+
     def test_start_upgrade_runs_playbook_once_on_one_host(self):
         hosts = get_hosts('infra2')
 
@@ -150,7 +206,7 @@ class TestDriver(object):
             '-l',
         ]
 
-        assert set(self.popen.call_args[0][0][3].split(',')) == set([
+        assert set(self.limit) == set([
             'infra2_nova_api_metadata_container-a542f3a5',
             'infra2_nova_api_os_compute_container-d088a5c5',
             'infra2_nova_cert_container-f4bebee6',
@@ -173,7 +229,7 @@ class TestDriver(object):
             '-l',
         ]
 
-        assert set(self.popen.call_args[0][0][3].split(',')) == set([
+        assert set(self.limit) == set([
             'infra2_nova_api_metadata_container-a542f3a5',
             'infra2_nova_api_os_compute_container-d088a5c5',
             'infra2_nova_cert_container-f4bebee6',
@@ -182,6 +238,595 @@ class TestDriver(object):
             'infra2_nova_scheduler_container-ea104a41',
         ])
 
+    def test_start_runs_playbook_with_tags(self, monkeypatch):
+        monkeypatch.setitem(
+            self.driver._tags, 'horizon-wsgi', ['horizon-config'])
+
+        self.driver.start({'name': 'horizon-wsgi'}, get_hosts('infra1'))()
+
+        assert self.popen.call_args[0][0][4:] == [
+            '--tags', 'horizon-config',
+        ]
+
+    def test_start_runs_unscoped_playbook_after_scoped(self):
+        hosts = get_hosts('compute1')
+
+        self.driver.start({'name': 'nova-compute'}, hosts)()
+        self.driver.start({'name': 'nova-api-os-compute'}, hosts)()
+
+        assert self.popen.call_count == 2
+        assert self.popen.call_args[0][0][4:] == []
+
+    def test_start_skips_scoped_playbook_after_unscoped(self):
+        hosts = get_hosts('compute1')
+
+        self.driver.start({'name': 'nova-api-os-compute'}, hosts)()
+        self.driver.start({'name': 'nova-compute'}, hosts)()
+
+        assert self.popen.call_count == 1
+
+    def test_start_skips_upgraded_hosts(self, monkeypatch):
+        def probe(args, **kwargs):
+            if args[0] == '/usr/local/bin/ansible':
+                tree = args[args.index('--tree') + 1]
+
+                with open(os.path.join(tree, 'infra1_horizon_container-'
+                                             'afb604da'), 'w') as fp:
+                    json.dump({
+                        'ansible_facts': {
+                            'ansible_local': {
+                                'openstack_ansible': {
+                                    'horizon': {'venv_tag': '14.2.0'},
+                                },
+                            },
+                        },
+                    }, fp)
+            return self._read_limit(args, **kwargs)
+
+        monkeypatch.setattr(self.driver, '_release', '14.2.0')
+        self.popen.side_effect = probe
+
+        self.driver.start(
+            {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert self.popen.call_count == 2
+        assert self.popen.call_args_list[0][0][0][4:6] == [
+            '-m', 'setup',
+        ]
+        assert self.limit == ['infra2_horizon_container-b7a45742']
+
+    def test_start_skips_playbook_if_all_hosts_upgraded(self, monkeypatch):
+        monkeypatch.setattr(self.driver, '_release', '14.2.0')
+        monkeypatch.setattr(
+            'kostyor_openstack_ansible.upgrades.base.get_upgraded_hosts',
+            mock.Mock(return_value=set(['compute1'])))
+
+        self.driver.start({'name': 'nova-compute'}, get_hosts('compute1'))()
+
+        assert self.popen.call_count == 1
+        assert self.popen.call_args[0][0][0] == '/usr/local/bin/ansible'
+
+    def test_start_runs_playbook_in_windows(self):
+        limits = []
+
+        def read_limit(args, **kwargs):
+            self._read_limit(args, **kwargs)
+            limits.append(self.limit)
+            return mock.DEFAULT
+
+        self.popen.side_effect = read_limit
+        self.driver.start(
+            {'name': 'neutron-l3-agent'}, get_hosts('infra1', 'compute1'))()
+
+        assert limits == [
+            [
+                'infra1_neutron_agents_container-3f82e912',
+                'infra1_neutron_server_container-bcfcdba9',
+            ],
+            ['compute1'],
+        ]
+
+    def test_start_runs_canary_first(self, monkeypatch):
+        calls = []
+
+        def read_limit(args, **kwargs):
+            self._read_limit(args, **kwargs)
+            calls.append((args[1], self.limit))
+            return mock.DEFAULT
+
+        monkeypatch.setitem(
+            self.driver._canaries, 'horizon-wsgi', 'healthcheck.yml')
+        self.popen.side_effect = read_limit
+
+        self.driver.start(
+            {'name': 'horizon-wsgi'},
+            get_hosts('infra1', 'infra2', 'infra3'))()
+
+        assert calls == [
+            (
+                '/opt/openstack-ansible/playbooks/os-horizon-install.yml',
+                ['infra1_horizon_container-afb604da'],
+            ),
+            (
+                '/opt/openstack-ansible/playbooks/healthcheck.yml',
+                ['infra1_horizon_container-afb604da'],
+            ),
+            (
+                '/opt/openstack-ansible/playbooks/os-horizon-install.yml',
+                [
+                    'infra2_horizon_container-b7a45742',
+                    'infra3_horizon_container-364cb921',
+                ],
+            ),
+        ]
+
+    def test_start_rolls_windows_after_canary(self, monkeypatch):
+        monkeypatch.setitem(self.driver._canaries, 'horizon-wsgi', None)
+        monkeypatch.setitem(self.driver._windows, 'horizon-wsgi', 1)
+        self.popen.return_value.returncode = 0
+
+        def fail_on_infra2(args, **kwargs):
+            self._read_limit(args, **kwargs)
+            if self.limit == ['infra2_horizon_container-b7a45742']:
+                self.popen.return_value.returncode = 2
+            return mock.DEFAULT
+
+        self.popen.side_effect = fail_on_infra2
+
+        with pytest.raises(Exception):
+            self.driver.start(
+                {'name': 'horizon-wsgi'},
+                get_hosts('infra1', 'infra2', 'infra3'))()
+
+        # The window of infra3 is not started, since the previous one
+        # is failed.
+        assert self.popen.call_count == 2
+        assert self.limit == ['infra2_horizon_container-b7a45742']
+
+    def test_start_stops_on_canary_failure(self, monkeypatch):
+        monkeypatch.setitem(self.driver._canaries, 'horizon-wsgi', None)
+        self.popen.return_value.returncode = 2
+
+        with pytest.raises(Exception):
+            self.driver.start(
+                {'name': 'horizon-wsgi'},
+                get_hosts('infra1', 'infra2', 'infra3'))()
+
+        assert self.popen.call_count == 1
+        assert self.limit == ['infra1_horizon_container-afb604da']
+
+    def test_schedule_respects_dependencies(self):
+        self.driver.schedule([
+            ({'name': 'horizon-wsgi'}, get_hosts('infra1')),
+            ({'name': 'keystone-wsgi-admin'}, get_hosts('infra1')),
+        ])()
+
+        assert [args[0][0][1] for args in self.popen.call_args_list] == [
+            '/opt/openstack-ansible/playbooks/os-keystone-install.yml',
+            '/opt/openstack-ansible/playbooks/os-horizon-install.yml',
+        ]
+
+    def _fail_hosts(self, *failed):
+        def write_events(args, **kwargs):
+            self._read_limit(args, **kwargs)
+
+            with open(os.environ['KOSTYOR_EVENTS_FILE'], 'a') as fp:
+                for host in self.limit:
+                    fp.write(json.dumps({
+                        'event': 'result',
+                        'host': host,
+                        'status': 'failed' if host in failed else 'ok',
+                        'time': 1.0,
+                    }) + '\n')
+
+            # Just like Ansible does, failed hosts are written to retry file.
+            if os.environ.get('ANSIBLE_RETRY_FILES_ENABLED') == 'True':
+                save_path = os.environ['ANSIBLE_RETRY_FILES_SAVE_PATH']
+                if not os.path.isdir(save_path):
+                    os.makedirs(save_path)
+                name = os.path.splitext(os.path.basename(args[1]))[0]
+                with open(os.path.join(save_path, name + '.retry'), 'w') as fp:
+                    fp.write(''.join(host + '\n' for host in failed))
+            return mock.DEFAULT
+
+        self.popen.side_effect = write_events
+        self.popen.return_value.returncode = 2
+
+    def test_start_quarantines_failed_nodes(self, monkeypatch):
+        monkeypatch.setattr(self.driver, '_quarantine', 1)
+        self._fail_hosts('infra1_horizon_container-afb604da')
+
+        result = self.driver.start(
+            {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))().get()
+
+        assert result['quarantined'] == ['infra1']
+        assert list(base.get_quarantined()) == ['infra1']
+
+        # The task has succeeded, so nothing is left to retry.
+        assert not os.path.exists(base.get_retry_file(
+            'os-horizon-install.yml', [
+                'infra1_horizon_container-afb604da',
+                'infra2_horizon_container-b7a45742',
+            ]))
+
+        # Quarantined nodes are excluded from subsequent steps.
+        self.popen.side_effect = self._read_limit
+        self.popen.return_value.returncode = 0
+        self.driver.start(
+            {'name': 'nova-api'}, get_hosts('infra1', 'infra2'))()
+
+        assert all(host.startswith('infra2') for host in self.limit)
+
+    def test_start_fails_if_quarantine_is_full(self, monkeypatch):
+        monkeypatch.setattr(self.driver, '_quarantine', 1)
+        self._fail_hosts(
+            'infra1_horizon_container-afb604da',
+            'infra2_horizon_container-b7a45742')
+
+        with pytest.raises(Exception):
+            self.driver.start(
+                {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert base.get_quarantined() == {}
+
+    def test_start_never_quarantines_canary(self, monkeypatch):
+        monkeypatch.setattr(self.driver, '_quarantine', 1)
+        monkeypatch.setitem(self.driver._canaries, 'horizon-wsgi', None)
+        self._fail_hosts('infra1_horizon_container-afb604da')
+
+        with pytest.raises(Exception):
+            self.driver.start(
+                {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert base.get_quarantined() == {}
+
+    def test_start_fails_if_canary_is_quarantined(self, monkeypatch):
+        monkeypatch.setattr(self.driver, '_quarantine', 1)
+        monkeypatch.setitem(
+            self.driver._canaries, 'horizon-wsgi', 'healthcheck.yml')
+        base.quarantine('os-horizon-install.yml', ['infra1'], 1)
+
+        with pytest.raises(Exception) as excinfo:
+            self.driver.start(
+                {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert str(excinfo.value) == 'Canary nodes are quarantined: infra1'
+        assert self.popen.call_args_list == []
+
+    def test_schedule_reports_quarantined_nodes(self, monkeypatch):
+        monkeypatch.setattr(self.driver, '_quarantine', 1)
+        self._fail_hosts('infra1_horizon_container-afb604da')
+
+        result = self.driver.schedule([
+            ({'name': 'horizon-wsgi'}, get_hosts('infra1')),
+        ])().get()
+
+        assert result == {
+            'infra1': {'playbook': 'os-horizon-install.yml', 'time': mock.ANY},
+        }
+
+    def test_release_quarantined(self):
+        base.quarantine('os-horizon-install.yml', ['infra1', 'infra2'], 2)
+
+        self.driver.release_quarantined(get_hosts('infra1'))()
+
+        assert list(base.get_quarantined()) == ['infra2']
+
+    @mock.patch('kostyor.rpc.tasks.execute.si', return_value=tasks.noop.si())
+    def test_pre_upgrade_resets_quarantine(self, execute):
+        base.quarantine('os-horizon-install.yml', ['infra1'], 1)
+
+        self.driver.pre_upgrade()()
+
+        assert base.get_quarantined() == {}
+
+    def test_start_runs_playbook_in_adaptive_batches(self, monkeypatch):
+        limits = []
+
+        def read_limit(args, **kwargs):
+            self._read_limit(args, **kwargs)
+            limits.append(self.limit)
+            return mock.DEFAULT
+
+        monkeypatch.setitem(
+            self.driver._batching,
+            'horizon-wsgi',
+            {'target': 3600, 'min': 1, 'max': 2})
+        self.popen.side_effect = read_limit
+
+        result = self.driver.start(
+            {'name': 'horizon-wsgi'},
+            get_hosts('infra1', 'infra2', 'infra3'))().get()
+
+        assert limits == [
+            ['infra1_horizon_container-afb604da'],
+            [
+                'infra2_horizon_container-b7a45742',
+                'infra3_horizon_container-364cb921',
+            ],
+        ]
+        assert [batch['nodes'] for batch in result['batches']] == [
+            ['infra1'],
+            ['infra2', 'infra3'],
+        ]
+
+    def test_start_records_playbook_duration(self):
+        self.driver.start(
+            {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert base.get_durations('os-horizon-install.yml') == [
+            {'nodes': 2, 'duration': mock.ANY},
+        ]
+
+    def test_run_playbook_reports_saved_time(self):
+        def write_events(args, **kwargs):
+            with open(os.environ['KOSTYOR_EVENTS_FILE'], 'a') as fp:
+                for host in ('infra1', 'infra1_horizon_container-afb604da',
+                             'infra2'):
+                    fp.write(json.dumps({
+                        'event': 'result', 'host': host, 'status': 'ok',
+                        'time': 1.0,
+                    }) + '\n')
+            return mock.DEFAULT
+
+        self.popen.side_effect = write_events
+        base.record_duration('pip-conf-removal.yml', 1, 30.0)
+
+        result = alt._run_playbook.si(
+            '/opt/openstack-ansible/scripts/upgrade-utilities/playbooks'
+            '/pip-conf-removal.yml',
+            facts={'gather_subset': '!all'})().get()
+
+        assert 59.0 < result['saved'] <= 60.0
+        assert base.get_durations('pip-conf-removal.yml')[-1] == {
+            'nodes': 2,
+            'duration': mock.ANY,
+            'facts': {'gather_subset': '!all'},
+            'saved': result['saved'],
+        }
+
+    def test_start_returns_playbook_summary(self):
+        def write_events(args, **kwargs):
+            self._read_limit(args, **kwargs)
+
+            # Ansible is told to write events via environment, and the
+            # callback plugin is expected to be found by Ansible.
+            assert 'kostyor_events' in \
+                os.environ['ANSIBLE_CALLBACK_WHITELIST'].split(',')
+
+            with open(os.environ['KOSTYOR_EVENTS_FILE'], 'a') as fp:
+                for event in [
+                    {'event': 'task', 'task': 'setup', 'time': 1.0},
+                    {'event': 'result', 'host': self.limit[0],
+                     'status': 'changed', 'time': 2.0},
+                    {'event': 'stats', 'time': 3.0},
+                ]:
+                    fp.write(json.dumps(event) + '\n')
+            return mock.DEFAULT
+
+        self.popen.side_effect = write_events
+
+        result = self.driver.start(
+            {'name': 'horizon-wsgi'}, get_hosts('infra1'))().get()
+
+        assert result == {
+            'hosts': {
+                'infra1_horizon_container-afb604da': {
+                    'ok': 1, 'changed': 1, 'failed': 0, 'unreachable': 0,
+                    'skipped': 0,
+                },
+            },
+            'tasks': [{'task': 'setup', 'duration': 2.0}],
+        }
+        assert 'KOSTYOR_EVENTS_FILE' not in os.environ
+
+    def test_start_uses_accelerated_strategy(self, monkeypatch, tmpdir):
+        environ = {}
+
+        def read_environ(args, **kwargs):
+            environ.update(os.environ)
+            return mock.DEFAULT
+
+        tmpdir.join('mitogen_linear.py').write('')
+        monkeypatch.setattr(self.driver, '_strategy', {
+            'name': 'mitogen_linear', 'plugins': str(tmpdir)})
+        monkeypatch.delenv('ANSIBLE_STRATEGY_PLUGINS', raising=False)
+        self.popen.side_effect = read_environ
+
+        self.driver.start({'name': 'horizon-wsgi'}, get_hosts('infra1'))()
+
+        assert environ['ANSIBLE_STRATEGY'] == 'mitogen_linear'
+        assert environ['ANSIBLE_STRATEGY_PLUGINS'] == str(tmpdir)
+        assert 'ANSIBLE_STRATEGY' not in os.environ
+
+    def test_start_falls_back_to_default_strategy(self, monkeypatch, tmpdir):
+        environ = {}
+
+        def read_environ(args, **kwargs):
+            environ.update(os.environ)
+            return mock.DEFAULT
+
+        monkeypatch.setattr(self.driver, '_strategy', {
+            'name': 'mitogen_linear', 'plugins': str(tmpdir)})
+        monkeypatch.delenv('ANSIBLE_STRATEGY', raising=False)
+        self.popen.side_effect = read_environ
+
+        self.driver.start({'name': 'horizon-wsgi'}, get_hosts('infra1'))()
+
+        assert 'ANSIBLE_STRATEGY' not in environ
+
+    def test_start_restricts_fact_gathering(self, monkeypatch):
+        environ = {}
+
+        def read_environ(args, **kwargs):
+            environ.update(os.environ)
+            return mock.DEFAULT
+
+        monkeypatch.setitem(
+            self.driver._facts,
+            'os-horizon-install.yml',
+            {'gather_subset': '!all', 'gather_timeout': 5})
+        self.popen.side_effect = read_environ
+
+        self.driver.start({'name': 'horizon-wsgi'}, get_hosts('infra1'))()
+
+        assert environ['ANSIBLE_GATHER_SUBSET'] == '!all'
+        assert environ['ANSIBLE_GATHER_TIMEOUT'] == '5'
+        assert 'ANSIBLE_GATHER_SUBSET' not in os.environ
+        assert base.get_durations('os-horizon-install.yml') == [
+            {
+                'nodes': 1,
+                'duration': mock.ANY,
+                'facts': {'gather_subset': '!all', 'gather_timeout': 5},
+            },
+        ]
+
+    def test_start_is_traced(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(tracing, '_TRACE_DIR', str(tmpdir))
+        driver = alt.Driver()
+
+        driver.start({'name': 'horizon-wsgi'}, get_hosts('infra1'))()
+
+        trace = read_trace(tmpdir.join(driver._trace['trace_id'] + '.json'))
+        spans = dict((event['name'], event) for event in trace)
+
+        assert set(spans) == set([
+            'start',
+            'queued',
+            '_run_playbook_for',
+            'limit_resolution',
+            'playbook',
+        ])
+        assert spans['playbook']['args']['playbook'] == \
+            'os-horizon-install.yml'
+        assert spans['_run_playbook_for']['args']['parent_id'] == \
+            spans['start']['args']['span_id']
+
+    def test_start_uses_cluster_deployment(self, monkeypatch):
+        environ = {}
+
+        def read_environ(args, **kwargs):
+            environ.update(os.environ)
+            return mock.DEFAULT
+
+        hosts = get_hosts('infra1')
+        monkeypatch.setitem(self.driver._clusters, hosts[0]['cluster_id'], {
+            'root': '/srv/cluster-a/openstack-ansible',
+            'deploy': '/srv/cluster-a/openstack_deploy',
+        })
+        self.popen.side_effect = read_environ
+
+        self.driver.start({'name': 'horizon-wsgi'}, hosts)()
+
+        assert self.popen.call_args[0][0][1] == (
+            '/srv/cluster-a/openstack-ansible/playbooks'
+            '/os-horizon-install.yml')
+        assert environ['OSA_CONFIG_DIR'] == '/srv/cluster-a/openstack_deploy'
+        assert 'ANSIBLE_INVENTORY' not in environ
+        alt.inventory.load.assert_called_once_with(
+            '/srv/cluster-a/openstack_deploy/openstack_inventory.json')
+
+    def test_start_uses_cluster_inventory_source(self, monkeypatch):
+        hosts = get_hosts('infra1')
+        monkeypatch.setitem(self.driver._clusters, hosts[0]['cluster_id'], {
+            'deploy': '/srv/cluster-a/openstack_deploy',
+            'inventory': '/srv/cluster-a/inventory.py',
+        })
+        monkeypatch.setattr(alt.inventory, 'load_source', mock.Mock(
+            return_value=inventory.InventoryIndex(self._inventory)))
+
+        self.driver.start({'name': 'horizon-wsgi'}, hosts)()
+
+        # Limits are resolved against the inventory Ansible is executed
+        # against.
+        alt.inventory.load_source.assert_called_once_with(
+            '/srv/cluster-a/inventory.py', '/srv/cluster-a/openstack_deploy')
+        assert alt.inventory.load.call_count == 0
+        assert self.limit == ['infra1_horizon_container-afb604da']
+
+    @mock.patch('kostyor.rpc.tasks.execute.si', return_value=tasks.noop.si())
+    def test_pre_upgrade_uses_cluster_deployment(self, execute, monkeypatch):
+        monkeypatch.setitem(self.driver._clusters, 'cluster-a', {
+            'root': '/srv/cluster-a/openstack-ansible',
+        })
+        driver = alt.Driver(cluster_id='cluster-a')
+
+        driver.pre_upgrade()()
+
+        execute.assert_called_once_with(
+            '/srv/cluster-a/openstack-ansible/scripts/bootstrap-ansible.sh',
+            cwd='/srv/cluster-a/openstack-ansible')
+        assert self.popen.call_args[1]['cwd'] == \
+            '/srv/cluster-a/openstack-ansible/playbooks'
+
+    def test_estimate(self):
+        base.record_duration('os-keystone-install.yml', 2, 200.0)
+        base.record_duration('os-horizon-install.yml', 1, 50.0)
+
+        estimation = self.driver.estimate([
+            ({'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2')),
+            ({'name': 'keystone-wsgi-admin'}, get_hosts('infra1')),
+        ])().get()
+
+        assert estimation['steps'] == [
+            {
+                'service': 'keystone-wsgi-admin',
+                'playbook': 'os-keystone-install.yml',
+                'nodes': ['infra1'],
+                'duration': 100.0,
+            },
+            {
+                'service': 'horizon-wsgi',
+                'playbook': 'os-horizon-install.yml',
+                'nodes': ['infra1', 'infra2'],
+                'duration': 100.0,
+            },
+        ]
+        assert estimation['stages'] == [100.0, 100.0]
+        assert estimation['total'] == 200.0
+        assert estimation['critical_path'] == 200.0
+        assert estimation['unknown'] == []
+
+    def test_estimate_independent_services(self):
+        base.record_duration('os-glance-install.yml', 1, 100.0)
+        base.record_duration('os-horizon-install.yml', 1, 50.0)
+
+        estimation = self.driver.estimate([
+            ({'name': 'glance-api'}, get_hosts('infra1')),
+            ({'name': 'horizon-wsgi'}, get_hosts('infra1')),
+        ])().get()
+
+        assert estimation['total'] == 150.0
+        assert estimation['critical_path'] == 100.0
+
+    def test_estimate_respects_executed_playbooks(self):
+        base.record_duration('os-nova-install.yml', 1, 100.0)
+        hosts = get_hosts('infra1')
+
+        estimation = self.driver.estimate([
+            ({'name': 'nova-api'}, hosts),
+            ({'name': 'nova-conductor'}, hosts),
+        ])().get()
+
+        assert [step['nodes'] for step in estimation['steps']] == [
+            ['infra1'],
+            [],
+        ]
+        assert estimation['total'] == 100.0
+
+        # Estimation must not affect upcoming upgrades.
+        assert self.driver._executions == {}
+        assert len(hosts) == 1
+
+    def test_estimate_without_history(self):
+        estimation = self.driver.estimate([
+            ({'name': 'horizon-wsgi'}, get_hosts('infra1')),
+        ])().get()
+
+        assert estimation['steps'][0]['duration'] is None
+        assert estimation['unknown'] == ['horizon-wsgi']
+        assert estimation['total'] == 0.0
+
     def test_start_upgrade_skip_not_supported_service(self):
         self.driver.start({'name': 'unknown-service'}, get_hosts('infra1'))()
 
@@ -196,4 +841,35 @@ class TestDriver(object):
         excinfo.match(
             r'Command \'/usr/local/bin/openstack-ansible '
             r'/opt/openstack-ansible/playbooks/os-nova-install.yml -l '
-            r'compute1\' returned non-zero exit status 42\.?')
+            r'@\S+ --skip-tags nova-db-setup,nova-service-add\' '
+            r'returned non-zero exit status 42\.?')
+
+    def test_retry_runs_playbook_on_failed_hosts(self):
+        def fail_on_infra2(args, **kwargs):
+            # That's what Ansible does when playbook is failed on some
+            # hosts and retry files are enabled.
+            retry_dir = os.environ['ANSIBLE_RETRY_FILES_SAVE_PATH']
+            os.makedirs(retry_dir)
+
+            with open(os.path.join(retry_dir, 'os-horizon-install.retry'),
+                      'w') as fp:
+                fp.write('infra2_horizon_container-b7a45742\n')
+
+            assert os.environ['ANSIBLE_RETRY_FILES_ENABLED'] == 'True'
+            return mock.DEFAULT
+
+        self.popen.side_effect = fail_on_infra2
+        self.popen.return_value.returncode = 2
+
+        with pytest.raises(Exception):
+            self.driver.start(
+                {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        self.popen.side_effect = self._read_limit
+        self.popen.return_value.returncode = 0
+        self.driver = alt.Driver()
+        self.driver.start(
+            {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert self.limit == ['infra2_horizon_container-b7a45742']
+        assert 'ANSIBLE_RETRY_FILES_SAVE_PATH' not in os.environ
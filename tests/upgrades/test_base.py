@@ -13,9 +13,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
+
+import mock
+import pytest
+
+from kostyor_openstack_ansible import adhoc, inventory
 from kostyor_openstack_ansible.upgrades import base
 
-from ..common import get_fixture, get_inventory_instance
+from ..common import (
+    UsesStateDir, get_fixture, get_hosts, get_inventory_instance)
 
 
 class TestGetServiceContainersForHost(object):
@@ -91,3 +99,508 @@ class TestGetServiceContainersForHost(object):
         )
 
         assert set([host.get_name() for host in component_hosts]) == set([])
+
+
+class TestGetComponentHostnamesOnNodes(object):
+
+    _inventory = get_fixture('dynamic_inventory.json')
+
+    def setup(self):
+        self.index = inventory.InventoryIndex(self._inventory)
+
+    def test_only_infra1_and_infra2_horizon_container(self):
+        hostnames = base.get_component_hostnames_on_nodes(
+            self.index,
+            {'name': 'horizon-wsgi'},
+            [{'hostname': 'infra1'}, {'hostname': 'infra2'}],
+        )
+
+        assert hostnames == [
+            'infra1_horizon_container-afb604da',
+            'infra2_horizon_container-b7a45742',
+        ]
+
+    def test_only_infra2_nova_containers(self):
+        hostnames = base.get_component_hostnames_on_nodes(
+            self.index,
+            {'name': 'nova-conductor'},
+            [{'hostname': 'infra2'}],
+        )
+
+        assert set(hostnames) == set([
+            'infra2_nova_api_metadata_container-a542f3a5',
+            'infra2_nova_api_os_compute_container-d088a5c5',
+            'infra2_nova_cert_container-f4bebee6',
+            'infra2_nova_conductor_container-c9d5c8ec',
+            'infra2_nova_console_container-14f4435d',
+            'infra2_nova_scheduler_container-ea104a41',
+        ])
+
+    def test_only_compute1_nova_on_host(self):
+        hostnames = base.get_component_hostnames_on_nodes(
+            self.index,
+            {'name': 'nova-compute'},
+            [{'hostname': 'compute1'}],
+        )
+
+        assert hostnames == ['compute1']
+
+    def test_no_keystone_on_compute(self):
+        hostnames = base.get_component_hostnames_on_nodes(
+            self.index,
+            {'name': 'keystone-wsgi-admin'},
+            [{'hostname': 'compute1'}],
+        )
+
+        assert hostnames == []
+
+    def test_hosts_are_resolved_and_timed_once(self, monkeypatch):
+        update = mock.Mock()
+        monkeypatch.setattr(base.metrics, '_update', update)
+
+        component_hosts = base.get_component_hosts_on_nodes(
+            get_inventory_instance(self._inventory),
+            {'name': 'horizon-wsgi'},
+            [{'hostname': 'infra1'}],
+            index=self.index,
+        )
+
+        assert [host.get_name() for host in component_hosts] == [
+            'infra1_horizon_container-afb604da',
+        ]
+        assert update.call_count == 1
+
+
+class TestRetryHosts(UsesStateDir):
+
+    _playbook = '/opt/openstack-ansible/playbooks/os-nova-install.yml'
+
+    def test_no_retry_file(self):
+        hosts = base.pop_retry_hosts(self._playbook, ['host-1', 'host-2'])
+
+        assert hosts == ['host-1', 'host-2']
+
+    def test_narrow_to_failed_hosts(self):
+        base.save_retry_hosts(self._playbook, ['host-1', 'host-2'], ['host-2'])
+        hosts = base.pop_retry_hosts(self._playbook, ['host-1', 'host-2'])
+
+        assert hosts == ['host-2']
+
+    def test_retry_file_is_removed(self):
+        base.save_retry_hosts(self._playbook, ['host-1', 'host-2'], ['host-2'])
+        base.pop_retry_hosts(self._playbook, ['host-1', 'host-2'])
+        hosts = base.pop_retry_hosts(self._playbook, ['host-1', 'host-2'])
+
+        assert hosts == ['host-1', 'host-2']
+
+    def test_retry_file_of_another_limit_is_ignored(self):
+        base.save_retry_hosts(self._playbook, ['host-1', 'host-2'], ['host-2'])
+        hosts = base.pop_retry_hosts(self._playbook, ['host-2', 'host-3'])
+
+        assert hosts == ['host-2', 'host-3']
+
+    def test_retry_file_of_another_release_is_ignored(self):
+        base.save_retry_hosts(
+            self._playbook, ['host-1', 'host-2'], ['host-2'], '14.1.0')
+        hosts = base.pop_retry_hosts(
+            self._playbook, ['host-1', 'host-2'], '14.2.0')
+
+        assert hosts == ['host-1', 'host-2']
+
+    def test_retry_file_of_another_cluster_is_ignored(self):
+        with base.cluster_state('cluster-a'):
+            base.save_retry_hosts(
+                self._playbook, ['host-1', 'host-2'], ['host-2'])
+
+        with base.cluster_state('cluster-b'):
+            hosts = base.pop_retry_hosts(self._playbook, ['host-1', 'host-2'])
+
+        assert hosts == ['host-1', 'host-2']
+
+    def test_expired_retry_file_is_ignored(self, monkeypatch):
+        base.save_retry_hosts(self._playbook, ['host-1', 'host-2'], ['host-2'])
+        monkeypatch.setattr(
+            base.time, 'time',
+            mock.Mock(return_value=time.time() + base._RETRY_TTL + 1))
+        hosts = base.pop_retry_hosts(self._playbook, ['host-1', 'host-2'])
+
+        assert hosts == ['host-1', 'host-2']
+        assert not os.path.exists(
+            base.get_retry_file(self._playbook, ['host-1', 'host-2']))
+
+    def test_purge_retry_hosts(self):
+        base.save_retry_hosts(self._playbook, ['host-1', 'host-2'], ['host-2'])
+        base.purge_retry_hosts()
+        hosts = base.pop_retry_hosts(self._playbook, ['host-1', 'host-2'])
+
+        assert hosts == ['host-1', 'host-2']
+
+    def test_purge_retry_hosts_of_release(self):
+        base.save_retry_hosts(
+            self._playbook, ['host-1', 'host-2'], ['host-2'], '14.1.0')
+        base.save_retry_hosts(
+            self._playbook, ['host-1', 'host-2'], ['host-2'], '14.2.0')
+        base.purge_retry_hosts('14.2.0')
+
+        assert base.pop_retry_hosts(
+            self._playbook, ['host-1', 'host-2'], '14.1.0') == ['host-2']
+        assert base.pop_retry_hosts(
+            self._playbook, ['host-1', 'host-2'], '14.2.0') == [
+                'host-1', 'host-2']
+
+    def test_discard_retry_hosts(self):
+        base.save_retry_hosts(self._playbook, ['host-1', 'host-2'], ['host-2'])
+        base.discard_retry_hosts(self._playbook, ['host-1', 'host-2'])
+        base.discard_retry_hosts(self._playbook, ['host-1', 'host-2'])
+        hosts = base.pop_retry_hosts(self._playbook, ['host-1', 'host-2'])
+
+        assert hosts == ['host-1', 'host-2']
+
+    def test_retry_file_is_ansible_compatible(self):
+        base.save_retry_hosts(self._playbook, ['host-1', 'host-2'], ['host-2'])
+        retry_file = base.get_retry_file(self._playbook, ['host-2', 'host-1'])
+
+        assert retry_file.endswith('/os-nova-install.retry')
+        with open(retry_file) as fp:
+            assert fp.read() == 'host-2\n'
+
+
+class TestGetUpgradedHosts(object):
+
+    def _facts(self, **venv_tags):
+        return adhoc.AdHocResult(
+            {
+                'ansible_facts': {
+                    'ansible_local': {
+                        'openstack_ansible': dict(
+                            (component, {'venv_tag': tag})
+                            for component, tag in venv_tags.items()
+                        ),
+                    },
+                },
+            },
+            0.1,
+        )
+
+    def test_upgraded_hosts(self):
+        upgraded = base.get_upgraded_hosts(
+            {
+                'host-1': self._facts(nova='14.2.0', neutron='14.1.0'),
+                'host-2': self._facts(nova='14.1.0', neutron='14.2.0'),
+                'host-3': adhoc.AdHocResult({'unreachable': True}, 10.0),
+            },
+            {'name': 'nova-compute'},
+            '14.2.0',
+        )
+
+        assert upgraded == set(['host-1'])
+
+
+class TestGetWindows(object):
+
+    _hosts = [
+        {'hostname': 'host-%d' % i, 'availability_zone': 'az-%d' % (i % 2)}
+        for i in range(5)
+    ]
+
+    def _get_hostnames(self, windows):
+        return [[host['hostname'] for host in window] for window in windows]
+
+    def test_no_window(self):
+        windows = base.get_windows(self._hosts, None)
+
+        assert self._get_hostnames(windows) == [
+            ['host-0', 'host-1', 'host-2', 'host-3', 'host-4'],
+        ]
+
+    def test_window_of_hosts(self):
+        windows = base.get_windows(self._hosts, 2)
+
+        assert self._get_hostnames(windows) == [
+            ['host-0', 'host-1'],
+            ['host-2', 'host-3'],
+            ['host-4'],
+        ]
+
+    def test_window_in_percents(self):
+        windows = base.get_windows(self._hosts, '50%')
+
+        assert self._get_hostnames(windows) == [
+            ['host-0', 'host-1', 'host-2'],
+            ['host-3', 'host-4'],
+        ]
+
+    def test_window_in_percents_is_at_least_one_host(self):
+        windows = base.get_windows(self._hosts[:2], '10%')
+
+        assert self._get_hostnames(windows) == [['host-0'], ['host-1']]
+
+    def test_window_per_group(self):
+        windows = base.get_windows(self._hosts, (1, 'availability_zone'))
+
+        assert self._get_hostnames(windows) == [
+            ['host-0', 'host-1'],
+            ['host-2', 'host-3'],
+            ['host-4'],
+        ]
+
+
+class TestGetStages(object):
+
+    _dependencies = {
+        'nova': ['keystone'],
+        'horizon': ['keystone'],
+        'nova-compute': ['nova-conductor'],
+    }
+
+    def _get_names(self, stages):
+        return [
+            sorted(service['name'] for service, _ in stage)
+            for stage in stages
+        ]
+
+    def test_stages(self):
+        stages = base.get_stages(
+            [
+                ({'name': 'nova-compute'}, []),
+                ({'name': 'horizon-wsgi'}, []),
+                ({'name': 'nova-conductor'}, []),
+                ({'name': 'keystone-wsgi-admin'}, []),
+                ({'name': 'keystone-wsgi-public'}, []),
+            ],
+            self._dependencies,
+        )
+
+        assert self._get_names(stages) == [
+            ['keystone-wsgi-admin', 'keystone-wsgi-public'],
+            ['horizon-wsgi', 'nova-conductor'],
+            ['nova-compute'],
+        ]
+
+    def test_stages_of_independent_services(self):
+        stages = base.get_stages(
+            [
+                ({'name': 'nova-compute'}, []),
+                ({'name': 'horizon-wsgi'}, []),
+            ],
+            self._dependencies,
+        )
+
+        assert self._get_names(stages) == [['horizon-wsgi', 'nova-compute']]
+
+    def test_circular_dependencies(self):
+        with pytest.raises(ValueError) as excinfo:
+            base.get_stages(
+                [
+                    ({'name': 'nova-compute'}, []),
+                    ({'name': 'nova-conductor'}, []),
+                ],
+                {
+                    'nova-compute': ['nova-conductor'],
+                    'nova-conductor': ['nova-compute'],
+                },
+            )
+
+        assert str(excinfo.value) == (
+            'Services have circular dependencies: '
+            'nova-compute, nova-conductor')
+
+
+class TestHistory(UsesStateDir):
+
+    _playbook = '/opt/openstack-ansible/playbooks/os-nova-install.yml'
+
+    def test_no_history(self):
+        assert base.get_durations(self._playbook) == []
+        assert base.get_node_duration(self._playbook) is None
+
+    def test_record_duration(self):
+        base.record_duration(self._playbook, 2, 60.0)
+        base.record_duration(self._playbook, 1, 40.0)
+
+        assert base.get_durations('os-nova-install.yml') == [
+            {'nodes': 2, 'duration': 60.0},
+            {'nodes': 1, 'duration': 40.0},
+        ]
+
+    def test_history_is_kept_per_cluster(self):
+        with base.cluster_state('cluster-a'):
+            base.record_duration(self._playbook, 2, 60.0)
+
+        @base.cluster_state()
+        def get_durations(deployment=None):
+            return base.get_durations(self._playbook)
+
+        assert get_durations(deployment={'cluster': 'cluster-a'}) == [
+            {'nodes': 2, 'duration': 60.0},
+        ]
+        assert get_durations(deployment={'cluster': 'cluster-b'}) == []
+        assert base.get_durations(self._playbook) == []
+
+    def test_history_is_bounded(self, monkeypatch):
+        monkeypatch.setattr(
+            'kostyor_openstack_ansible.upgrades.base._HISTORY_SIZE', 2)
+
+        for duration in (10.0, 20.0, 30.0):
+            base.record_duration(self._playbook, 1, duration)
+
+        assert base.get_durations(self._playbook) == [
+            {'nodes': 1, 'duration': 20.0},
+            {'nodes': 1, 'duration': 30.0},
+        ]
+
+    def test_record_duration_with_facts(self):
+        facts = {'gather_subset': '!all'}
+        base.record_duration(self._playbook, 2, 100.0)
+
+        entry = base.record_duration(self._playbook, 2, 60.0, facts=facts)
+
+        assert entry == {
+            'nodes': 2, 'duration': 60.0, 'facts': facts, 'saved': 40.0,
+        }
+        assert base.get_node_duration(self._playbook) == 50.0
+        assert base.get_node_duration(self._playbook, facts) == 30.0
+
+    def test_get_node_duration(self):
+        base.record_duration(self._playbook, 2, 60.0)
+        base.record_duration(self._playbook, 1, 40.0)
+        base.record_duration(self._playbook, 4, 400.0)
+
+        assert base.get_node_duration(self._playbook) == 40.0
+
+
+class TestBatching(UsesStateDir):
+
+    _playbook = '/opt/openstack-ansible/playbooks/os-nova-install.yml'
+    _batching = {'target': 600, 'min': 1, 'max': 10}
+
+    def test_batch_size_without_history(self):
+        assert base.get_batch_size(self._batching, None) == 1
+
+    def test_batch_size_hits_target(self):
+        assert base.get_batch_size(self._batching, 100.0) == 6
+
+    def test_batch_size_within_bounds(self):
+        assert base.get_batch_size(self._batching, 1000.0) == 1
+        assert base.get_batch_size(self._batching, 1.0) == 10
+
+    def test_batch_size_grows_gradually(self):
+        assert base.get_batch_size(self._batching, 1.0, 3) == 6
+
+    def test_run_in_batches(self):
+        nodes = [{'hostname': 'node-%d' % i} for i in range(6)]
+        run = mock.Mock(return_value=0)
+
+        result = base.run_in_batches(
+            run, self._playbook, nodes, self._batching)
+
+        assert run.call_args_list == [
+            mock.call(nodes[0:1]),
+            mock.call(nodes[1:3]),
+            mock.call(nodes[3:6]),
+        ]
+        assert [batch['size'] for batch in result['batches']] == [1, 2, 3]
+        assert result['batches'][0]['nodes'] == ['node-0']
+        assert result['batches'][0]['next_size'] == 2
+
+    def test_run_in_batches_starts_from_history(self):
+        base.record_duration(self._playbook, 1, 200.0)
+        nodes = [{'hostname': 'node-%d' % i} for i in range(4)]
+        run = mock.Mock(return_value=0)
+
+        base.run_in_batches(run, self._playbook, nodes, self._batching)
+
+        assert run.call_args_list[0] == mock.call(nodes[0:3])
+
+
+class TestCheckReachability(UsesStateDir):
+
+    def test_all_hosts_reachable(self):
+        base.check_reachability(
+            {
+                'host-1': adhoc.AdHocResult({'ping': 'pong'}, 0.5),
+                'host-2': adhoc.AdHocResult({'ping': 'pong'}, 1.5),
+            },
+            ['host-1', 'host-2'])
+
+        assert base.get_response_times() == {'host-1': 0.5, 'host-2': 1.5}
+
+    def test_unreachable_hosts(self):
+        with pytest.raises(Exception) as excinfo:
+            base.check_reachability(
+                {
+                    'host-1': adhoc.AdHocResult({'ping': 'pong'}, 0.5),
+                    'host-2': adhoc.AdHocResult({'unreachable': True}, 10.0),
+                    'host-3': adhoc.AdHocResult({'failed': True}, 1.0),
+                },
+                ['host-1', 'host-2', 'host-3', 'host-4'])
+
+        assert str(excinfo.value) == (
+            'Hosts are unreachable: host-2, host-3, host-4')
+        assert base.get_response_times() == {'host-1': 0.5, 'host-3': 1.0}
+
+
+class TestGetStrategy(object):
+
+    def test_no_strategy(self):
+        assert base.get_strategy(None) is None
+
+    def test_builtin_strategy(self):
+        assert base.get_strategy({'name': 'free'}) == {'name': 'free'}
+
+    def test_plugin_strategy(self, tmpdir):
+        tmpdir.join('mitogen_linear.py').write('')
+        strategy = {'name': 'mitogen_linear', 'plugins': str(tmpdir)}
+
+        assert base.get_strategy(strategy) == strategy
+
+    def test_missing_plugin_strategy(self, tmpdir):
+        strategy = {'name': 'mitogen_linear', 'plugins': str(tmpdir)}
+
+        assert base.get_strategy(strategy) is None
+
+
+class TestQuarantine(UsesStateDir):
+
+    _playbook = '/opt/openstack-ansible/playbooks/os-nova-install.yml'
+
+    def test_quarantine(self):
+        assert base.quarantine(self._playbook, ['compute1'], 2)
+        assert base.quarantine(self._playbook, ['compute1', 'compute2'], 2)
+
+        assert base.get_quarantined() == {
+            'compute1': {'playbook': 'os-nova-install.yml', 'time': mock.ANY},
+            'compute2': {'playbook': 'os-nova-install.yml', 'time': mock.ANY},
+        }
+
+    def test_quarantine_limit_exceeded(self):
+        assert base.quarantine(self._playbook, ['compute1'], 2)
+        assert not base.quarantine(
+            self._playbook, ['compute2', 'compute3'], 2)
+
+        assert list(base.get_quarantined()) == ['compute1']
+
+    def test_exclude_quarantined(self):
+        base.quarantine(self._playbook, ['compute1'], 2)
+
+        nodes = base.exclude_quarantined(get_hosts('compute1', 'compute2'))
+
+        assert [node['hostname'] for node in nodes] == ['compute2']
+
+    def test_exclude_quarantined_canary(self):
+        base.quarantine(self._playbook, ['compute1'], 2)
+
+        with pytest.raises(Exception) as excinfo:
+            base.exclude_quarantined(
+                get_hosts('compute1', 'compute2'), canary=True)
+
+        assert str(excinfo.value) == 'Canary nodes are quarantined: compute1'
+
+    def test_release_quarantined(self):
+        base.quarantine(self._playbook, ['compute1', 'compute2'], 2)
+
+        base.release_quarantined(['compute1'])
+        assert list(base.get_quarantined()) == ['compute2']
+
+        base.release_quarantined()
+        assert base.get_quarantined() == {}
@@ -19,12 +19,14 @@ import mock
 import pytest
 
 from kostyor.rpc import app, tasks
-from kostyor_openstack_ansible.upgrades import ref
+from kostyor_openstack_ansible import adhoc, inventory
+from kostyor_openstack_ansible.upgrades import base, ref
 
-from ..common import get_fixture, get_inventory_instance, get_hosts
+from ..common import (
+    UsesStateDir, get_fixture, get_inventory_instance, get_hosts)
 
 
-class TestDriver(object):
+class TestDriver(UsesStateDir):
 
     _inventory = get_fixture('dynamic_inventory.json')
 
@@ -47,6 +49,9 @@ class TestDriver(object):
     def use_fake_executor(self, monkeypatch):
         self.executor = mock.Mock()
         self.executor.return_value.run.return_value = 0
+        self.executor.return_value._tqm._stats.failures = {}
+        self.executor.return_value._tqm._stats.dark = {}
+        self.executor.return_value._tqm._stats.processed = {}
 
         monkeypatch.setattr(
             'kostyor_openstack_ansible.upgrades.ref.PlaybookExecutor',
@@ -113,6 +118,52 @@ class TestDriver(object):
                 passwords={}),
         ]
 
+    def test_pre_stage(self, monkeypatch):
+        index = inventory.InventoryIndex(self._inventory)
+        monkeypatch.setattr(ref.inventory, 'load', mock.Mock(
+            return_value=index))
+        monkeypatch.setattr(self.driver, '_prestage_batch', 10)
+        self.executor.return_value.run.return_value = 2
+
+        # Inventory is available on deployment host only, so hosts are
+        # enumerated by a worker.
+        pre_stage = self.driver.pre_stage()
+        assert ref.inventory.load.call_count == 0
+
+        # Prefetching is best effort, so failures are tolerated. The task
+        # is replaced by the group of batches, so it's finished only when
+        # all of them are.
+        pre_stage.apply().get()
+
+        assert self.executor.call_count == (len(index.get_hosts()) + 9) // 10
+        assert self.executor.call_args == mock.call(
+            playbooks=[base._PRESTAGE_PLAYBOOK],
+            inventory=self.inventory,
+            variable_manager=mock.ANY,
+            loader=mock.ANY,
+            options=mock.ANY,
+            passwords={})
+
+    def test_pre_stage_uses_custom_inventory(self, monkeypatch):
+        monkeypatch.setattr(ref.inventory, 'load', mock.Mock())
+        monkeypatch.setattr(self.driver, '_inventory', '/opt/inventory.py')
+        monkeypatch.setattr(self.driver, '_prestage_batch', 1000)
+
+        self.driver.pre_stage().apply().get()
+
+        # Hosts are enumerated by Ansible, just like limits of playbooks
+        # executed against the custom inventory are resolved.
+        assert ref.inventory.load.call_count == 0
+        assert ref.Inventory.call_args_list[0] == mock.call(
+            mock.ANY, mock.ANY, '/opt/inventory.py')
+        self.executor.assert_called_once_with(
+            playbooks=[base._PRESTAGE_PLAYBOOK],
+            inventory=self.inventory,
+            variable_manager=mock.ANY,
+            loader=mock.ANY,
+            options=mock.ANY,
+            passwords={})
+
     def test_start_runs_playbook(self):
         self.driver.start({'name': 'nova-compute'}, get_hosts('compute1'))()
 
@@ -198,6 +249,171 @@ class TestDriver(object):
             'infra2_nova_scheduler_container-ea104a41',
         ])
 
+    def test_start_runs_playbook_with_skip_tags(self):
+        self.driver.start({'name': 'nova-compute'}, get_hosts('compute1'))()
+
+        options = self.executor.call_args[1]['options']
+        assert set(options.skip_tags) == set([
+            'nova-db-setup',
+            'nova-service-add',
+        ])
+
+    def test_start_restricts_fact_gathering(self, monkeypatch):
+        constants = {}
+
+        def read_constants():
+            constants['subset'] = ref.C.DEFAULT_GATHER_SUBSET
+            constants['timeout'] = ref.C.DEFAULT_GATHER_TIMEOUT
+            return 0
+
+        monkeypatch.setitem(
+            self.driver._facts,
+            'os-horizon-install.yml',
+            {'gather_subset': '!all', 'gather_timeout': 5})
+        self.executor.return_value.run.side_effect = read_constants
+        subset = ref.C.DEFAULT_GATHER_SUBSET
+
+        self.driver.start({'name': 'horizon-wsgi'}, get_hosts('infra1'))()
+
+        assert constants == {'subset': '!all', 'timeout': 5}
+        assert ref.C.DEFAULT_GATHER_SUBSET == subset
+
+    def test_start_uses_accelerated_strategy(self, monkeypatch, tmpdir):
+        tmpdir.join('mitogen_linear.py').write('')
+        add_directory = mock.Mock()
+        run = self.executor.return_value._tqm.run
+        plays = [
+            mock.Mock(strategy=ref.C.DEFAULT_STRATEGY),
+            mock.Mock(strategy='free'),
+        ]
+
+        def run_plays():
+            for play in plays:
+                self.executor.return_value._tqm.run(play=play)
+            return 0
+
+        monkeypatch.setattr(self.driver, '_strategy', {
+            'name': 'mitogen_linear', 'plugins': str(tmpdir)})
+        monkeypatch.setattr(ref.strategy_loader, 'add_directory',
+                            add_directory)
+        self.executor.return_value.run.side_effect = run_plays
+
+        self.driver.start({'name': 'horizon-wsgi'}, get_hosts('infra1'))()
+
+        add_directory.assert_called_once_with(str(tmpdir))
+        assert [play.strategy for play in plays] == ['mitogen_linear', 'free']
+        assert run.call_count == 2
+
+    def test_start_falls_back_to_default_strategy(self, monkeypatch, tmpdir):
+        run = self.executor.return_value._tqm.run
+
+        monkeypatch.setattr(self.driver, '_strategy', {
+            'name': 'mitogen_linear', 'plugins': str(tmpdir)})
+
+        self.driver.start({'name': 'horizon-wsgi'}, get_hosts('infra1'))()
+
+        assert self.executor.return_value._tqm.run is run
+
+    def test_start_uses_cluster_deployment(self, monkeypatch, tmpdir):
+        tmpdir.join('user_variables.yml').write('debug: true\n')
+        hosts = get_hosts('infra1')
+        monkeypatch.setitem(self.driver._clusters, hosts[0]['cluster_id'], {
+            'root': '/srv/cluster-a/openstack-ansible',
+            'deploy': str(tmpdir),
+            'inventory': '/srv/cluster-a/inventory.py',
+        })
+
+        self.driver.start({'name': 'horizon-wsgi'}, hosts)()
+
+        assert self.executor.call_args[1]['playbooks'] == [
+            '/srv/cluster-a/openstack-ansible/playbooks'
+            '/os-horizon-install.yml',
+        ]
+        assert ref.Inventory.call_args[0][2] == '/srv/cluster-a/inventory.py'
+
+        variable_manager = self.executor.call_args[1]['variable_manager']
+        assert variable_manager.extra_vars['debug'] is True
+
+    def test_start_uses_cluster_deploy_for_inventory(self, monkeypatch,
+                                                     tmpdir):
+        hosts = get_hosts('infra1')
+        monkeypatch.setitem(self.driver._clusters, hosts[0]['cluster_id'], {
+            'deploy': str(tmpdir),
+        })
+        monkeypatch.delenv('OSA_CONFIG_DIR', raising=False)
+
+        def get_inventory(*args):
+            # Dynamic inventory is executed while inventory is created, and
+            # it must generate inventory of the given deployment.
+            assert os.environ['OSA_CONFIG_DIR'] == str(tmpdir)
+            return self.inventory
+
+        ref.Inventory.side_effect = get_inventory
+
+        self.driver.start({'name': 'horizon-wsgi'}, hosts)()
+
+        assert ref.Inventory.call_args[0][2] == ref.C.DEFAULT_HOST_LIST
+        assert 'OSA_CONFIG_DIR' not in os.environ
+
+    def test_start_skips_upgraded_hosts(self, monkeypatch):
+        run_adhoc = mock.Mock(return_value={
+            'infra1_horizon_container-afb604da': adhoc.AdHocResult(
+                {
+                    'ansible_facts': {
+                        'ansible_local': {
+                            'openstack_ansible': {
+                                'horizon': {'venv_tag': '14.2.0'},
+                            },
+                        },
+                    },
+                },
+                0.1,
+            ),
+        })
+
+        monkeypatch.setattr(self.driver, '_release', '14.2.0')
+        monkeypatch.setattr(
+            'kostyor_openstack_ansible.upgrades.ref._run_adhoc_impl',
+            run_adhoc)
+
+        self.driver.start(
+            {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert run_adhoc.call_args[0][5:] == (
+            'setup', 'filter=ansible_local gather_subset=!all')
+        assert set([h.get_name() for h in self.inventory.get_hosts()]) == set([
+            'infra2_horizon_container-b7a45742',
+        ])
+
+    def test_start_probes_versions_without_tags(self, monkeypatch):
+        run_adhoc = mock.Mock(return_value={})
+        monkeypatch.setattr(self.driver, '_release', '14.2.0')
+        monkeypatch.setattr(
+            'kostyor_openstack_ansible.upgrades.ref._run_adhoc_impl',
+            run_adhoc)
+
+        self.driver.start({'name': 'nova-compute'}, get_hosts('compute1'))()
+
+        # The playbook is executed with skip-tags, but the probe task is
+        # untagged, so it must not be filtered out.
+        assert self.executor.call_args[1]['options'].skip_tags
+        options = run_adhoc.call_args[0][3]
+        assert not getattr(options, 'skip_tags', None)
+        assert not getattr(options, 'tags', None)
+
+    def test_start_skips_playbook_if_all_hosts_upgraded(self, monkeypatch):
+        monkeypatch.setattr(self.driver, '_release', '14.2.0')
+        monkeypatch.setattr(
+            'kostyor_openstack_ansible.upgrades.ref._run_adhoc_impl',
+            mock.Mock(return_value={}))
+        monkeypatch.setattr(
+            'kostyor_openstack_ansible.upgrades.base.get_upgraded_hosts',
+            mock.Mock(return_value=set(['compute1'])))
+
+        self.driver.start({'name': 'nova-compute'}, get_hosts('compute1'))()
+
+        self.executor.assert_not_called()
+
     def test_start_skip_not_supported_service(self):
         self.driver.start({'name': 'unknown-service'}, get_hosts('infra1'))()
 
@@ -213,3 +429,139 @@ class TestDriver(object):
             'Playbook "/opt/openstack-ansible/playbooks/os-nova-install.yml" '
             'has been finished with errors. Exit code is "42".'
         )
+
+    def test_start_quarantines_failed_nodes(self, monkeypatch):
+        monkeypatch.setattr(self.driver, '_quarantine', 1)
+        self.executor.return_value.run.return_value = 2
+        self.executor.return_value._tqm._stats.failures = {
+            'infra1_horizon_container-afb604da': 1,
+        }
+
+        self.driver.start(
+            {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert list(base.get_quarantined()) == ['infra1']
+
+        # The task has succeeded, so nothing is left to retry.
+        assert not os.path.exists(base.get_retry_file(
+            'os-horizon-install.yml', [
+                'infra1_horizon_container-afb604da',
+                'infra2_horizon_container-b7a45742',
+            ]))
+
+    def test_start_fails_if_quarantine_is_full(self, monkeypatch):
+        monkeypatch.setattr(self.driver, '_quarantine', 1)
+        self.executor.return_value.run.return_value = 2
+        self.executor.return_value._tqm._stats.failures = {
+            'infra1_horizon_container-afb604da': 1,
+            'infra2_horizon_container-b7a45742': 1,
+        }
+
+        with pytest.raises(Exception):
+            self.driver.start(
+                {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert base.get_quarantined() == {}
+
+    def test_run_playbook_reports_saved_time(self):
+        self.executor.return_value._tqm._stats.processed = {
+            'infra1': 1,
+            'infra1_horizon_container-afb604da': 1,
+            'infra2': 1,
+        }
+        base.record_duration('pip-conf-removal.yml', 1, 30.0)
+
+        result = ref._run_playbook.si(
+            '/opt/openstack-ansible/scripts/upgrade-utilities/playbooks'
+            '/pip-conf-removal.yml',
+            facts={'gather_subset': '!all'})().get()
+
+        assert result['exitcode'] == 0
+        assert 59.0 < result['saved'] <= 60.0
+        assert base.get_durations('pip-conf-removal.yml')[-1]['nodes'] == 2
+
+    def test_retry_runs_playbook_on_failed_hosts(self):
+        self.executor.return_value.run.return_value = 2
+        self.executor.return_value._tqm._stats.failures = {
+            'infra2_horizon_container-b7a45742': 1,
+        }
+
+        with pytest.raises(Exception):
+            self.driver.start(
+                {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        self.executor.return_value.run.return_value = 0
+        self.driver = ref.Driver()
+        self.driver.start(
+            {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert set([h.get_name() for h in self.inventory.get_hosts()]) == set([
+            'infra2_horizon_container-b7a45742',
+        ])
+
+    def test_ignored_failures_are_not_retried(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(ref.inventory, 'load', mock.Mock(
+            return_value=inventory.InventoryIndex(self._inventory)))
+        self.executor.return_value.run.return_value = 2
+        self.executor.return_value._tqm._stats.failures = {
+            'infra2_horizon_container-b7a45742': 1,
+        }
+
+        self.driver.pre_stage().apply().get()
+
+        assert not tmpdir.join('retry').check()
+
+    def test_retry_runs_playbook_on_unreachable_hosts(self):
+        self.executor.return_value.run.return_value = 3
+        self.executor.return_value._tqm._stats.dark = {
+            'infra1_horizon_container-afb604da': 1,
+        }
+
+        with pytest.raises(Exception):
+            self.driver.start(
+                {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        self.executor.return_value.run.return_value = 0
+        self.driver = ref.Driver()
+        self.driver.start(
+            {'name': 'horizon-wsgi'}, get_hosts('infra1', 'infra2'))()
+
+        assert set([h.get_name() for h in self.inventory.get_hosts()]) == set([
+            'infra1_horizon_container-afb604da',
+        ])
+
+
+class TestCachingDataLoader(object):
+
+    @pytest.fixture(autouse=True)
+    def use_fake_loader(self, monkeypatch):
+        self.load_from_file = mock.Mock(
+            side_effect=lambda file_name: {'hosts': 'all', 'tasks': []})
+
+        monkeypatch.setattr(ref, '_YAML_CACHE', {})
+        monkeypatch.setattr(
+            ref.DataLoader, 'load_from_file', self.load_from_file)
+
+    def test_load_is_cached(self, tmpdir):
+        playbook = tmpdir.join('playbook.yml')
+        playbook.write('- hosts: all')
+
+        loader = ref._CachingDataLoader()
+        data = loader.load_from_file(str(playbook))
+        data['tasks'].append({'debug': 'msg=changed'})
+
+        assert ref._CachingDataLoader().load_from_file(str(playbook)) == {
+            'hosts': 'all', 'tasks': [],
+        }
+        assert self.load_from_file.call_count == 1
+
+    def test_load_reloads_modified(self, tmpdir):
+        playbook = tmpdir.join('playbook.yml')
+        playbook.write('- hosts: all')
+
+        loader = ref._CachingDataLoader()
+        loader.load_from_file(str(playbook))
+        playbook.setmtime(playbook.mtime() + 10)
+        loader.load_from_file(str(playbook))
+
+        assert self.load_from_file.call_count == 2